@@ -28,16 +28,74 @@ resource "aws_lambda_function" "t_step2" {
       RIVERLINES_LAYER         = var.riverlines_layer
       MODEL_TABLE              = var.model_table
       LOOKUP_TABLE             = var.lookup_table
+      EXCEEDANCE_WINDOW        = var.exceedance_window
       AGOURL                   = var.agourl
       AGOUSERNAME              = var.agousername
       AGOPASSWORD              = var.agopassword
       HOSTED_FEATURE_LAYER_URL = var.hosted_feature_layer_url
-      TEMP_ITEM_ID_S3_KEY      = var.temp_item_id_s3_key
+      RUN_STATE_TABLE          = aws_dynamodb_table.run_state.name
     }
   }
   source_code_hash = filebase64sha256(var.lambda_zip_path)
 }
 
+# Run state (temporary item IDs per run), see run_state.py. Lambda function 1
+# shares the table: set its RUN_STATE_TABLE to the run_state_table_name
+# output; with stage1_lambda_role_arn set, its role gets the policy below too.
+resource "aws_dynamodb_table" "run_state" {
+  name         = var.run_state_table_name
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "scope"
+  range_key    = "run_id"
+
+  attribute {
+    name = "scope"
+    type = "S"
+  }
+  attribute {
+    name = "run_id"
+    type = "S"
+  }
+}
+
+# Lets the Lambda roles read and conditionally write the run state
+locals {
+  run_state_policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [{
+      Effect = "Allow"
+      Action = [
+        "dynamodb:GetItem",
+        "dynamodb:Query",
+        "dynamodb:Scan",
+        "dynamodb:TransactWriteItems",
+      ]
+      Resource = aws_dynamodb_table.run_state.arn
+    }]
+  })
+}
+
+resource "aws_iam_role_policy" "run_state" {
+  name   = "${var.lambda_function_name}-run-state"
+  role   = element(split("/", var.lambda_role_arn), length(split("/", var.lambda_role_arn)) - 1)
+  policy = local.run_state_policy
+}
+
+# The role of Lambda function 1, if it is not the same as this function's
+resource "aws_iam_role_policy" "run_state_stage1" {
+  count = var.stage1_lambda_role_arn != null && var.stage1_lambda_role_arn != var.lambda_role_arn ? 1 : 0
+  name  = "${var.lambda_function_name}-stage1-run-state"
+  role = element(
+    split("/", var.stage1_lambda_role_arn),
+    length(split("/", var.stage1_lambda_role_arn)) - 1
+  )
+  policy = local.run_state_policy
+}
+
+output "run_state_table_name" {
+  value = aws_dynamodb_table.run_state.name
+}
+
 # Variables for configuration
 variable "aws_region" {}
 variable "lambda_function_name" {}
@@ -49,11 +107,13 @@ variable "final_output_key" {}
 variable "riverlines_layer" {}
 variable "model_table" {}
 variable "lookup_table" {}
+variable "exceedance_window" { default = "0-48" }
 variable "agourl" {}
 variable "agousername" {}
 variable "agopassword" {}
 variable "hosted_feature_layer_url" {}
-variable "temp_item_id_s3_key" { default = "geopackages/last_temp_item_id.txt" }
+variable "run_state_table_name" { default = "lambda-run-state" }
+variable "stage1_lambda_role_arn" { default = null }
 variable "lambda_layer_arn" { default = null }
 variable "lambda_layer_arns" {
   type    = list(string)
@@ -76,5 +136,11 @@ variable "lambda_layer_arns" {
 #   -var 'agopassword=/AGOPASSWORD' \
 #   -var 'hosted_feature_layer_url=https://services3.arcgis.com/fp1tibNcN9mbExhG/arcgis/rest/services/final_output/FeatureServer/0'
 #   -var 'lambda_layer_arn=arn:aws:lambda:ap-southeast-2:851725470721:layer:arcgis-sqlite-lambda-stack-prd:2'
+#   -var 'stage1_lambda_role_arn=arn:aws:iam::AWSACCOUNT:role/s3-lambda-stack-prd-LambdaExecutionRole-YYYYYYYYY'
+#
+# Then point Lambda function 1 at the table (keep its other variables, this
+# command replaces the whole environment):
+# aws lambda update-function-configuration --function-name t-step1 \
+#   --environment "Variables={RUN_STATE_TABLE=$(terraform output -raw run_state_table_name),...}"
 
 # terraform plan -var 'aws_region=ap-southeast-2' -var 'lambda_function_name=step2_TEST' -var 'lambda_zip_path=./lambda_function2.zip' -var 'lambda_role_arn=arn:aws:iam::AWSACCOUNT:role/s3-lambda-stack-prd-LambdaExecutionRole-XXXXXXXXXXX' -var 'output_s3_bucket=s3-lambda-stack-prd-output-bucket-prod' -var 'output_s3_key=your-input-geopackage.gpkg' -var 'final_output_key=geopackages/final_output.gpkg' -var 'riverlines_layer=riverlines' -var 'model_table=data' -var 'lookup_table=lookup' -var 'agourl=https://ORGANISATION.maps.arcgis.com' -var 'agousername=USERNAME' -var 'agopassword=/AGOPASSWORD'   -var 'hosted_feature_layer_url=https://services3.arcgis.com/THEIRACCOUNT/arcgis/rest/services/final_output/FeatureServer/0' -var 'lambda_layer_arn=arn:aws:lambda:ap-southeast-2:MYACCOUNT:layer:arcgis-sqlite-lambda-stack-prd:2'
@@ -0,0 +1,226 @@
+"""
+Batch backfill: run the lambda_function transform stages over many NetCDF files.
+
+Example:
+    python backfill.py s3://s3-lambda-stack-prd-input-bucket-prod/forecasts/2024/ \
+        ./backfill_output --reference ./a_gpkg.gpkg --workers 8
+
+Each input file gets its own output folder (<output>/<file stem>/) holding the
+first join, second join and threshold extract GeoPackages, plus a _SUCCESS
+marker written last. Files whose marker already exists are skipped, so an
+interrupted backfill can simply be started again.
+"""
+import argparse
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import boto3
+import s3fs
+
+import lambda_function
+from run_state import open_state_store
+
+SUCCESS_MARKER = "_SUCCESS"
+
+
+def list_netcdf_files(source):
+    """List the .nc files in a local directory or below an s3:// prefix, sorted by name."""
+    if source.startswith("s3://"):
+        fs = s3fs.S3FileSystem()
+        paths = [f"s3://{p}" for p in fs.find(source) if p.endswith(".nc")]
+    else:
+        paths = [
+            os.path.join(root, name)
+            for root, _, names in os.walk(source)
+            for name in names
+            if name.endswith(".nc")
+        ]
+    return sorted(paths)
+
+
+def split_s3_url(url):
+    """Split s3://bucket/key into (bucket, key)."""
+    bucket, _, key = url[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def file_output_location(output, input_path):
+    """Output folder (local path or s3:// URL) for one input file."""
+    stem = os.path.splitext(os.path.basename(input_path))[0]
+    return f"{output.rstrip('/')}/{stem}"
+
+
+def is_done(output, input_path):
+    """Check for the _SUCCESS marker of an input file."""
+    marker = f"{file_output_location(output, input_path)}/{SUCCESS_MARKER}"
+    if marker.startswith("s3://"):
+        return s3fs.S3FileSystem().exists(marker)
+    return os.path.exists(marker)
+
+
+def backfill_file(input_path, output, reference_local_path):
+    """Worker: transform one NetCDF file and store its GeoPackages in the output location."""
+    location = file_output_location(output, input_path)
+    to_s3 = location.startswith("s3://")
+    work_dir = tempfile.mkdtemp() if to_s3 else location
+    os.makedirs(work_dir, exist_ok=True)
+
+    outputs = lambda_function.transform_netcdf_to_geopackages(
+        input_path, reference_local_path, output_dir=work_dir
+    )
+    for name, path in list(outputs.items()):
+        if not os.path.exists(path):
+            # e.g. no extract when the file has no timewindows == 3
+            print(f"No {name} GeoPackage written for {input_path}")
+            del outputs[name]
+
+    if to_s3:
+        s3_client = boto3.client("s3")
+        bucket, prefix = split_s3_url(location)
+        for name, path in outputs.items():
+            key = f"{prefix}/{os.path.basename(path)}"
+            s3_client.upload_file(path, bucket, key)
+            outputs[name] = f"s3://{bucket}/{key}"
+        s3_client.put_object(Bucket=bucket, Key=f"{prefix}/{SUCCESS_MARKER}", Body=b"")
+        shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        with open(os.path.join(location, SUCCESS_MARKER), "w"):
+            pass
+    return outputs
+
+
+def publish_latest(input_path, output):
+    """Publish the outputs of one backfilled file to the hosted feature layers."""
+    location = file_output_location(output, input_path)
+    outputs = {}
+    file_names = {
+        "first": "first_join_geopackage.gpkg",
+        "second": "second_join_geopackage.gpkg",
+        # Written by the transform when GENERALIZED_LAYER_URLS is set
+        **{
+            f"second_{band}": f"second_join_geopackage_{band}.gpkg"
+            for band in lambda_function.GENERALIZED_LAYER_URLS
+        },
+    }
+    for name, file_name in file_names.items():
+        path = f"{location}/{file_name}"
+        exists = (
+            s3fs.S3FileSystem().exists(path)
+            if path.startswith("s3://")
+            else os.path.exists(path)
+        )
+        if name.startswith("second_") and not exists:
+            # Backfilled before the band was configured
+            continue
+        if path.startswith("s3://"):
+            local_path = os.path.join(tempfile.gettempdir(), file_name)
+            boto3.client("s3").download_file(*split_s3_url(path), local_path)
+            path = local_path
+        outputs[name] = path
+
+    from arcgis.gis import GIS
+
+    print(f"Connecting to ArcGIS Online {lambda_function.AGOURL}")
+    gis = GIS(
+        lambda_function.AGOURL,
+        lambda_function.AGOUSERNAME,
+        lambda_function.get_agol_password(),
+    )
+    s3_bucket, s3_key = (
+        split_s3_url(input_path) if input_path.startswith("s3://") else (None, None)
+    )
+    item_ids = lambda_function.publish_geopackages(gis, outputs, s3_bucket, s3_key)
+    if s3_bucket:
+        # Let the next Lambda run clean up the temporary items, as usual
+        lambda_function.save_item_metadata(
+            open_state_store(), s3_key, f"backfill-{uuid.uuid4().hex}", item_ids
+        )
+    for key, item_id in item_ids.items():
+        print(f"Published {key}: item {item_id}")
+
+
+def run_backfill(source, output, reference_local_path, workers=None, publish=False):
+    """Process every not-yet-done .nc file under source on a process pool."""
+    input_paths = list_netcdf_files(source)
+    pending = [p for p in input_paths if not is_done(output, p)]
+    print(
+        f"Found {len(input_paths)} NetCDF files, {len(input_paths) - len(pending)} "
+        f"already done, {len(pending)} to process."
+    )
+
+    started = time.perf_counter()
+    completed = 0
+    failed = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(backfill_file, path, output, reference_local_path): path
+            for path in pending
+        }
+        for future in concurrent.futures.as_completed(futures):
+            path = futures[future]
+            try:
+                future.result()
+                completed += 1
+            except Exception as e:
+                print(f"Error processing {path}: {e}")
+                failed.append(path)
+            elapsed_min = (time.perf_counter() - started) / 60
+            print(
+                f"[{completed + len(failed)}/{len(pending)}] {path} - "
+                f"{completed / elapsed_min:.1f} files/min"
+            )
+
+    elapsed_min = (time.perf_counter() - started) / 60
+    rate = completed / elapsed_min if elapsed_min > 0 else 0.0
+    print(
+        f"Backfill finished: {completed} processed, {len(failed)} failed in "
+        f"{elapsed_min:.1f} min ({rate:.1f} files/min)."
+    )
+
+    if publish:
+        if failed:
+            print("Not publishing because some files failed; re-run to retry them.")
+        elif input_paths:
+            # The hosted layers hold a single forecast, so publish the newest file once
+            publish_latest(input_paths[-1], output)
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Backfill NetCDF files into GeoPackages using the Lambda transform stages."
+    )
+    parser.add_argument("source", help="Directory or s3:// prefix containing .nc files")
+    parser.add_argument("output", help="Output directory or s3:// prefix")
+    parser.add_argument(
+        "--reference",
+        help="Local reference riverlines GeoPackage (downloaded from S3 if omitted)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of worker processes (default: all CPU cores)",
+    )
+    parser.add_argument(
+        "--publish",
+        action="store_true",
+        help="Publish the newest file's GeoPackages to ArcGIS Online at the end",
+    )
+    args = parser.parse_args(argv)
+
+    reference_local_path = args.reference or lambda_function.download_reference_geopackage(
+        boto3.client("s3")
+    )
+    failed = run_backfill(
+        args.source, args.output, reference_local_path, args.workers, args.publish
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,388 @@
+"""
+Local benchmarks for the NetCDF -> GeoPackage pipeline on synthetic data.
+
+Example:
+    python benchmark.py decode --times 72 --reaches 200000
+
+Runs without AWS or ArcGIS access; all inputs are generated in a temporary
+directory.
+"""
+import argparse
+import contextlib
+import os
+import tempfile
+import time
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+from netCDF4 import Dataset, num2date
+
+from chunked_upload import ChunkedUploader
+from fake_portal import start_fake_portal
+from gpkg_memory import GeoPackageOutput
+from lambda_function import (
+    THRESHOLD_VARIABLES,
+    TIME_DEPENDENT_VARIABLES,
+    convert_to_datetime,
+    decode_netcdf_file,
+    join_geopackage_tables_in_memory,
+)
+from netcdf_decode import decode_cf_times, decode_variables_parallel
+from reference_store import write_reference_store
+from upload_payload import optimize_upload_payload
+from zarr_reader import write_zarr_from_netcdf
+
+
+def make_synthetic_netcdf(path, n_times, n_reaches, seed=0):
+    """Write a zlib-compressed NetCDF file shaped like the upstream forecast files."""
+    rng = np.random.default_rng(seed)
+    dataset = Dataset(path, mode="w")
+    dataset.createDimension("time", n_times)
+    dataset.createDimension("nrch", n_reaches)
+    dataset.createDimension("nrthresholds", 4)
+    dataset.createDimension("timewindows", 5)
+
+    time_var = dataset.createVariable("time", "f8", ("time",))
+    time_var.units = "hours since 2024-01-01 00:00:00"
+    time_var[:] = np.arange(n_times)
+    dataset.createVariable("nrch", "i4", ("nrch",))[:] = np.arange(n_reaches)
+    dataset.createVariable("rchid", "i4", ("nrch",))[:] = np.arange(n_reaches) + 1
+    dataset.createVariable("streamorder", "i4", ("nrch",))[:] = rng.integers(
+        1, 8, n_reaches
+    )
+    for name in TIME_DEPENDENT_VARIABLES:
+        variable = dataset.createVariable(
+            name, "f4", ("time", "nrch"), zlib=True, complevel=4, fill_value=-9999.0
+        )
+        values = (rng.gamma(2.0, 2.0, (n_times, n_reaches))).astype("f4")
+        values[rng.random((n_times, n_reaches)) < 0.001] = 999
+        variable[:] = values
+    for name in THRESHOLD_VARIABLES:
+        dataset.createVariable(
+            name, "f4", ("nrch",), zlib=True, fill_value=-9999.0
+        )[:] = rng.gamma(2.0, 3.0, n_reaches)
+    dataset.createVariable("nrthresholds", "i4", ("nrthresholds",))[:] = [2, 5, 10, 20]
+    dataset.createVariable(
+        "sum_bool_value_thsh", "f4", ("nrthresholds", "nrch", "timewindows"), zlib=True
+    )[:] = rng.integers(0, 5, (4, n_reaches, 5))
+    dataset.close()
+    return path
+
+
+def report(name, seconds, nbytes=None):
+    """Print one benchmark result line."""
+    line = f"{name:<40} {seconds:8.3f} s"
+    if nbytes is not None:
+        line += f" {nbytes / 1e6 / seconds:10.1f} MB/s"
+    print(line)
+
+
+def bench_decode(args, work_dir):
+    """Sequential vs multi-process decode of the time-dependent and threshold variables."""
+    path = make_synthetic_netcdf(
+        os.path.join(work_dir, "decode.nc"), args.times, args.reaches
+    )
+    names = TIME_DEPENDENT_VARIABLES + THRESHOLD_VARIABLES
+    print(
+        f"decode: {args.times} times x {args.reaches} reaches, "
+        f"file size {os.path.getsize(path) / 1e6:.1f} MB"
+    )
+
+    start = time.perf_counter()
+    dataset = Dataset(path, mode="r")
+    sequential = {name: dataset.variables[name][:] for name in names}
+    dataset.close()
+    sequential_seconds = time.perf_counter() - start
+    nbytes = sum(array.nbytes for array in sequential.values())
+    report("decode sequential", sequential_seconds, nbytes)
+
+    for workers in sorted({2, 4, os.cpu_count() or 1}):
+        start = time.perf_counter()
+        arrays, _ = decode_variables_parallel(path, names, max_workers=workers)
+        seconds = time.perf_counter() - start
+        report(f"decode parallel ({workers} processes)", seconds, nbytes)
+        for name in names:
+            np.testing.assert_array_equal(
+                np.ma.filled(sequential[name].astype(arrays[name].dtype), np.nan),
+                arrays[name],
+            )
+        del arrays
+
+
+def bench_upload(args, work_dir):
+    """Single-connection vs parallel chunked upload to the local fake portal."""
+    path = os.path.join(work_dir, "upload.gpkg")
+    with open(path, "wb") as f:
+        f.write(os.urandom(args.upload_mb * 1024 * 1024))
+    nbytes = os.path.getsize(path)
+    server = start_fake_portal(fail_rate=args.fail_rate)
+    print(f"upload: {args.upload_mb} MB to {server.url}, fail rate {args.fail_rate}")
+    try:
+        for workers in (1, 4, 8):
+            uploader = ChunkedUploader(
+                server.url, "benchmark", "token", part_size=8 * 1024 * 1024,
+                max_workers=workers, backoff_seconds=0.05,
+            )
+            start = time.perf_counter()
+            uploader.upload(path, {"title": "benchmark", "type": "GeoPackage"})
+            report(f"chunked upload ({workers} connections)", time.perf_counter() - start, nbytes)
+    finally:
+        server.shutdown()
+
+
+def bench_zarr(args, work_dir):
+    """NetCDF decode vs the same data as a Zarr directory store, with 1-16 fetch threads."""
+    path = make_synthetic_netcdf(
+        os.path.join(work_dir, "zarr.nc"), args.times, args.reaches
+    )
+    store = write_zarr_from_netcdf(path, os.path.join(work_dir, "forecast.zarr"))
+    print(f"zarr: {args.times} times x {args.reaches} reaches")
+
+    start = time.perf_counter()
+    expected = decode_netcdf_file(path)
+    report("decode NetCDF", time.perf_counter() - start)
+    for workers in (1, 4, 16):
+        os.environ["ZARR_FETCH_WORKERS"] = str(workers)
+        start = time.perf_counter()
+        decoded = decode_netcdf_file(store)
+        report(f"decode Zarr ({workers} fetch threads)", time.perf_counter() - start)
+        for output, valid in expected["valid"].items():
+            np.testing.assert_array_equal(valid, decoded["valid"][output])
+        for name, values in expected["variables"].items():
+            np.testing.assert_array_equal(
+                np.ma.getdata(values), np.ma.getdata(decoded["variables"][name])
+            )
+    del os.environ["ZARR_FETCH_WORKERS"]
+
+
+def make_synthetic_riverlines(n_reaches, seed=0):
+    """GeoDataFrame of short random line segments shaped like the final output layer."""
+    rng = np.random.default_rng(seed)
+    starts = rng.uniform(0, 1e6, (n_reaches, 2))
+    coords = np.stack([starts, starts + rng.uniform(-500, 500, (n_reaches, 2))], axis=1)
+    return gpd.GeoDataFrame(
+        {
+            "rchid": np.arange(n_reaches) + 1,
+            "sum_bool_value_thsh": rng.integers(0, 5, n_reaches),
+            "nrthresholds": rng.choice([2, 5, 10, 20], n_reaches),
+        },
+        geometry=shapely.linestrings(coords),
+        crs="EPSG:2193",
+    )
+
+
+def bench_gpkg(args, work_dir):
+    """GeoPackage built on disk and read back for upload vs built in memory."""
+    gdf = make_synthetic_riverlines(args.reaches)
+    print(f"gpkg: {args.reaches} features")
+
+    # Best of three runs, the write times are noisy
+    disk_seconds = memory_seconds = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        on_disk = GeoPackageOutput.from_frame(gdf, "disk.gpkg", "layer", 0, work_dir)
+        with open(on_disk.path, "rb") as f:
+            nbytes = len(f.read())
+        disk_seconds = min(disk_seconds, time.perf_counter() - start)
+        on_disk.remove()
+
+        start = time.perf_counter()
+        in_memory = GeoPackageOutput.from_frame(gdf, "memory.gpkg", "layer", 1 << 40)
+        memory_seconds = min(memory_seconds, time.perf_counter() - start)
+    report("gpkg write + read back (/tmp)", disk_seconds, nbytes)
+    report("gpkg in memory", memory_seconds, in_memory.size)
+    print(
+        f"In-memory GeoPackage saved {disk_seconds - memory_seconds:.3f} s "
+        f"({1 - memory_seconds / disk_seconds:.0%})"
+    )
+
+
+def bench_index(args, work_dir):
+    """Write time and file size vs key lookup and bounding-box read time per index setup."""
+    gdf = make_synthetic_riverlines(args.reaches)
+    rng = np.random.default_rng(1)
+    keys = rng.integers(1, args.reaches + 1, 1000).tolist()
+    boxes = [(x, y, x + 10000, y + 10000) for x, y in rng.uniform(0, 1e6 - 10000, (20, 2))]
+    print(f"index: {args.reaches} features, {len(keys)} rchid lookups, {len(boxes)} 10 km boxes")
+
+    setups = {
+        "no indexes": (False, []),
+        "spatial index": (True, []),
+        "spatial + rchid index": (True, ["rchid"]),
+    }
+    for name, (spatial_index, columns) in setups.items():
+        write_seconds = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            output = GeoPackageOutput.from_frame(
+                gdf, "index.gpkg", "layer", 0, work_dir, spatial_index, columns
+            )
+            write_seconds = min(write_seconds, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with contextlib.closing(output.connect()) as conn:
+            for key in keys:
+                conn.execute("SELECT * FROM layer WHERE rchid = ?", (key,)).fetchall()
+        lookup_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        features = sum(len(pyogrio.read_dataframe(output.path, bbox=box)) for box in boxes)
+        bbox_seconds = time.perf_counter() - start
+        print(
+            f"{name:<24} write {write_seconds:7.3f} s, {output.size / 1e6:6.1f} MB, "
+            f"lookups {lookup_seconds:7.3f} s, bbox reads {bbox_seconds:7.3f} s "
+            f"({features} features)"
+        )
+        output.remove()
+
+
+def bench_reference(args, work_dir):
+    """Reference GeoPackage read + join vs reference store open + join."""
+    layer = "rec1_Riverlines_SimplifyLine"
+    gdf = make_synthetic_riverlines(args.reaches).rename(columns={"rchid": "Top_reach"})
+    gpkg_path = os.path.join(work_dir, "reference.gpkg")
+    gdf.to_file(gpkg_path, layer=layer, driver="GPKG")
+    store_path = os.path.join(work_dir, "reference.refstore")
+    write_reference_store(gpkg_path, store_path, [layer])
+    # The second output joins the reaches with a forecast, about a third here
+    rng = np.random.default_rng(1)
+    aggregated = pd.DataFrame(
+        {"rchid": rng.choice(args.reaches, args.reaches // 3, replace=False) + 1}
+    )
+    print(f"reference: {args.reaches} reaches, {len(aggregated)} joined")
+
+    timings = {}
+    for name, path in {"gpkg": gpkg_path, "store": store_path}.items():
+        start = time.perf_counter()
+        joined = join_geopackage_tables_in_memory(
+            path, layer, aggregated, "Top_reach", "rchid", join_type="inner"
+        )
+        timings[name] = time.perf_counter() - start
+        report(f"reference {name} read + join", timings[name], os.path.getsize(path))
+    print(
+        f"Reference store join {timings['gpkg'] / timings['store']:.1f}x faster "
+        f"({len(joined)} rows)"
+    )
+
+
+def bench_time(args, work_dir):
+    """num2date + per-value datetime conversion vs the vectorized CF time decoder."""
+    units = "hours since 2024-01-01 00:00:00"
+    values = np.arange(args.times, dtype="float64")
+    start = time.perf_counter()
+    expected = pd.to_datetime(
+        [convert_to_datetime(value) for value in num2date(values, units=units)]
+    ).values
+    loop_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    decoded = decode_cf_times(values, units)
+    vectorized_seconds = time.perf_counter() - start
+    if not np.array_equal(decoded, expected):
+        raise AssertionError("Vectorized time decoding differs from num2date.")
+    print(f"time: {args.times} time steps")
+    report("time num2date loop", loop_seconds)
+    report("time vectorized", vectorized_seconds)
+
+
+def bench_payload(args, work_dir):
+    """Size and upload time of the first output GeoPackage per upload optimization."""
+    reaches = make_synthetic_riverlines(args.reaches // 10).rename(
+        columns={"rchid": "Top_reach"}
+    )[["Top_reach", "geometry"]]
+    # Long format like the first output; a tenth of the reaches is not in the reference
+    times = pd.date_range("2024-01-01", periods=24, freq="h")
+    rng = np.random.default_rng(1)
+    rchid = np.arange(len(reaches) + len(reaches) // 10) + 1
+    raw = pd.DataFrame(
+        {
+            "rchid": np.repeat(rchid, len(times)),
+            "time_stamp_date": np.tile(times, len(rchid)),
+            "streamorder": np.repeat(rng.integers(1, 8, len(rchid)), len(times)),
+            "relativevalues": rng.random(len(rchid) * len(times)).round(2),
+        }
+    )
+    joined = reaches.merge(raw, left_on="Top_reach", right_on="rchid", how="right")
+    source = GeoPackageOutput.from_frame(
+        gpd.GeoDataFrame(joined, geometry="geometry", crs=reaches.crs),
+        "first.gpkg",
+        "layer",
+        0,
+        work_dir,
+    )
+    print(f"payload: {len(joined)} rows, {len(reaches)} reaches in the reference")
+
+    # Next to the source, the optimized file would replace it
+    output_dir = os.path.join(work_dir, "payload")
+    os.makedirs(output_dir, exist_ok=True)
+    server = start_fake_portal()
+    setups = [
+        [],
+        ["drop_unmatched"],
+        ["drop_unmatched", "compact"],
+        ["drop_unmatched", "compact", "quantize", "narrow"],
+        ["drop_unmatched", "compact", "compress"],
+        ["drop_unmatched", "compact", "quantize", "narrow", "compress"],
+    ]
+    try:
+        for optimizations in setups:
+            start = time.perf_counter()
+            payload, stats = optimize_upload_payload(
+                source, optimizations, memory_budget=0, output_dir=output_dir
+            )
+            optimize_seconds = time.perf_counter() - start
+            uploader = ChunkedUploader(
+                server.url, "benchmark", "token", part_size=8 * 1024 * 1024, max_workers=4
+            )
+            start = time.perf_counter()
+            uploader.upload(payload.path, {"title": "benchmark", "type": "GeoPackage"})
+            upload_seconds = time.perf_counter() - start
+            print(
+                f"{'+'.join(optimizations) or 'none':<52} {stats['bytes_after'] / 1e6:7.2f} MB, "
+                f"optimize {optimize_seconds:6.2f} s, upload {upload_seconds:6.2f} s"
+            )
+            if payload is not source:
+                payload.remove()
+    finally:
+        server.shutdown()
+
+
+BENCHMARKS = {
+    "decode": bench_decode,
+    "upload": bench_upload,
+    "gpkg": bench_gpkg,
+    "zarr": bench_zarr,
+    "index": bench_index,
+    "reference": bench_reference,
+    "time": bench_time,
+    "payload": bench_payload,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "benchmarks",
+        nargs="*",
+        help=f"Benchmarks to run: {', '.join(BENCHMARKS)} (default: all)",
+    )
+    parser.add_argument("--times", type=int, default=72, help="Number of time steps")
+    parser.add_argument("--reaches", type=int, default=100000, help="Number of reaches")
+    parser.add_argument("--upload-mb", type=int, default=64, help="Size of the upload test file")
+    parser.add_argument(
+        "--fail-rate", type=float, default=0.0, help="Fraction of failing part uploads"
+    )
+    args = parser.parse_args(argv)
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        for name in args.benchmarks or list(BENCHMARKS):
+            BENCHMARKS[name](args, work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import json
+import os
+import tempfile
+import uuid
+
+import boto3
+import botocore
+
+from gpkg_memory import as_geopackage_output
+from lambda_function import read_frames_from_sqlite, write_frames_to_sqlite
+
+# Stop starting new stages once less than this is left of the Lambda timeout
+DEFAULT_MIN_REMAINING_MS = 180000
+# Upper bound on self re-invocations for one run, to avoid endless loops
+DEFAULT_MAX_CONTINUATIONS = 5
+
+
+class RunCheckpoint:
+    """Stage-level checkpoints of one lambda_handler run, persisted to S3.
+
+    Everything lives under s3://{bucket}/{prefix}/{run_id}/: a state.json with
+    the completed stages (and small results such as item IDs), plus the
+    DataFrames and GeoPackages that later stages need. With bucket=None all
+    methods are no-ops and every stage simply runs.
+    """
+
+    def __init__(self, bucket, run_id=None, prefix="checkpoints", continuation=0):
+        self.bucket = bucket
+        self.run_id = run_id or uuid.uuid4().hex
+        self.prefix = f"{prefix}/{self.run_id}"
+        self.continuation = continuation
+        self.s3_client = boto3.client("s3") if bucket else None
+        self.state = self._load_state()
+
+    @classmethod
+    def from_event(cls, event):
+        """Resume the run named in event["resume_run_id"] or start a new one.
+
+        Checkpointing is enabled by setting CHECKPOINT_S3_BUCKET.
+        """
+        return cls(
+            os.environ.get("CHECKPOINT_S3_BUCKET"),
+            run_id=event.get("resume_run_id"),
+            continuation=event.get("continuation", 0),
+        )
+
+    @property
+    def enabled(self):
+        return self.s3_client is not None
+
+    def _load_state(self):
+        if not self.s3_client:
+            return {}
+        try:
+            response = self.s3_client.get_object(
+                Bucket=self.bucket, Key=f"{self.prefix}/state.json"
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code", "") in ("404", "NoSuchKey"):
+                return {}
+            raise
+        state = json.loads(response["Body"].read())
+        print(f"Resuming run {self.run_id}, completed stages: {list(state)}")
+        return state
+
+    def is_done(self, stage):
+        return stage in self.state
+
+    def result(self, stage):
+        """Small result stored with mark_done for a completed stage."""
+        return self.state[stage]
+
+    def mark_done(self, stage, result=None):
+        """Record a completed stage (with an optional JSON-serializable result)."""
+        self.state[stage] = result
+        if self.s3_client:
+            self.s3_client.put_object(
+                Bucket=self.bucket,
+                Key=f"{self.prefix}/state.json",
+                Body=json.dumps(self.state).encode("utf-8"),
+            )
+            print(f"Checkpoint: stage '{stage}' done for run {self.run_id}")
+
+    def save_frames(self, stage, frames):
+        """Persist a dict of DataFrames for a stage as one SQLite object."""
+        if not self.s3_client:
+            return
+        local_path = os.path.join(tempfile.gettempdir(), f"{self.run_id}_{stage}.sqlite")
+        write_frames_to_sqlite(frames, local_path)
+        self.s3_client.upload_file(local_path, self.bucket, f"{self.prefix}/{stage}.sqlite")
+        os.remove(local_path)
+
+    def load_frames(self, stage, table_names):
+        local_path = os.path.join(tempfile.gettempdir(), f"{self.run_id}_{stage}.sqlite")
+        self.s3_client.download_file(self.bucket, f"{self.prefix}/{stage}.sqlite", local_path)
+        frames = read_frames_from_sqlite(local_path, table_names)
+        os.remove(local_path)
+        return frames
+
+    def save_files(self, stage, paths):
+        """Persist the files of a stage; paths is {name: local path or GeoPackageOutput}."""
+        if not self.s3_client:
+            return
+        for name, path in paths.items():
+            output = as_geopackage_output(path)
+            output.upload_to_s3(
+                self.s3_client, self.bucket, f"{self.prefix}/{stage}/{output.name}"
+            )
+
+    def load_files(self, stage, file_names, output_dir=None):
+        """Download the files of a stage; file_names is {name: base name}."""
+        output_dir = output_dir or tempfile.gettempdir()
+        paths = {}
+        for name, file_name in file_names.items():
+            paths[name] = os.path.join(output_dir, file_name)
+            self.s3_client.download_file(
+                self.bucket, f"{self.prefix}/{stage}/{file_name}", paths[name]
+            )
+        return paths
+
+    def clear(self):
+        """Delete all checkpoint objects of this run once it completed."""
+        if not self.s3_client:
+            return
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=f"{self.prefix}/"):
+            keys = [{"Key": obj["Key"]} for obj in page.get("Contents", [])]
+            if keys:
+                self.s3_client.delete_objects(Bucket=self.bucket, Delete={"Objects": keys})
+
+
+class DeadlineGuard:
+    """Watches context.get_remaining_time_in_millis() between stages."""
+
+    def __init__(self, context, min_remaining_ms=None):
+        self.context = context
+        self.min_remaining_ms = min_remaining_ms or int(
+            os.environ.get("CHECKPOINT_MIN_REMAINING_MS", DEFAULT_MIN_REMAINING_MS)
+        )
+
+    def remaining_ms(self):
+        if not hasattr(self.context, "get_remaining_time_in_millis"):
+            return None  # Not running in Lambda (local test with context=None/{})
+        return self.context.get_remaining_time_in_millis()
+
+    def should_continue_elsewhere(self):
+        """True if the next stage should run in a fresh invocation instead."""
+        remaining = self.remaining_ms()
+        return remaining is not None and remaining < self.min_remaining_ms
+
+
+def continue_in_new_invocation(event, context, checkpoint):
+    """Re-invoke this function asynchronously to resume the run from its checkpoint."""
+    max_continuations = int(
+        os.environ.get("CHECKPOINT_MAX_CONTINUATIONS", DEFAULT_MAX_CONTINUATIONS)
+    )
+    if checkpoint.continuation >= max_continuations:
+        raise RuntimeError(
+            f"Run {checkpoint.run_id} did not finish within {max_continuations} continuations."
+        )
+    payload = dict(event)
+    payload["resume_run_id"] = checkpoint.run_id
+    payload["continuation"] = checkpoint.continuation + 1
+    boto3.client("lambda").invoke(
+        FunctionName=context.invoked_function_arn,
+        InvocationType="Event",
+        Payload=json.dumps(payload).encode("utf-8"),
+    )
+    print(
+        f"Not enough time left, run {checkpoint.run_id} continues in a new invocation "
+        f"(continuation {payload['continuation']})."
+    )
+    return {
+        "statusCode": 202,
+        "body": f"Run {checkpoint.run_id} continues in a new invocation.",
+    }
@@ -0,0 +1,161 @@
+import concurrent.futures
+import json
+import os
+import tempfile
+import time
+
+from portal_client import PortalClient, PortalError
+
+DEFAULT_PART_SIZE = 32 * 1024 * 1024
+# ArcGIS Online accepts at most 10000 parts per item
+MAX_PARTS = 10000
+
+
+class UploadError(PortalError):
+    """Raised when the portal rejects a request or a part keeps failing."""
+
+
+class ChunkedUploader(PortalClient):
+    """Multipart upload of large files as ArcGIS Online / Portal items.
+
+    Uses the REST multipart flow: addItem (multipart=true) -> addPart for each
+    part, in parallel and retried individually with exponential backoff ->
+    commit -> poll status. The item ID is kept in a small JSON state file in
+    the temp directory, so an interrupted upload asks the portal which parts
+    it already has (items/<id>/parts) and only sends the missing ones.
+
+    Works against any portal URL, including the local fake in fake_portal.py.
+    """
+
+    error_class = UploadError
+
+    def __init__(
+        self,
+        portal_url,
+        username,
+        token,
+        part_size=DEFAULT_PART_SIZE,
+        max_workers=4,
+        max_retries=5,
+        backoff_seconds=1.0,
+        session=None,
+    ):
+        super().__init__(portal_url, username, token, max_retries, backoff_seconds, session)
+        self.part_size = part_size
+        self.max_workers = max_workers
+
+    def _load_state(self, state_path, file_size):
+        if not os.path.exists(state_path):
+            return None
+        with open(state_path) as f:
+            state = json.load(f)
+        if state.get("file_size") != file_size or state.get("part_size") != self.part_size:
+            print("Upload state does not match the file any more, starting over.")
+            return None
+        return state
+
+    def _upload_part(self, item_id, path, part_num, data=None):
+        offset = (part_num - 1) * self.part_size
+        if data is not None:
+            chunk = data[offset : offset + self.part_size]
+        else:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                chunk = f.read(self.part_size)
+        self._request(
+            "POST",
+            self._user_url(f"items/{item_id}/addPart"),
+            data={"partNum": part_num},
+            files={"file": (os.path.basename(path), chunk)},
+        )
+        return len(chunk)
+
+    def _wait_for_commit(self, item_id, timeout_seconds=600):
+        deadline = time.monotonic() + timeout_seconds
+        while time.monotonic() < deadline:
+            status = self._request("GET", self._user_url(f"items/{item_id}/status"))
+            if status.get("status") == "completed":
+                return
+            if status.get("status") == "failed":
+                raise UploadError(f"Commit of item {item_id} failed: {status}")
+            time.sleep(2)
+        raise UploadError(f"Commit of item {item_id} did not complete in time.")
+
+    def upload(self, path, item_properties, state_path=None, data=None):
+        """Upload path as a new item (or resume its interrupted upload); returns the item ID.
+
+        With data (bytes), the upload is sent from memory under the file
+        name path; there is no state file to resume from then. The state
+        file defaults to <file name>.upload.json in the temp directory, the
+        only writable one on Lambda.
+        """
+        state_path = state_path or os.path.join(
+            tempfile.gettempdir(), f"{os.path.basename(path)}.upload.json"
+        )
+        file_size = len(data) if data is not None else os.path.getsize(path)
+        part_count = max(1, -(-file_size // self.part_size))
+        if part_count > MAX_PARTS:
+            raise UploadError(
+                f"{path} needs {part_count} parts of {self.part_size} bytes, "
+                f"more than the {MAX_PARTS} the portal accepts."
+            )
+
+        state = self._load_state(state_path, file_size) if data is None else None
+        done_parts = set()
+        if state:
+            item_id = state["item_id"]
+            try:
+                parts = self._request("GET", self._user_url(f"items/{item_id}/parts"))
+            except UploadError as e:
+                print(f"Cannot resume item {item_id} ({e}), starting over.")
+                state = None
+            else:
+                done_parts = {int(p) for p in parts.get("parts", [])}
+                print(
+                    f"Resuming upload of item {item_id}: {len(done_parts)}/{part_count} parts confirmed."
+                )
+        if not state:
+            result = self._request(
+                "POST",
+                self._user_url("addItem"),
+                data={
+                    **item_properties,
+                    "multipart": "true",
+                    "filename": os.path.basename(path),
+                },
+            )
+            item_id = result["id"]
+            if data is None:
+                with open(state_path, "w") as f:
+                    json.dump(
+                        {"item_id": item_id, "file_size": file_size, "part_size": self.part_size},
+                        f,
+                    )
+            print(f"Started multipart upload of item {item_id} in {part_count} parts.")
+
+        pending = [n for n in range(1, part_count + 1) if n not in done_parts]
+        started = time.perf_counter()
+        sent_bytes = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {
+                executor.submit(self._upload_part, item_id, path, n, data): n for n in pending
+            }
+            for future in concurrent.futures.as_completed(futures):
+                sent_bytes += future.result()
+        elapsed = time.perf_counter() - started
+
+        self._request(
+            "POST",
+            self._user_url(f"items/{item_id}/commit"),
+            data={k: v for k, v in item_properties.items() if k in ("type", "title", "tags")},
+        )
+        self._wait_for_commit(item_id)
+        if os.path.exists(state_path):
+            os.remove(state_path)
+
+        if elapsed > 0 and sent_bytes:
+            print(
+                f"Uploaded {sent_bytes / 1e6:.1f} MB in {len(pending)} parts in {elapsed:.1f} s "
+                f"({sent_bytes / 1e6 / elapsed:.1f} MB/s with {self.max_workers} connections)."
+            )
+        return item_id
@@ -0,0 +1,176 @@
+import concurrent.futures
+import os
+import time
+
+from portal_client import PortalClient, PortalError
+from run_state import StateConflict, open_state_store
+
+# ArcGIS Online's deleteItems takes a comma-separated list of item IDs
+DEFAULT_BATCH_SIZE = 100
+# Run ID of the record a sweep keeps the items it could not delete in
+SWEEP_RUN_ID = "sweep"
+
+
+class ItemCleaner(PortalClient):
+    """Permanently delete ArcGIS Online items by ID.
+
+    Items are removed in batches with deleteItems (permanentDelete=true, so
+    they skip the recycle bin), several batches at a time. IDs a batch could
+    not delete, e.g. items already sitting in the recycle bin, are purged one
+    by one with items/<id>/delete. Nothing is searched or matched by title.
+    """
+
+    def __init__(
+        self,
+        portal_url,
+        username,
+        token,
+        max_workers=4,
+        batch_size=DEFAULT_BATCH_SIZE,
+        **kwargs,
+    ):
+        super().__init__(portal_url, username, token, **kwargs)
+        self.max_workers = max_workers
+        self.batch_size = batch_size
+
+    def _delete_batch(self, item_ids):
+        """Delete a batch of items; returns the IDs the portal did not delete."""
+        result = self._request(
+            "POST",
+            self._user_url("deleteItems"),
+            data={"items": ",".join(item_ids), "permanentDelete": "true"},
+        )
+        deleted = {r["itemId"] for r in result.get("results", []) if r.get("success")}
+        return [item_id for item_id in item_ids if item_id not in deleted]
+
+    def _purge(self, item_id):
+        """Permanently delete one item, also from the recycle bin; True if it is gone."""
+        try:
+            self._request(
+                "POST",
+                self._user_url(f"items/{item_id}/delete"),
+                data={"permanentDelete": "true"},
+            )
+        except PortalError as e:
+            if "does not exist" in str(e) or "not found" in str(e).lower():
+                return True
+            print(f"Could not delete item {item_id}: {e}")
+            return False
+        return True
+
+    def delete_items(self, item_ids):
+        """Delete the items concurrently; returns the IDs that could not be deleted."""
+        item_ids = list(dict.fromkeys(item_ids))
+        if not item_ids:
+            return []
+        started = time.perf_counter()
+        batches = [
+            item_ids[i : i + self.batch_size]
+            for i in range(0, len(item_ids), self.batch_size)
+        ]
+        leftover = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._delete_batch, batch): batch for batch in batches}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    leftover.extend(future.result())
+                except PortalError as e:
+                    print(f"Bulk delete failed ({e}), deleting items one by one.")
+                    leftover.extend(futures[future])
+
+            purged = dict(zip(leftover, executor.map(self._purge, leftover)))
+        failed = [item_id for item_id, ok in purged.items() if not ok]
+        print(
+            f"Deleted {len(item_ids) - len(failed)} of {len(item_ids)} items in "
+            f"{time.perf_counter() - started:.1f} s ({len(leftover)} purged individually)."
+        )
+        return failed
+
+
+def item_ids_from_metadata(metadata):
+    """All item IDs recorded in an item metadata dict, including pending ones."""
+    item_ids = []
+    for value in metadata.values():
+        if value.get("item_id"):
+            item_ids.append(value["item_id"])
+        item_ids.extend(value.get("item_ids", []))
+    return item_ids
+
+
+def _delete_or_keep(cleaner, item_ids):
+    """delete_items that never raises: on unexpected errors all IDs stay pending."""
+    try:
+        return cleaner.delete_items(item_ids)
+    except Exception as e:
+        print(f"Error deleting previous items from ArcGIS Online: {e}")
+        return list(item_ids)
+
+
+def start_cleanup(cleaner, item_ids):
+    """Delete the items on a background thread; returns a Future of the failed IDs.
+
+    The caller must wait for the Future before its Lambda invocation
+    returns, because the execution environment is frozen afterwards.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(_delete_or_keep, cleaner, item_ids)
+    executor.shutdown(wait=False)
+    return future
+
+
+def sweep(cleaner, state_store, scope_prefix=""):
+    """Delete the items recorded in every run state record below scope_prefix.
+
+    The records of a scope are only dropped if nobody changed them
+    meanwhile (conditional write on their versions), so IDs a running
+    pipeline just recorded are never lost; a scope that changed is simply
+    swept again next time. Items that could not be deleted stay in a
+    "sweep" record of their scope. A scope with more records than fit into
+    one commit of the store is swept in part, the rest next time.
+    """
+    swept = 0
+    for scope, records in state_store.scan(scope_prefix).items():
+        if state_store.max_actions and len(records) >= state_store.max_actions:
+            # Leave room for the put of the sweep record
+            records = dict(list(records.items())[: state_store.max_actions - 1])
+        item_ids = [
+            item_id
+            for record in records.values()
+            for item_id in item_ids_from_metadata(record["items"])
+        ]
+        if not item_ids:
+            continue
+        failed = cleaner.delete_items(item_ids)
+        versions = {run_id: record["version"] for run_id, record in records.items()}
+        puts = None
+        if failed:
+            sweep_version = versions.pop(SWEEP_RUN_ID, None)
+            puts = {SWEEP_RUN_ID: ({"pending": {"item_ids": failed}}, sweep_version)}
+        try:
+            state_store.commit(scope, puts=puts, deletes=versions)
+        except StateConflict:
+            print(f"Run state of {scope} changed while sweeping, leaving it for the next sweep.")
+        swept += len(item_ids) - len(failed)
+    print(f"Sweep removed {swept} items.")
+    return swept
+
+
+def sweeper_handler(event, context):
+    """Lambda entry point for a scheduled cleanup sweep.
+
+    Expects event["cleanup_sweep"] with an optional scope prefix
+    (defaulting to CLEANUP_SCOPE_PREFIX, i.e. all scopes).
+    """
+    from arcgis.gis import GIS
+
+    import lambda_function
+
+    sweep_config = event.get("cleanup_sweep") or {}
+    scope_prefix = sweep_config.get("prefix", os.environ.get("CLEANUP_SCOPE_PREFIX", ""))
+    gis = GIS(
+        lambda_function.AGOURL,
+        lambda_function.AGOUSERNAME,
+        lambda_function.get_agol_password(),
+    )
+    swept = sweep(ItemCleaner.from_gis(gis), open_state_store(), scope_prefix)
+    return {"statusCode": 200, "body": f"Removed {swept} items."}
@@ -0,0 +1,185 @@
+"""
+Minimal local stand-in for the ArcGIS Online multipart item upload endpoints.
+
+Example:
+    python fake_portal.py --port 8765 --fail-rate 0.2
+
+Then point ChunkedUploader at http://localhost:8765 (any username and token
+are accepted). Implements addItem (multipart=true), addPart, parts, commit,
+status, items/<id>/delete and deleteItems under
+/sharing/rest/content/users/<user>/; --fail-rate makes that fraction of
+addPart and delete calls fail with HTTP 503 (or --fail-status) to exercise
+retries. Tests can also fail given parts a fixed number of times through
+FakePortal.fail_parts, e.g. {2: 1} fails the first addPart of part 2.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import uuid
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+USER_PATH = re.compile(r"^/sharing/rest/content/users/[^/]+/(?P<rest>.+)$")
+
+
+class FakePortal(ThreadingHTTPServer):
+    """Threaded HTTP server holding uploaded items in memory."""
+
+    def __init__(self, address, fail_rate=0.0, fail_status=503, fail_parts=None):
+        super().__init__(address, FakePortalHandler)
+        self.fail_rate = fail_rate
+        self.fail_status = fail_status
+        self.fail_parts = dict(fail_parts or {})
+        self.items = {}
+        self.lock = threading.Lock()
+        self.part_requests = 0
+        self.delete_requests = 0
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def item_bytes(self, item_id):
+        """Content of a committed item."""
+        return self.items[item_id]["data"]
+
+
+class FakePortalHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _form(self):
+        """Parse a urlencoded or multipart/form-data body into (fields, files)."""
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "")
+        if not content_type.startswith("multipart/form-data"):
+            fields = {k: v[0] for k, v in parse_qs(body.decode("utf-8")).items()}
+            return fields, {}
+        message = BytesParser(policy=HTTP).parsebytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode("utf-8") + body
+        )
+        fields, files = {}, {}
+        for part in message.iter_parts():
+            name = part.get_param("name", header="content-disposition")
+            if part.get_filename() is not None:
+                files[name] = part.get_payload(decode=True)
+            else:
+                fields[name] = part.get_payload(decode=True).decode("utf-8")
+        return fields, files
+
+    def _injected_delete_failure(self):
+        with self.server.lock:
+            self.server.delete_requests += 1
+        return random.random() < self.server.fail_rate
+
+    def _injected_part_failure(self, part_num):
+        with self.server.lock:
+            self.server.part_requests += 1
+            if self.server.fail_parts.get(part_num, 0) > 0:
+                self.server.fail_parts[part_num] -= 1
+                return True
+        return random.random() < self.server.fail_rate
+
+    def _route(self):
+        match = USER_PATH.match(urlparse(self.path).path)
+        return match.group("rest") if match else None
+
+    def do_GET(self):
+        rest = self._route() or ""
+        parts = re.match(r"^items/(?P<id>[^/]+)/(?P<op>parts|status)$", rest)
+        item = parts and self.server.items.get(parts.group("id"))
+        if not item:
+            return self._send({"error": {"code": 400, "message": "Item does not exist"}})
+        if parts.group("op") == "parts":
+            return self._send({"parts": sorted(item["parts"])})
+        return self._send({"status": item["status"]})
+
+    def do_POST(self):
+        rest = self._route() or ""
+        fields, files = self._form()
+        if rest == "addItem":
+            item_id = uuid.uuid4().hex
+            with self.server.lock:
+                self.server.items[item_id] = {
+                    "properties": fields,
+                    "parts": {},
+                    "status": "partial",
+                    "data": None,
+                }
+            return self._send({"success": True, "id": item_id})
+
+        if rest == "deleteItems":
+            if self._injected_delete_failure():
+                return self._send({"error": "injected failure"}, status=self.server.fail_status)
+            results = []
+            with self.server.lock:
+                for item_id in fields.get("items", "").split(","):
+                    deleted = self.server.items.pop(item_id, None) is not None
+                    results.append({"itemId": item_id, "success": deleted})
+            return self._send({"results": results})
+
+        match = re.match(r"^items/(?P<id>[^/]+)/(?P<op>addPart|commit|delete)$", rest)
+        item = match and self.server.items.get(match.group("id"))
+        if not item:
+            return self._send({"error": {"code": 400, "message": "Item does not exist"}})
+
+        if match.group("op") == "delete":
+            if self._injected_delete_failure():
+                return self._send({"error": "injected failure"}, status=self.server.fail_status)
+            with self.server.lock:
+                self.server.items.pop(match.group("id"), None)
+            return self._send({"success": True, "itemId": match.group("id")})
+
+        if match.group("op") == "addPart":
+            if self._injected_part_failure(int(fields["partNum"])):
+                return self._send({"error": "injected failure"}, status=self.server.fail_status)
+            with self.server.lock:
+                item["parts"][int(fields["partNum"])] = files["file"]
+            return self._send({"success": True})
+
+        with self.server.lock:
+            numbers = sorted(item["parts"])
+            if numbers != list(range(1, len(numbers) + 1)):
+                return self._send({"error": {"code": 400, "message": "Missing parts"}})
+            item["data"] = b"".join(item["parts"][n] for n in numbers)
+            item["status"] = "completed"
+        return self._send({"success": True, "id": match.group("id")})
+
+
+def start_fake_portal(port=0, fail_rate=0.0, fail_status=503, fail_parts=None):
+    """Start a FakePortal in a background thread and return it (call .shutdown() to stop)."""
+    server = FakePortal(
+        ("127.0.0.1", port),
+        fail_rate=fail_rate,
+        fail_status=fail_status,
+        fail_parts=fail_parts,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--fail-rate", type=float, default=0.0)
+    parser.add_argument("--fail-status", type=int, default=503)
+    args = parser.parse_args()
+    server = FakePortal(
+        ("127.0.0.1", args.port), fail_rate=args.fail_rate, fail_status=args.fail_status
+    )
+    print(f"Fake portal listening on {server.url}")
+    server.serve_forever()
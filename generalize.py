@@ -0,0 +1,204 @@
+"""
+Multi-scale generalized riverlines for publishing lighter layers.
+
+Example:
+    python generalize.py ./a_gpkg.gpkg ./a_gpkg_generalized.gpkg \
+        --netcdf ./forecast.nc
+
+For each scale band, keeps the reaches with at least the band's stream order
+and simplifies their geometry with the band's tolerance (in the units of the
+reference CRS, metres for NZGD2000 / NZTM). Each band becomes one layer,
+riverlines_<band>, of the output GeoPackage. Feature counts and geometry
+sizes are reported per band. The Lambda builds the file once and caches it on
+S3 next to the reference GeoPackage, keyed by the bands, the reference version
+and the stream orders of the forecast.
+"""
+import argparse
+import hashlib
+import json
+import os
+import tempfile
+
+import boto3
+import botocore
+import numpy as np
+import pandas as pd
+import shapely
+
+from lambda_function import (
+    REFERENCE_S3_BUCKET,
+    REFERENCE_S3_KEY,
+    REFERENCE_STORE_S3_KEY,
+    open_netcdf_dataset,
+)
+from reference_store import is_reference_store, read_reference_layer
+
+# band -> simplification tolerance and smallest stream order kept
+DEFAULT_SCALE_BANDS = {
+    "national": {"tolerance": 250.0, "min_streamorder": 5},
+    "regional": {"tolerance": 50.0, "min_streamorder": 3},
+}
+REFERENCE_LAYER = "rec1_Riverlines_SimplifyLine"
+REFERENCE_KEY = "Top_reach"
+
+
+def scale_bands():
+    """Scale bands from GENERALIZED_SCALE_BANDS (JSON), or the defaults."""
+    if os.environ.get("GENERALIZED_SCALE_BANDS"):
+        return json.loads(os.environ["GENERALIZED_SCALE_BANDS"])
+    return DEFAULT_SCALE_BANDS
+
+
+def generalized_layer_name(band):
+    return f"riverlines_{band}"
+
+
+def streamorder_from_netcdf(s3_path):
+    """Series of stream order indexed by rchid, from a NetCDF forecast file."""
+    dataset = open_netcdf_dataset(s3_path)
+    try:
+        rchid = np.ma.getdata(dataset.variables["rchid"][:])
+        streamorder = np.ma.getdata(dataset.variables["streamorder"][:])
+    finally:
+        dataset.close()
+    return pd.Series(streamorder, index=rchid)
+
+
+def streamorder_digest(streamorder):
+    """Hash of the rchid and stream order arrays, to tell forecasts' reach sets apart."""
+    digest = hashlib.sha1(np.ascontiguousarray(streamorder.index.values).tobytes())
+    digest.update(np.ascontiguousarray(streamorder.values).tobytes())
+    return digest.hexdigest()
+
+
+def _geometry_summary(geometries):
+    """(features, vertices, WKB bytes) of a GeoSeries."""
+    values = geometries.values
+    return (
+        len(values),
+        int(shapely.get_num_coordinates(values).sum()),
+        int(sum(len(wkb) for wkb in shapely.to_wkb(values) if wkb is not None)),
+    )
+
+
+def build_generalized_riverlines(
+    reference_path, output_path, streamorder, bands=None, layer=REFERENCE_LAYER
+):
+    """Write one simplified, stream-order-filtered riverlines layer per scale band.
+
+    streamorder maps the reference's Top_reach to stream order; reaches
+    without one are left out. reference_path may also be a reference store.
+    Returns {band: report dict}.
+    """
+    bands = bands or scale_bands()
+    riverlines = read_reference_layer(reference_path, layer)
+    orders = riverlines[REFERENCE_KEY].map(streamorder)
+    features, vertices, size = _geometry_summary(riverlines.geometry)
+    print(
+        f"Reference layer {layer}: {features} features, {vertices} vertices, "
+        f"{size / 1e6:.1f} MB of geometry"
+    )
+
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    reports = {}
+    for band, config in bands.items():
+        subset = riverlines[orders >= config["min_streamorder"]].copy()
+        subset["geometry"] = subset.geometry.simplify(
+            config["tolerance"], preserve_topology=True
+        )
+        subset.to_file(output_path, layer=generalized_layer_name(band), driver="GPKG")
+
+        band_features, band_vertices, band_size = _geometry_summary(subset.geometry)
+        reports[band] = {
+            "features": band_features,
+            "vertices": band_vertices,
+            "geometry_bytes": band_size,
+        }
+        print(
+            f"Band {band} (streamorder >= {config['min_streamorder']}, tolerance "
+            f"{config['tolerance']}): {band_features}/{features} features "
+            f"({band_features / max(features, 1):.1%}), {band_vertices}/{vertices} vertices, "
+            f"{band_size / 1e6:.2f}/{size / 1e6:.2f} MB of geometry "
+            f"({band_size / max(size, 1):.1%})"
+        )
+    print(
+        f"Generalized riverlines written to {output_path} "
+        f"({os.path.getsize(output_path) / 1e6:.1f} MB)"
+    )
+    return reports
+
+
+def cache_key(bands, reference_etag, streamorder_hash):
+    """S3 key of the cached generalized GeoPackage for bands, reference version and stream orders."""
+    digest = hashlib.sha1(
+        json.dumps([bands, reference_etag, streamorder_hash], sort_keys=True).encode(
+            "utf-8"
+        )
+    ).hexdigest()
+    stem = os.path.splitext(REFERENCE_S3_KEY)[0]
+    return f"{stem}_generalized_{digest[:8]}.gpkg"
+
+
+def get_generalized_reference(reference_local_path, s3_path, bands=None):
+    """Local path of the generalized riverlines, from /tmp, the S3 cache or built now.
+
+    A freshly built file is uploaded next to the reference GeoPackage, so
+    only the first run after a change of the bands, the reference or the
+    stream orders pays for it. Stream orders are read from the NetCDF file
+    at s3_path. The reference version is the ETag of the reference store
+    when reference_local_path is one, else of the reference GeoPackage.
+    """
+    bands = bands or scale_bands()
+    s3_client = boto3.client("s3")
+    reference_key = (
+        REFERENCE_STORE_S3_KEY
+        if REFERENCE_STORE_S3_KEY and is_reference_store(reference_local_path)
+        else REFERENCE_S3_KEY
+    )
+    reference_etag = s3_client.head_object(Bucket=REFERENCE_S3_BUCKET, Key=reference_key)[
+        "ETag"
+    ]
+    streamorder = streamorder_from_netcdf(s3_path)
+    key = cache_key(bands, reference_etag, streamorder_digest(streamorder))
+    local_path = os.path.join(tempfile.gettempdir(), os.path.basename(key))
+    if os.path.exists(local_path):
+        return local_path
+
+    try:
+        s3_client.download_file(REFERENCE_S3_BUCKET, key, local_path)
+        print(f"Generalized riverlines retrieved from s3://{REFERENCE_S3_BUCKET}/{key}")
+        return local_path
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code", "") not in ("404", "NoSuchKey"):
+            raise
+
+    print("No cached generalized riverlines, building them...")
+    build_generalized_riverlines(reference_local_path, local_path, streamorder, bands)
+    s3_client.upload_file(local_path, REFERENCE_S3_BUCKET, key)
+    print(f"Generalized riverlines cached at s3://{REFERENCE_S3_BUCKET}/{key}")
+    return local_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Build generalized riverlines per scale band from the reference GeoPackage."
+    )
+    parser.add_argument("reference", help="Reference riverlines GeoPackage")
+    parser.add_argument("output", help="Output GeoPackage")
+    parser.add_argument(
+        "--netcdf", required=True, help="NetCDF forecast file providing the stream orders"
+    )
+    parser.add_argument(
+        "--bands",
+        help="Scale bands as JSON (default: GENERALIZED_SCALE_BANDS or the built-in bands)",
+    )
+    args = parser.parse_args(argv)
+    bands = json.loads(args.bands) if args.bands else scale_bands()
+    build_generalized_riverlines(
+        args.reference, args.output, streamorder_from_netcdf(args.netcdf), bands
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import contextlib
+import io
+import os
+import sqlite3
+import tempfile
+import time
+
+import pyogrio
+import shapely
+
+# Bytes per cell assumed for non-geometry columns when estimating the size
+_ESTIMATED_BYTES_PER_VALUE = 12
+# GeoPackage page, index and metadata overhead on top of the raw data
+_ESTIMATED_OVERHEAD = 1.3
+# Join keys of the pipeline's layers, indexed where a layer has them
+DEFAULT_INDEX_COLUMNS = "rchid,Top_reach,nrch"
+
+
+def memory_budget_bytes():
+    """Largest GeoPackage built in memory, from GEOPACKAGE_MEMORY_BUDGET_MB (0 disables)."""
+    return int(float(os.environ.get("GEOPACKAGE_MEMORY_BUDGET_MB", "0")) * 1e6)
+
+
+def declared_index_columns():
+    """Key columns to index, from GEOPACKAGE_INDEX_COLUMNS (comma-separated, empty disables)."""
+    value = os.environ.get("GEOPACKAGE_INDEX_COLUMNS", DEFAULT_INDEX_COLUMNS)
+    return [column.strip() for column in value.split(",") if column.strip()]
+
+
+def spatial_index_options(spatial_index):
+    """GPKG layer creation option building (or skipping) the R-tree spatial index."""
+    return {"SPATIAL_INDEX": "YES" if spatial_index else "NO"}
+
+
+def create_attribute_indexes(conn, layer, columns):
+    """Index the given columns of a GeoPackage layer that it has; returns the indexed columns."""
+    existing = {row[1] for row in conn.execute(f'PRAGMA table_info("{layer}")')}
+    indexed = [column for column in columns if column in existing]
+    for column in indexed:
+        conn.execute(
+            f'CREATE INDEX IF NOT EXISTS "idx_{layer}_{column}" ON "{layer}" ("{column}")'
+        )
+    conn.commit()
+    return indexed
+
+
+def index_geopackage_file(path, layer, columns=None):
+    """Add the attribute indexes to a GeoPackage file; returns the indexed columns."""
+    columns = declared_index_columns() if columns is None else columns
+    if not columns:
+        return []
+    with contextlib.closing(sqlite3.connect(path)) as conn:
+        return create_attribute_indexes(conn, layer, columns)
+
+
+def estimate_geopackage_size(gdf):
+    """Rough size in bytes of a GeoDataFrame written as a GeoPackage layer."""
+    # WKB is 16 bytes per XY vertex plus a small per-feature header
+    geometry_bytes = 16 * int(shapely.get_num_coordinates(gdf.geometry.values).sum())
+    geometry_bytes += 40 * len(gdf)
+    value_bytes = len(gdf) * (len(gdf.columns) - 1) * _ESTIMATED_BYTES_PER_VALUE
+    return int((geometry_bytes + value_bytes) * _ESTIMATED_OVERHEAD)
+
+
+class GeoPackageOutput:
+    """A GeoPackage held in memory (data) or, above the memory budget, on disk (path).
+
+    name is the file name it is published and uploaded under.
+    """
+
+    def __init__(self, name, data=None, path=None):
+        self.name = name
+        self.data = data
+        self.path = path
+
+    @property
+    def in_memory(self):
+        return self.data is not None
+
+    @property
+    def size(self):
+        return len(self.data) if self.in_memory else os.path.getsize(self.path)
+
+    @classmethod
+    def from_frame(
+        cls,
+        gdf,
+        name,
+        layer,
+        memory_budget=None,
+        output_dir=None,
+        spatial_index=True,
+        index_columns=None,
+    ):
+        """Write gdf as a one-layer GeoPackage, in memory if it fits the budget.
+
+        The layer is written through GDAL's in-memory file system, so nothing
+        touches /tmp. GeoPackages estimated (or found) to be larger than
+        memory_budget bytes are written to output_dir instead.
+        spatial_index=False skips the R-tree, e.g. for intermediate files or
+        published layers with the compact upload optimization; index_columns
+        (default GEOPACKAGE_INDEX_COLUMNS) get attribute indexes.
+        """
+        memory_budget = memory_budget_bytes() if memory_budget is None else memory_budget
+        output_dir = output_dir or tempfile.gettempdir()
+        options = spatial_index_options(spatial_index)
+        started = time.perf_counter()
+        if memory_budget > 0 and estimate_geopackage_size(gdf) <= memory_budget:
+            buffer = io.BytesIO()
+            pyogrio.write_dataframe(gdf, buffer, layer=layer, driver="GPKG", **options)
+            output = cls(name, data=buffer.getvalue())
+            output.create_indexes(layer, index_columns)
+            if output.size <= memory_budget:
+                print(
+                    f"GeoPackage {name} built in memory ({output.size / 1e6:.1f} MB) "
+                    f"in {time.perf_counter() - started:.2f} s."
+                )
+                return output
+            print(f"GeoPackage {name} is over the memory budget, moving it to disk.")
+            return output.spill(output_dir)
+
+        path = os.path.join(output_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+        pyogrio.write_dataframe(gdf, path, layer=layer, driver="GPKG", **options)
+        index_geopackage_file(path, layer, index_columns)
+        print(
+            f"GeoPackage {name} written to {path} ({os.path.getsize(path) / 1e6:.1f} MB) "
+            f"in {time.perf_counter() - started:.2f} s."
+        )
+        return cls(name, path=path)
+
+    @classmethod
+    def from_s3(cls, s3_client, bucket, key, memory_budget=None, output_dir=None):
+        """Download a GeoPackage from S3, into memory if it fits the budget."""
+        memory_budget = memory_budget_bytes() if memory_budget is None else memory_budget
+        name = os.path.basename(key)
+        size = s3_client.head_object(Bucket=bucket, Key=key)["ContentLength"]
+        if memory_budget > 0 and size <= memory_budget:
+            buffer = io.BytesIO()
+            s3_client.download_fileobj(bucket, key, buffer)
+            return cls(name, data=buffer.getvalue())
+        path = os.path.join(output_dir or tempfile.gettempdir(), name)
+        s3_client.download_file(bucket, key, path)
+        return cls(name, path=path)
+
+    def spill(self, output_dir=None):
+        """Move an in-memory GeoPackage to disk; returns self."""
+        if self.in_memory:
+            self.path = os.path.join(output_dir or tempfile.gettempdir(), self.name)
+            with open(self.path, "wb") as f:
+                f.write(self.data)
+            self.data = None
+        return self
+
+    def source(self):
+        """Something pyogrio/geopandas can read: the bytes or the path."""
+        return io.BytesIO(self.data) if self.in_memory else self.path
+
+    def connect(self):
+        """sqlite3 connection to the GeoPackage (an in-memory copy for in-memory data)."""
+        if not self.in_memory:
+            return sqlite3.connect(self.path)
+        conn = sqlite3.connect(":memory:")
+        conn.deserialize(self.data)
+        return conn
+
+    def create_indexes(self, layer, columns=None):
+        """Add the attribute indexes to the layer; returns the indexed columns."""
+        columns = declared_index_columns() if columns is None else columns
+        if not columns:
+            return []
+        if not self.in_memory:
+            return index_geopackage_file(self.path, layer, columns)
+        with contextlib.closing(self.connect()) as conn:
+            indexed = create_attribute_indexes(conn, layer, columns)
+            if indexed:
+                self.data = conn.serialize()
+        return indexed
+
+    def vacuum(self):
+        """Rebuild the GeoPackage without free pages; returns its new size."""
+        if not self.in_memory:
+            with contextlib.closing(sqlite3.connect(self.path)) as conn:
+                conn.execute("VACUUM")
+            return self.size
+        with contextlib.closing(self.connect()) as conn:
+            conn.execute("VACUUM")
+            self.data = conn.serialize()
+        return self.size
+
+    def upload_to_s3(self, s3_client, bucket, key):
+        if self.in_memory:
+            s3_client.upload_fileobj(io.BytesIO(self.data), bucket, key)
+        else:
+            s3_client.upload_file(self.path, bucket, key)
+
+    def remove(self):
+        """Free the memory or delete the file."""
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+        self.data = None
+
+
+def as_geopackage_output(output):
+    """Wrap a plain GeoPackage path as a GeoPackageOutput."""
+    if isinstance(output, GeoPackageOutput):
+        return output
+    return GeoPackageOutput(os.path.basename(output), path=output)
@@ -2,34 +2,180 @@ import concurrent.futures
 import json
 import logging
 import os
-import uuid  # For generating unique filenames
 from datetime import datetime as dt
 
 import boto3
 import geopandas as gpd
+import numpy as np
 import pandas as pd
 import s3fs
-from arcgis.features import FeatureLayer, FeatureLayerCollection
-from arcgis.gis import GIS
-from arcgis.layers import Service
 from netCDF4 import Dataset, num2date
 from shapely.geometry import Point
 import sqlite3
 import tempfile
-
-HOSTED_FEATURE_LAYER_URL = os.environ["HOSTED_FEATURE_LAYER_URL"]
-SECOND_FEATURE_LAYER_URL = os.environ["SECOND_FEATURE_LAYER_URL"]
+import time
+
+from chunked_upload import ChunkedUploader
+from cleanup import ItemCleaner, item_ids_from_metadata, start_cleanup
+from gpkg_memory import (
+    GeoPackageOutput,
+    as_geopackage_output,
+    index_geopackage_file,
+    memory_budget_bytes,
+    spatial_index_options,
+)
+from netcdf_decode import decode_cf_times, decode_variables_parallel, localize_netcdf
+from reference_store import is_reference_store, read_reference_layer
+from run_state import import_legacy_s3_record, open_state_store
+from stages import StagePipeline
+from upload_payload import (
+    UploadReport,
+    append_wait_seconds,
+    optimize_upload_payload,
+    published_index_options,
+    remove_payload,
+)
+from zarr_reader import is_zarr_path
+
+# Read with .get so the transform stages can be imported (e.g. by backfill.py)
+# without the ArcGIS configuration; lambda_handler still needs all of them.
+HOSTED_FEATURE_LAYER_URL = os.environ.get("HOSTED_FEATURE_LAYER_URL")
+SECOND_FEATURE_LAYER_URL = os.environ.get("SECOND_FEATURE_LAYER_URL")
 # Get the password from environment variables
-MyPASSWORD = os.environ["AGOPASSWORD"]
-AGOURL = os.environ["AGOURL"]
-AGOUSERNAME = os.environ["AGOUSERNAME"]
+MyPASSWORD = os.environ.get("AGOPASSWORD")
+AGOURL = os.environ.get("AGOURL")
+AGOUSERNAME = os.environ.get("AGOUSERNAME")
+# Optional hosted layers for the generalized second output, {scale band: layer URL}
+GENERALIZED_LAYER_URLS = json.loads(os.environ.get("GENERALIZED_LAYER_URLS", "{}"))
 
 s3_client = boto3.client("s3")
-# Try to get the password from AWS SSM Parameter Store
 
-ssm_client = boto3.client("ssm")
-response = ssm_client.get_parameter(Name=MyPASSWORD, WithDecryption=True)
-AGOPASSWORD = response["Parameter"]["Value"]
+# Variables read by decode_netcdf_file
+TIME_DEPENDENT_VARIABLES = [
+    "absoluteValues",
+    "relativeValues",
+    "absoluteValues25thPercentile",
+    "absoluteValues5thPercentile",
+    "absoluteValues75thPercentile",
+    "absoluteValues95thPercentile",
+    "absoluteValuesMedian",
+    "relativeValues25thPercentile",
+    "relativeValues5thPercentile",
+    "relativeValues75thPercentile",
+    "relativeValues95thPercentile",
+    "relativeValuesMedian",
+]
+THRESHOLD_VARIABLES = [
+    "relative_thresholds_10yr",
+    "relative_thresholds_20yr",
+    "relative_thresholds_2yr",
+    "relative_thresholds_5yr",
+]
+
+# Identifier variables, decoded for every output and never checked against
+# the sentinel values by default
+IDENTIFIER_VARIABLES = ["rchid", "streamorder"]
+
+# Per-reach statistics reduce_reach_statistics computes
+REACH_STATISTICS = ("max", "mean", "argmax_time", "exceedance_count")
+
+
+def parse_reach_statistics(spec):
+    """Parse "max, mean" (or a list of names) into ["max", "mean"].
+
+    Raises ValueError for statistics reduce_reach_statistics does not support.
+    """
+    if isinstance(spec, str):
+        spec = spec.split(",")
+    statistics = [name.strip() for name in spec if name.strip()]
+    unsupported = [name for name in statistics if name not in REACH_STATISTICS]
+    if unsupported:
+        raise ValueError(
+            f"Unsupported reach statistics {', '.join(unsupported)}; "
+            f"choose from {', '.join(REACH_STATISTICS)}."
+        )
+    return statistics
+
+
+# Declarative schema of the published layers: per output, the NetCDF
+# variables it needs, the per-reach statistics ("second" only), the decimals
+# each variable's columns are rounded to and output column renames
+# ({column: new name}). Only the variables some output needs are decoded, so
+# publishing another variable is a configuration change. The OUTPUT_SCHEMA
+# environment variable (JSON) overrides these keys per output.
+DEFAULT_OUTPUT_SCHEMA = {
+    "first": {
+        "variables": TIME_DEPENDENT_VARIABLES + THRESHOLD_VARIABLES,
+        "round": {var: 2 for var in TIME_DEPENDENT_VARIABLES},
+        "columns": {},
+    },
+    "second": {
+        "variables": ["relativeValues95thPercentile"],
+        "statistics": parse_reach_statistics(os.environ.get("REACH_STATISTICS", "max")),
+        "round": {"relativeValues95thPercentile": 2},
+        "columns": {},
+    },
+}
+OUTPUT_SCHEMA = {
+    output: {**layer, **json.loads(os.environ.get("OUTPUT_SCHEMA", "{}")).get(output, {})}
+    for output, layer in DEFAULT_OUTPUT_SCHEMA.items()
+}
+OUTPUT_SCHEMA["second"]["statistics"] = parse_reach_statistics(
+    OUTPUT_SCHEMA["second"].get("statistics", ["max"])
+)
+
+# Layer name of the joined long-format data in the first GeoPackage
+RAW_LAYER_NAME = "joined_raw_riverlines"
+
+# Reference riverlines GeoPackage the model output is joined onto
+REFERENCE_S3_BUCKET = "s3-lambda-stack-prd-input-bucket-prod"  # Static bucket name from test event
+REFERENCE_S3_KEY = "REC1_Geopackage/a_gpkg.gpkg"
+# Reference store built from the GeoPackage with reference_store.py; when
+# set, it is downloaded and joined instead of the GeoPackage
+REFERENCE_STORE_S3_KEY = os.environ.get("REFERENCE_STORE_S3_KEY")
+
+# Declared dtypes of the long-format frame built by flatten_decoded_netcdf. Time
+# is categorical (one entry per time step instead of per row) and values are
+# float32, which is all the precision the NetCDF file stores them with.
+LONG_FRAME_SCHEMA = {
+    "time_stamp_date": "category",
+    "nrch": "int32",
+    "rchid": "int32",
+    "streamorder": "int8",
+    **{var.lower(): "float32" for var in TIME_DEPENDENT_VARIABLES},
+    **{var: "float32" for var in THRESHOLD_VARIABLES},
+}
+# Per-reach aggregates use the same dtypes, except that time stays datetime64
+AGGREGATED_FRAME_SCHEMA = {
+    column: dtype
+    for column, dtype in LONG_FRAME_SCHEMA.items()
+    if column != "time_stamp_date"
+}
+
+# Schemas of the frames stored as "raw" and "aggregated" SQLite tables
+FRAME_SCHEMAS = {"raw": LONG_FRAME_SCHEMA, "aggregated": AGGREGATED_FRAME_SCHEMA}
+# SQLite table holding the dtypes of those columns as they were written
+FRAME_DTYPES_TABLE = "frame_dtypes"
+
+# Values the upstream model writes for missing or invalid data, per variable
+# ("default" applies to every value and threshold variable not listed). Can be
+# overridden with a JSON object in the SENTINEL_VALUES environment variable.
+SENTINEL_VALUES = json.loads(
+    os.environ.get("SENTINEL_VALUES", '{"default": [-888, 888, 999]}')
+)
+
+_agol_password = None
+
+
+def get_agol_password():
+    """Get the ArcGIS Online password from AWS SSM Parameter Store (cached per container)."""
+    global _agol_password
+    if _agol_password is None:
+        ssm_client = boto3.client("ssm")
+        response = ssm_client.get_parameter(Name=MyPASSWORD, WithDecryption=True)
+        _agol_password = response["Parameter"]["Value"]
+    return _agol_password
+
 
 def convert_to_datetime(cftime_obj):
     """Convert a cftime or datetime object to a standard datetime object."""
@@ -49,85 +195,59 @@ def convert_to_datetime(cftime_obj):
         raise
 
 
-def process_time_step(
-    time,
-    data,
-    nrch,
-    rchid,
-    streamorder,
-    absolute_values,
-    absolute_values_25th,
-    absolute_values_5th,
-    absolute_values_75th,
-    absolute_values_95th,
-    absolute_values_median,
-    relative_thresholds_10yr,
-    relative_thresholds_20yr,
-    relative_thresholds_2yr,
-    relative_thresholds_5yr,
-    relative_values,
-    relative_values_25th,
-    relative_values_5th,
-    relative_values_75th,
-    relative_values_95th,
-    relative_values_median,
-):
-    """Process a single time step and return rows for the DataFrame."""
-    rows = []
-    for j in range(len(rchid)):
-        row = {
-            "time_stamp_date": time,  # Keep as a datetime object
-            "nrch": (
-                nrch[j] if isinstance(nrch, list) else nrch
-            ),  # Ensure nrch is included
-            "rchid": int(rchid[j]),
-            "streamorder": int(streamorder[j]),
-            "absolutevalues": float(absolute_values[j]),
-            "absolutevalues25thpercentile": float(absolute_values_25th[j]),
-            "absolutevalues5thpercentile": float(absolute_values_5th[j]),
-            "absolutevalues75thpercentile": float(absolute_values_75th[j]),
-            "absolutevalues95thpercentile": float(absolute_values_95th[j]),
-            "absolutevaluesmedian": float(absolute_values_median[j]),
-            "relativevalues": float(relative_values[j]),
-            "relativevalues25thpercentile": float(relative_values_25th[j]),
-            "relativevalues5thpercentile": float(relative_values_5th[j]),
-            "relativevalues75thpercentile": float(relative_values_75th[j]),
-            "relativevalues95thpercentile": float(relative_values_95th[j]),
-            "relativevaluesmedian": float(relative_values_median[j]),
-            "relative_thresholds_10yr": float(relative_thresholds_10yr[j]),
-            "relative_thresholds_20yr": float(relative_thresholds_20yr[j]),
-            "relative_thresholds_2yr": float(relative_thresholds_2yr[j]),
-            "relative_thresholds_5yr": float(relative_thresholds_5yr[j]),
-        }
-        rows.append(row)
-    return rows
-
+def add_geopackage_item(gis, geopackage_path):
+    """Upload a GeoPackage as a temporary ArcGIS Online item and return the item.
 
-def upload_geopackage_to_arcgis(
-    gis, geopackage_path, s3_bucket, s3_key, feature_layer, overwrite=True
-):
-    """Upload a GeoPackage to ArcGIS Online and update the hosted feature layer."""
+    GeoPackages larger than CHUNKED_UPLOAD_THRESHOLD_MB, and GeoPackages
+    built in memory, are sent as a multipart upload with parallel parts (see
+    chunked_upload.py).
+    """
+    geopackage = as_geopackage_output(geopackage_path)
+    item_properties = {
+        "title": geopackage.name,
+        "type": "GeoPackage",
+        "tags": "data upload, automation",
+        "description": "Temporary GeoPackage file for updating a hosted feature layer.",
+    }
+    threshold_mb = float(os.environ.get("CHUNKED_UPLOAD_THRESHOLD_MB", "100"))
     try:
         print("Uploading GeoPackage to ArcGIS Online...")
-        root_folder = gis.content.folders.get()
-        # geopackage_item = gis.content.add(
-        geopackage_item = root_folder.add(
-            {
-                "title": geopackage_path.split("/")[-1],
-                "type": "GeoPackage",
-                "tags": "data upload, automation",
-                "description": "Temporary GeoPackage file for updating a hosted feature layer.",
-            },
-            file=geopackage_path,
-        ).result()
+        if geopackage.in_memory or geopackage.size > threshold_mb * 1e6:
+            uploader = ChunkedUploader.from_gis(
+                gis, max_workers=int(os.environ.get("CHUNKED_UPLOAD_WORKERS", "4"))
+            )
+            geopackage_item = gis.content.get(
+                uploader.upload(
+                    geopackage.path or geopackage.name, item_properties, data=geopackage.data
+                )
+            )
+        else:
+            root_folder = gis.content.folders.get()
+            # geopackage_item = gis.content.add(
+            geopackage_item = root_folder.add(
+                item_properties,
+                file=geopackage.path,
+            ).result()
         print(f"GeoPackage uploaded successfully. Item ID: {geopackage_item.id}")
     except Exception as e:
         print(f"Error during GeoPackage upload and update: {e}")
         raise
 
+    return geopackage_item
+
+
+def upload_geopackage_to_arcgis(
+    gis, geopackage_path, s3_bucket, s3_key, feature_layer, overwrite=True, on_append=None
+):
+    """Upload a GeoPackage to ArcGIS Online and update the hosted feature layer.
+
+    on_append is called with the result of the append (a Future with
+    future=True) or overwrite, e.g. to time the job.
+    """
+    geopackage_item = add_geopackage_item(gis, geopackage_path)
+
     try:
         print("Updating the hosted feature layer...")
-        print(f"GeoPackage uploaded successfully. Item ID: {geopackage_item.id}")
 
         # Step 4: Append or Overwrite Data in the Feature Layer
         print("Updating the hosted feature layer...")
@@ -142,6 +262,8 @@ def upload_geopackage_to_arcgis(
                 upsert=False,  # Set to True if you want to update existing records
                 future=True,  # Set to True if you want to use the asynchronous process
             )
+        if on_append is not None:
+            on_append(result)
 
         if result:
             print("Data being updated in the feature layer.")
@@ -155,131 +277,65 @@ def upload_geopackage_to_arcgis(
     return geopackage_item
 
 
-# Permanently delete an item from ArcGIS Online
-def delete_item_permanently(item, gis):
-    try:
-        org_user = gis.users.search(AGOUSERNAME)[0]
-        for r_item in org_user.recyclebin.content:
-            print(
-                f"{r_item.properties['title']:15} {r_item.properties['type']:22}{type(r_item)}"
-            )
-            if r_item.properties["title"].startswith(f"{item.title}"):
-                # if (r_item.properties['type']:22) == "Map Service":
-                r_item.delete()
-                print(f"Item deleted from recycle bin: {r_item.properties['title']}")
-                logging.info(
-                    f"Item deleted from recycle bin: {r_item.properties['title']}"
-                )
-
-    except Exception as e:
-        print(f"Failed to delete item {item.title} permanently: {e}")
-
-
-# Delete the previous temporary GeoPackage item from ArcGIS Online
-def delete_previous_item_from_agol(gis, s3_bucket, s3_key):
-    """Delete the previous temporary GeoPackage item from ArcGIS Online."""
-    import json
-
-    import boto3
-
-    s3_client = boto3.client("s3")
+# Delete the previous temporary GeoPackage items from ArcGIS Online
+def start_previous_items_cleanup(gis, state_store, scope, run_id, legacy_bucket=None):
+    """Start deleting the temporary items recorded by earlier runs of scope.
 
+    Returns (consumed, cleanup): the {run_id: version} of the run state
+    records read, and a Future of the item IDs that are still left to
+    delete. By default (CLEANUP_MODE=background) the items are deleted on a
+    background thread while the run goes on; CLEANUP_MODE=inline waits for
+    them, and CLEANUP_MODE=sweeper leaves them all to
+    cleanup.sweeper_handler. With legacy_bucket, the scope's
+    item_metadata.json an earlier version left there is imported first.
+    """
+    mode = os.environ.get("CLEANUP_MODE", "background")
     try:
-        # Download the metadata file from S3
-        s3_metadata_key = f"{s3_key}/item_metadata.json"
-        metadata_file = os.path.join(tempfile.gettempdir(), "item_metadata.json")
-        print(f"Downloading metadata file from S3: {s3_metadata_key}")
-        s3_client.download_file(s3_bucket, s3_metadata_key, metadata_file)
-
-        # Parse the metadata file
-        with open(metadata_file, "r") as f:
-            metadata = json.load(f)
-
-        # Iterate over the metadata entries
-        for key, value in metadata.items():
-            item_id = value.get("item_id")
-            if not item_id:
-                print(
-                    f"No item ID found for {key} in metadata file. Skipping deletion."
-                )
-                continue
-
-            # Delete the item from ArcGIS Online
-            print(f"Deleting item from ArcGIS Online: {item_id.title}")
-            # item_to_delete = gis.content.search(query=f"title:{item_id.title}")
-            item_to_delete = gis.content.get(item_id)
-            print(f"Deleting item from ArcGIS Online: {item_to_delete.title}")
-
-            if item_to_delete:
-                item_to_delete.delete()
-                print("Item deleted successfully.")
-                try:
-                    # Also delete item from the recycle bin
-                    delete_item_permanently(item_to_delete, gis)
-                except Exception as e:
-                    print(f"Failure when trying to delete permanently: {e}")
-
-            else:
-                print("Item not found in ArcGIS Online.")
-            
-
-        # Delete the metadata file from S3
-        print(f"Deleting metadata file from S3: {s3_metadata_key}")
-        s3_client.delete_object(Bucket=s3_bucket, Key=s3_metadata_key)
-        print("Metadata file deleted from S3 successfully.")
-
+        if legacy_bucket:
+            # Also in sweeper mode, so that the sweep finds the imported items
+            records = import_legacy_s3_record(
+                state_store, scope, legacy_bucket, f"{scope}/item_metadata.json", json.loads
+            )
+        else:
+            records = {} if mode == "sweeper" else state_store.load(scope)
     except Exception as e:
-        print(f"Error deleting previous items from ArcGIS Online: {e}")
-
-
-
-
-def aggregate_table(data, group_by_column, column_filter):
-    """Aggregate data by a specific column and calculate maximum values for filtered columns."""
-    # Identify columns of interest based on the filter
-    columns_of_interest = [col for col in data.columns if column_filter in col.lower()]
-
-    # Ensure 'time_stamp_date' is included in the aggregation
-    if "time_stamp_date" in data.columns:
-        columns_of_interest.append("time_stamp_date")
-
-    # Perform aggregation: calculate the maximum for each group
-    aggregated_data = data.groupby(group_by_column, as_index=False)[
-        columns_of_interest
-    ].max()
-
-    return aggregated_data
-
+        print(f"Error reading the run state of {scope}: {e}")
+        records = {}
+    if mode == "sweeper":
+        records = {}
+    records.pop(run_id, None)
+    item_ids = [
+        item_id
+        for record in records.values()
+        for item_id in item_ids_from_metadata(record["items"])
+    ]
+    consumed = {other: record["version"] for other, record in records.items()}
+    print(f"{len(item_ids)} previous temporary items to delete (cleanup mode: {mode}).")
 
-def clean_and_filter_data(data, invalid_values, datetime_column):
-    """Clean and filter data by removing invalid values and ensuring datetime format."""
-    data[datetime_column] = pd.to_datetime(data[datetime_column], errors="coerce")
-    data = data.dropna(subset=[datetime_column])
-    return data[~data.isin(invalid_values).any(axis=1)]
+    if not item_ids:
+        cleanup = concurrent.futures.Future()
+        cleanup.set_result(item_ids)
+        return consumed, cleanup
+    cleanup = start_cleanup(ItemCleaner.from_gis(gis), item_ids)
+    if mode == "inline":
+        cleanup.result()
+    return consumed, cleanup
 
 
-def join_geopackage_tables(geopackage_path, layer_a, layer_b, join_key_a, join_key_b):
-    """Perform a join between two layers in a GeoPackage."""
-    # Ensure layer_b is a valid string or integer
-    if not isinstance(layer_b, (str, int)):
-        raise ValueError(
-            f"Invalid layer_b: {layer_b}. It must be a string or integer representing a layer name or index."
-        )
+def finish_cleanup(cleanup, checkpoint):
+    """Wait for the cleanup of previous items.
 
-    data_a = gpd.read_file(geopackage_path, layer=layer_a)
-    data_b = gpd.read_file(geopackage_path, layer=layer_b)
-    joined_data = data_a.merge(
-        data_b, left_on=join_key_a, right_on=join_key_b, how="inner"
-    )
-    return joined_data
+    Returns {"consumed": ..., "pending": ...}: the run state records read
+    and the item IDs the cleanup left over.
+    """
+    if not checkpoint.is_done("cleanup"):
+        consumed, future = cleanup
+        checkpoint.mark_done("cleanup", {"consumed": consumed, "pending": future.result()})
+    return checkpoint.result("cleanup")
 
 
-def write_dataframe_to_geopackage(
-    df, geopackage_path, table_name, add_dummy_geometry=True, overwrite=True
-):
-    """Write a DataFrame to a GeoPackage table, ensuring the geometry column is named 'SHAPE'.
-    If overwrite is True, the GeoPackage file is deleted if it exists. If False, the new layer is appended.
-    """
+def prepare_geodataframe(df, add_dummy_geometry=True):
+    """Return df as a GeoDataFrame with a single geometry column named 'SHAPE'."""
     from shapely.geometry import Point
 
     # Ensure the input is a GeoDataFrame
@@ -316,6 +372,23 @@ def write_dataframe_to_geopackage(
     if df.geometry.name != "SHAPE":
         print("Renaming geometry column to 'SHAPE'...")
         df = df.rename_geometry("SHAPE")
+    return df
+
+
+def write_dataframe_to_geopackage(
+    df,
+    geopackage_path,
+    table_name,
+    add_dummy_geometry=True,
+    overwrite=True,
+    spatial_index=True,
+    index_columns=None,
+):
+    """Write a DataFrame to a GeoPackage table, ensuring the geometry column is named 'SHAPE'.
+    If overwrite is True, the GeoPackage file is deleted if it exists. If False, the new layer is appended.
+    The index_columns (default GEOPACKAGE_INDEX_COLUMNS) are indexed; spatial_index=False skips the R-tree.
+    """
+    df = prepare_geodataframe(df, add_dummy_geometry)
 
     # Only delete the GeoPackage if overwrite is True
     if overwrite and os.path.exists(geopackage_path):
@@ -324,16 +397,129 @@ def write_dataframe_to_geopackage(
 
     # Write the GeoDataFrame to the GeoPackage (append if file exists and overwrite is False)
     mode = "w" if overwrite or not os.path.exists(geopackage_path) else "a"
-    df.to_file(geopackage_path, layer=table_name, driver="GPKG")
+    df.to_file(
+        geopackage_path,
+        layer=table_name,
+        driver="GPKG",
+        **spatial_index_options(spatial_index),
+    )
+    index_geopackage_file(geopackage_path, table_name, index_columns)
+
+
+def build_geopackage(
+    df,
+    output_dir,
+    file_name,
+    table_name,
+    add_dummy_geometry=True,
+    memory_budget=0,
+    spatial_index=True,
+    index_columns=None,
+):
+    """Write a one-layer GeoPackage and return its path, or a GeoPackageOutput.
+
+    With a memory_budget (bytes) the GeoPackage is built in memory instead of
+    in output_dir, unless it is larger than the budget (see gpkg_memory.py).
+    spatial_index=False skips the R-tree for files nobody queries spatially,
+    index_columns=[] the attribute indexes.
+    """
+    if memory_budget > 0:
+        return GeoPackageOutput.from_frame(
+            prepare_geodataframe(df, add_dummy_geometry),
+            file_name,
+            table_name,
+            memory_budget,
+            output_dir,
+            spatial_index,
+            index_columns,
+        )
+    geopackage_path = os.path.join(output_dir, file_name)
+    write_dataframe_to_geopackage(
+        df,
+        geopackage_path,
+        table_name,
+        add_dummy_geometry,
+        spatial_index=spatial_index,
+        index_columns=index_columns,
+    )
+    return geopackage_path
+
+
+def write_frames_to_sqlite(frames, path):
+    """Write a dict of plain DataFrames to a SQLite file, one table per key.
 
+    The dtypes of the columns declared in FRAME_SCHEMAS are kept in the
+    FRAME_DTYPES_TABLE, so columns widened for float64 variables come back
+    as float64.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    try:
+        dtypes = []
+        for table_name, frame in frames.items():
+            widen_compact_columns(frame.copy()).to_sql(table_name, conn, index=False)
+            dtypes += [
+                (table_name, column, str(frame[column].dtype))
+                for column in FRAME_SCHEMAS.get(table_name, {})
+                if column in frame.columns
+            ]
+        pd.DataFrame(dtypes, columns=["table_name", "column_name", "dtype"]).to_sql(
+            FRAME_DTYPES_TABLE, conn, index=False
+        )
+    finally:
+        conn.close()
+
+
+def read_frame_dtypes(conn):
+    """Schemas from the FRAME_DTYPES_TABLE, or FRAME_SCHEMAS for files written without it."""
+    if not conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (FRAME_DTYPES_TABLE,),
+    ).fetchone():
+        return FRAME_SCHEMAS
+    schemas = {}
+    for table_name, column, dtype in conn.execute(
+        f"SELECT table_name, column_name, dtype FROM {FRAME_DTYPES_TABLE}"
+    ):
+        schemas.setdefault(table_name, {})[column] = dtype
+    return schemas
+
+
+def read_frames_from_sqlite(path, table_names):
+    """Read tables written by write_frames_to_sqlite back into DataFrames."""
+    conn = sqlite3.connect(path)
+    try:
+        schemas = read_frame_dtypes(conn)
+        frames = {}
+        for table_name in table_names:
+            frame = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
+            if "time_stamp_date" in frame.columns:
+                # Same resolution as decode_cf_times; each distinct time is parsed once
+                frame["time_stamp_date"] = pd.to_datetime(
+                    frame["time_stamp_date"], cache=True
+                ).astype("datetime64[ns]")
+            # SQLite only has 8-byte REAL/INTEGER, so restore the compact dtypes
+            frames[table_name] = apply_frame_schema(frame, schemas.get(table_name, {}))
+    finally:
+        conn.close()
+    return frames
 
 
 def join_geopackage_tables_in_memory(
     geopackage_path, layer_a, cleaned_data, join_key_a, join_key_b, join_type="inner"
 ):
-    """Perform a join between an in-memory DataFrame and a layer from a GeoPackage."""
-    # Load the existing table from the GeoPackage
-    data_a = gpd.read_file(geopackage_path, layer=layer_a)
+    """Perform a join between an in-memory DataFrame and a layer from a GeoPackage.
+
+    geopackage_path can also be a reference store (see reference_store.py).
+    """
+    if is_reference_store(geopackage_path) and join_type in ("inner", "right"):
+        # Reference rows without a match drop out of these joins anyway, so
+        # only the matched rows are read and their geometries decoded
+        data_a = read_reference_layer(geopackage_path, layer_a, cleaned_data[join_key_b])
+    else:
+        # Load the existing table from the GeoPackage
+        data_a = read_reference_layer(geopackage_path, layer_a)
 
     # Perform the join in-memory based on the specified join type
     joined_data = data_a.merge(
@@ -347,13 +533,196 @@ def join_geopackage_tables_in_memory(
     return joined_data
 
 
-def process_netCDF_file(s3_path):
-    """Process the NetCDF file and return a DataFrame."""
+def cast_to_schema(values, dtype):
+    """Cast an array to a schema dtype, refusing integer downcasts that would overflow."""
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer) and len(values):
+        limits = np.iinfo(dtype)
+        if values.min() < limits.min or values.max() > limits.max:
+            raise ValueError(f"Values {values.min()}..{values.max()} do not fit into {dtype}.")
+    return values.astype(dtype, copy=False)
+
+
+def value_dtype(declared, source=None):
+    """The declared compact dtype of a value column, or a wider one if needed.
+
+    source is the variable's dtype in the NetCDF file; values that do not
+    fit the declared dtype exactly (float64, or int32 in a float32) keep the
+    precision of the file.
+    """
+    declared = np.dtype(declared)
+    if source is None or np.can_cast(source, declared):
+        return declared
+    return np.result_type(source, declared)
+
+
+def apply_frame_schema(df, schema=LONG_FRAME_SCHEMA):
+    """Cast the columns of df that are declared in schema to their compact dtypes."""
+    for column, dtype in schema.items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if dtype == "category":
+            df[column] = df[column].astype("category")
+        else:
+            df[column] = cast_to_schema(df[column].to_numpy(), dtype)
+    return df
+
+
+def widen_compact_columns(df):
+    """Undo the compact dtypes before writing a GeoPackage.
+
+    Categorical columns go back to their plain dtype and float32 becomes
+    float64, so the rounded values written for ArcGIS stay exactly the same
+    as with the old float64 frame.
+    """
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = np.asarray(df[column])
+        elif df[column].dtype == "float32":
+            df[column] = df[column].astype("float64")
+    return df
+
+
+def sentinel_values_for(var):
+    """Configured sentinel values of a variable; identifiers have none by default."""
+    if var in SENTINEL_VALUES:
+        return SENTINEL_VALUES[var]
+    if var not in IDENTIFIER_VARIABLES:
+        return SENTINEL_VALUES.get("default", [])
+    return []
+
+
+def _is_number(value):
     try:
-        print(f"Opening NetCDF file from S3 path: {s3_path}")
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def output_variables(schema=None):
+    """The value variables each output of schema needs ({output: [names]}).
+
+    The second output includes the threshold variable of the
+    "exceedance_count" statistic.
+    """
+    schema = schema or OUTPUT_SCHEMA
+    variables = {output: list(layer["variables"]) for output, layer in schema.items()}
+    exceedance_threshold = os.environ.get("EXCEEDANCE_THRESHOLD", "relative_thresholds_2yr")
+    if "exceedance_count" in schema["second"].get("statistics", ()) and not _is_number(
+        exceedance_threshold
+    ):
+        variables["second"].append(exceedance_threshold)
+    return variables
+
+
+def decoded_variables(schema=None):
+    """The value variables the outputs of schema need, in first-seen order."""
+    return list(
+        dict.fromkeys(var for names in output_variables(schema).values() for var in names)
+    )
+
+
+def finish_layer_columns(df, output, schema=None):
+    """Round and rename the columns of a joined frame as the output's schema says.
+
+    A variable's rounding applies to all its float columns: "<name>" and
+    the statistics "<name>_<statistic>" (names lower-cased).
+    """
+    layer = (schema or OUTPUT_SCHEMA)[output]
+    for var, decimals in layer.get("round", {}).items():
+        name = var.lower()
+        columns = [
+            column
+            for column in df.columns
+            if (column == name or column.startswith(f"{name}_"))
+            and pd.api.types.is_float_dtype(df[column])
+        ]
+        df[columns] = df[columns].round(decimals)
+    if layer.get("columns"):
+        df = df.rename(columns=layer["columns"])
+    return df
+
+
+def invalid_value_mask(values, sentinels):
+    """Boolean mask of masked, NaN and sentinel cells of a decoded variable."""
+    raw = np.ma.getdata(values)
+    invalid = np.ma.getmaskarray(values) | np.isin(raw, sentinels)
+    if np.issubdtype(raw.dtype, np.floating):
+        invalid |= np.isnan(raw)
+    return invalid
+
+
+def open_netcdf_dataset(path):
+    """Open a NetCDF file from an s3:// URL (read into memory) or a local path.
+
+    Zarr stores (paths containing ".zarr") open as a zarr_reader.ZarrDataset,
+    which reads like a netCDF4 Dataset but only fetches the chunks used.
+    """
+    if is_zarr_path(path):
+        from zarr_reader import open_zarr_dataset
+
+        return open_zarr_dataset(path)
+    if path.startswith("s3://"):
         fs = s3fs.S3FileSystem()
-        with fs.open(s3_path, "rb") as f:
-            dataset = Dataset("dummy", mode="r", memory=f.read())
+        with fs.open(path, "rb") as f:
+            return Dataset("dummy", mode="r", memory=f.read())
+    return Dataset(path, mode="r")
+
+
+def read_time_values(dataset):
+    """Decode the time variable of an open dataset into a datetime64 array."""
+    time_var = dataset.variables["time"]
+    raw_times = time_var[:]
+    time_values = decode_cf_times(
+        raw_times, time_var.units, getattr(time_var, "calendar", "standard")
+    )
+    if time_values is not None:
+        return time_values
+
+    # Other calendars and units go through cftime, one value at a time
+    time_values = num2date(raw_times, units=time_var.units)
+
+    # Convert time values to standard datetime objects
+    return pd.to_datetime([convert_to_datetime(time) for time in time_values]).values
+
+
+def read_nrch(dataset, reach_slice=slice(None)):
+    """Per-reach nrch values of an open dataset."""
+    if "nrch" in dataset.variables:
+        return np.ma.getdata(dataset.variables["nrch"][reach_slice])
+    if "nrch" in dataset.dimensions:
+        # No coordinate variable: use the reach's index along the dimension
+        return np.arange(len(dataset.dimensions["nrch"]))[reach_slice]
+    raise KeyError("Dimension 'nrch' not found in the NetCDF file.")
+
+
+def decode_netcdf_file(s3_path, reach_range=None, variables=None):
+    """Decode the NetCDF variables into (time, nrch) and (nrch,) arrays.
+
+    Returns a dict with "time_values" (datetime64 array), "nrch" (per-reach
+    array), "variables" (name -> array), "dtypes" (name -> dtype of the
+    variable in the file) and "valid", per output the (time, nrch) mask of
+    cells where the identifiers and that output's variables hold no invalid
+    values, plus "nrthresholds" if the file has that coordinate. If
+    reach_range is given as (start, stop), only that slice of the nrch
+    dimension is decoded, so a shard worker reads just its own hyperslab.
+    Only the value variables listed in variables (default: the ones the
+    OUTPUT_SCHEMA needs) are decoded, besides rchid and streamorder.
+    """
+    variables = decoded_variables() if variables is None else list(variables)
+    decode_workers = int(os.environ.get("NETCDF_DECODE_WORKERS", "1"))
+    # Zarr chunks are fetched on threads instead (see zarr_reader.py)
+    if is_zarr_path(s3_path):
+        decode_workers = 1
+    try:
+        print(f"Opening NetCDF file from S3 path: {s3_path}")
+        if decode_workers > 1:
+            # Worker processes open the file themselves, so it has to be on local disk
+            local_path = localize_netcdf(s3_path)
+            dataset = open_netcdf_dataset(local_path)
+        else:
+            dataset = open_netcdf_dataset(s3_path)
         print("NetCDF file loaded successfully.")
     except Exception as e:
         print(f"Error loading NetCDF file: {e}")
@@ -361,129 +730,230 @@ def process_netCDF_file(s3_path):
 
     print("Processing data...")
     data = {}
+    reach_slice = slice(*reach_range) if reach_range else slice(None)
+
+    parallel_arrays = {}
+    if decode_workers > 1:
+        print(f"Decoding variables with {decode_workers} processes...")
+        parallel_arrays, timings = decode_variables_parallel(
+            local_path,
+            variables,
+            reach_range,
+            decode_workers,
+        )
+        decoded_mb = sum(array.nbytes for array in parallel_arrays.values()) / 1e6
+        print(
+            f"Decoded {decoded_mb:.1f} MB in {len(parallel_arrays)} variables "
+            f"(CPU time across workers: {sum(timings.values()):.2f} s)."
+        )
+        if local_path != s3_path:
+            os.remove(local_path)
+    elif is_zarr_path(s3_path):
+        started = time.perf_counter()
+        parallel_arrays = dataset.read_variables(variables, reach_slice)
+        decoded_mb = sum(array.nbytes for array in parallel_arrays.values()) / 1e6
+        print(
+            f"Fetched and decoded {decoded_mb:.1f} MB of Zarr chunks in "
+            f"{time.perf_counter() - started:.2f} s."
+        )
 
     # Extract the time variable
-    time_var = dataset.variables["time"]
-    time_values = num2date(time_var[:], units=time_var.units)
-
-    # Convert time values to standard datetime objects
-    time_values = [convert_to_datetime(time) for time in time_values]
+    time_values = read_time_values(dataset)
 
     # Extract non-time-dependent variables
-    for var in ["rchid", "streamorder"]:
+    for var in IDENTIFIER_VARIABLES:
         if var in dataset.variables:
-            data[var] = dataset.variables[var][:].tolist()
+            data[var] = dataset.variables[var][reach_slice]
         else:
             raise KeyError(f"Variable '{var}' not found in the NetCDF file.")
 
     # Extract the nrch dimension
-    if "nrch" in dataset.variables:
-        nrch = dataset.variables["nrch"][:].tolist()
-    elif "nrch" in dataset.dimensions:
-        nrch = len(dataset.dimensions["nrch"])
-    else:
-        raise KeyError("Dimension 'nrch' not found in the NetCDF file.")
-
-    # Extract time-dependent variables
-    for var in [
-        "absoluteValues",
-        "relativeValues",
-        "absoluteValues25thPercentile",
-        "absoluteValues5thPercentile",
-        "absoluteValues75thPercentile",
-        "absoluteValues95thPercentile",
-        "absoluteValuesMedian",
-        "relativeValues25thPercentile",
-        "relativeValues5thPercentile",
-        "relativeValues75thPercentile",
-        "relativeValues95thPercentile",
-        "relativeValuesMedian",
-    ]:
-        if var in dataset.variables:
-            var_data = dataset.variables[var][:]
-            print(f"Variable '{var}' shape: {var_data.shape}")
-            if var_data.shape[0] != len(time_values):
-                raise ValueError(
-                    f"Variable '{var}' does not have the same time dimension as 'time'."
-                )
-            data[var] = var_data
-        else:
-            raise KeyError(f"Variable '{var}' not found in the NetCDF file.")
+    nrch = read_nrch(dataset, reach_slice)
 
-    # Extract thresholds
-    for var in [
-        "relative_thresholds_10yr",
-        "relative_thresholds_20yr",
-        "relative_thresholds_2yr",
-        "relative_thresholds_5yr",
-    ]:
-        if var in dataset.variables:
-            var_data = dataset.variables[var][:]
-            print(f"Variable '{var}' shape: {var_data.shape}")
-            if var_data.shape[0] != len(data["rchid"]):
-                raise ValueError(
-                    f"Variable '{var}' does not have the same spatial dimension as 'rchid'."
-                )
-            data[var] = var_data
-        else:
+    # Extract the value variables: time-dependent (time, nrch) ones and
+    # per-reach (nrch,) ones such as the thresholds
+    print(f"Decoding {len(variables)} variables: {', '.join(variables)}")
+    for var in variables:
+        if var not in dataset.variables:
             raise KeyError(f"Variable '{var}' not found in the NetCDF file.")
-
-    # Step 3: Process data in parallel
-    print("Processing data in parallel...")
-    rows = []
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = [
-            executor.submit(
-                process_time_step,
-                time_values[i],
-                data,
-                nrch,
-                data["rchid"],
-                data["streamorder"],
-                data["absoluteValues"][i],
-                data["absoluteValues25thPercentile"][i],
-                data["absoluteValues5thPercentile"][i],
-                data["absoluteValues75thPercentile"][i],
-                data["absoluteValues95thPercentile"][i],
-                data["absoluteValuesMedian"][i],
-                data["relative_thresholds_10yr"],
-                data["relative_thresholds_20yr"],
-                data["relative_thresholds_2yr"],
-                data["relative_thresholds_5yr"],
-                data["relativeValues"][i],
-                data["relativeValues25thPercentile"][i],
-                data["relativeValues5thPercentile"][i],
-                data["relativeValues75thPercentile"][i],
-                data["relativeValues95thPercentile"][i],
-                data["relativeValuesMedian"][i],
+        time_dependent = dataset.variables[var].dimensions[0] == "time"
+        if var in parallel_arrays:
+            var_data = parallel_arrays[var]
+        elif time_dependent:
+            var_data = dataset.variables[var][:, reach_slice]
+        else:
+            var_data = dataset.variables[var][reach_slice]
+        print(f"Variable '{var}' shape: {var_data.shape}")
+        if time_dependent and var_data.shape[0] != len(time_values):
+            raise ValueError(
+                f"Variable '{var}' does not have the same time dimension as 'time'."
             )
-            for i in range(len(time_values))
-        ]
-        for future in concurrent.futures.as_completed(futures):
-            rows.extend(future.result())
+        if not time_dependent and var_data.shape[0] != len(data["rchid"]):
+            raise ValueError(
+                f"Variable '{var}' does not have the same spatial dimension as 'rchid'."
+            )
+        data[var] = var_data
+
+    # Step 3: Mask invalid cells at decode time: masked (_FillValue / valid
+    # range), NaN or one of the variable's sentinel values. Per output, a
+    # (time, reach) cell is dropped if its time step (NaT), an identifier or
+    # one of the output's own variables is invalid there, so an invalid value
+    # of one output's variable does not drop the cell from the other outputs.
+    print("Masking invalid values...")
+    shape = (len(time_values), len(data["rchid"]))
+    identifiers_valid = np.ones(shape, dtype=bool)
+    identifiers_valid &= ~np.isnat(time_values)[:, np.newaxis]
+    for var in IDENTIFIER_VARIABLES:
+        identifiers_valid &= ~invalid_value_mask(data[var], sentinel_values_for(var))
+    invalid = {
+        var: invalid_value_mask(data[var], sentinel_values_for(var)) for var in variables
+    }
+    valid = {}
+    for output, names in output_variables().items():
+        valid[output] = identifiers_valid.copy()
+        for var in names:
+            if var in invalid:
+                valid[output] &= ~invalid[var]
+        print(
+            f"{output}: {valid[output].size - valid[output].sum()} of "
+            f"{valid[output].size} (time, reach) cells are invalid."
+        )
 
-    # Step 4: Create a pandas DataFrame
+    decoded = {
+        "time_values": time_values,
+        "nrch": nrch,
+        "variables": data,
+        "dtypes": {var: dataset.variables[var].dtype for var in variables},
+        "valid": valid,
+    }
+    if "nrthresholds" in dataset.variables:
+        decoded["nrthresholds"] = read_nrthresholds(dataset)
+    return decoded
+
+
+def flatten_decoded_netcdf(decoded):
+    """Build the long-format DataFrame (one row per valid time step and reach)."""
+    data = decoded["variables"]
+    nrch = decoded["nrch"]
+    time_index, reach_index = np.nonzero(decoded["valid"]["first"])
+    # One category per distinct time; repeated time steps share it and NaT
+    # ones (code -1) have no valid cells
+    time_codes, times = pd.factorize(decoded["time_values"])
+
+    # Step 4: Create a pandas DataFrame from the valid cells, with the
+    # compact dtypes of LONG_FRAME_SCHEMA (wider where the file's are)
     print("Creating pandas DataFrame...")
-    df = pd.DataFrame(rows)
-    df["time_stamp_date"] = pd.to_datetime(df["time_stamp_date"])
-    print(f"DataFrame created with shape: {df.shape}")
+    schema = LONG_FRAME_SCHEMA
+    dtypes = decoded.get("dtypes", {})
+    columns = {
+        "time_stamp_date": pd.Categorical.from_codes(
+            time_codes[time_index], categories=pd.DatetimeIndex(times)
+        ),
+        "nrch": cast_to_schema(np.asarray(nrch)[reach_index], schema["nrch"]),
+        "rchid": cast_to_schema(np.ma.getdata(data["rchid"])[reach_index], schema["rchid"]),
+        "streamorder": cast_to_schema(
+            np.ma.getdata(data["streamorder"])[reach_index], schema["streamorder"]
+        ),
+    }
+    # The first output's variables: time-dependent ones (absoluteValues*
+    # first, then relativeValues*, as before) under lower-cased names, then
+    # the per-reach ones; undeclared variables are float32 (or wider)
+    first_variables = [var for var in OUTPUT_SCHEMA["first"]["variables"] if var in data]
+    time_dependent = [var for var in first_variables if np.ndim(data[var]) == 2]
+    for var in sorted(time_dependent, key=lambda v: v.startswith("relative")):
+        columns[var.lower()] = cast_to_schema(
+            np.ma.getdata(data[var])[time_index, reach_index],
+            value_dtype(schema.get(var.lower(), "float32"), dtypes.get(var)),
+        )
+    for var in first_variables:
+        if var not in time_dependent:
+            columns[var] = cast_to_schema(
+                np.ma.getdata(data[var])[reach_index],
+                value_dtype(schema.get(var, "float32"), dtypes.get(var)),
+            )
+    df = pd.DataFrame(columns)
+    print(
+        f"DataFrame created with shape: {df.shape}, "
+        f"{df.memory_usage(deep=True).sum() / 1e6:.1f} MB in memory"
+    )
 
     return df
 
 
+def reduce_reach_statistics(
+    decoded, variables, statistics=("max",), exceedance_threshold=None
+):
+    """Per-reach statistics computed with axis reductions over the (time, nrch) arrays.
+
+    Returns one row per reach with at least one valid cell of the second
+    output, sorted by "rchid" and "streamorder": "rchid", "streamorder", then
+    for each variable (column name = lower-cased variable name) the requested
+    statistics, and "time_stamp_date", the latest time step with valid
+    values. Statistics:
+
+    - "max": column "<name>", the maximum over valid time steps
+    - "mean": column "<name>_mean"
+    - "argmax_time": column "<name>_argmax_time", time step of the maximum
+    - "exceedance_count": column "<name>_exceedance_count", number of valid
+      time steps above exceedance_threshold (a number or the name of a
+      per-reach threshold variable such as "relative_thresholds_2yr")
+    """
+    data = decoded["variables"]
+    valid = decoded["valid"]["second"]
+    time_values = decoded["time_values"]
+    has_valid = valid.any(axis=0)
+    valid_counts = valid.sum(axis=0)
+
+    columns = {
+        "rchid": np.ma.getdata(data["rchid"]).astype("int64"),
+        "streamorder": np.ma.getdata(data["streamorder"]).astype("int64"),
+    }
+    for var in variables:
+        values = np.ma.getdata(data[var]).astype("float64")
+        column = var.lower()
+        masked_for_max = np.where(valid, values, -np.inf)
+        if "max" in statistics:
+            columns[column] = masked_for_max.max(axis=0)
+        if "mean" in statistics:
+            sums = np.where(valid, values, 0.0).sum(axis=0)
+            columns[f"{column}_mean"] = sums / np.maximum(valid_counts, 1)
+        if "argmax_time" in statistics:
+            columns[f"{column}_argmax_time"] = time_values[masked_for_max.argmax(axis=0)]
+        if "exceedance_count" in statistics:
+            if exceedance_threshold is None:
+                raise ValueError("exceedance_count needs an exceedance_threshold.")
+            threshold = (
+                np.ma.getdata(data[exceedance_threshold]).astype("float64")
+                if isinstance(exceedance_threshold, str)
+                else exceedance_threshold
+            )
+            columns[f"{column}_exceedance_count"] = (
+                valid & (values > threshold)
+            ).sum(axis=0)
+    # Latest valid time step per reach, the same as max() over the long table
+    time_ints = time_values.astype("int64")
+    latest = np.where(valid, time_ints[:, np.newaxis], np.iinfo("int64").min).max(axis=0)
+    columns["time_stamp_date"] = latest.astype(time_values.dtype)
+
+    schema = dict(AGGREGATED_FRAME_SCHEMA)
+    for var in variables:
+        if var.lower() in schema:
+            schema[var.lower()] = value_dtype(
+                schema[var.lower()], decoded.get("dtypes", {}).get(var)
+            )
+    aggregated_data = apply_frame_schema(pd.DataFrame(columns)[has_valid], schema)
+    return aggregated_data.sort_values(["rchid", "streamorder"], ignore_index=True)
+
+
 def extract_threshold_summary_from_netcdf(s3_path):
     """
     Extracts the sum_bool_value_thsh variable from the NetCDF file and returns a DataFrame
     grouped by nrch and nrthresholds, for the '0-48' timewindow (index 3).
     """
     import pandas as pd
-    import s3fs
-    from netCDF4 import Dataset
     from shapely.geometry import Point
 
-    fs = s3fs.S3FileSystem()
-    with fs.open(s3_path, "rb") as f:
-        dataset = Dataset("dummy", mode="r", memory=f.read())
+    dataset = open_netcdf_dataset(s3_path)
 
     # Always use index 3 for the '0-48' timewindow
     timewindow_index = 3  # 0-based index for the 4th timewindow
@@ -521,58 +991,179 @@ def extract_threshold_summary_from_netcdf(s3_path):
     return df
 
 
-# lambda_handler function
+def parse_time_windows(spec):
+    """Parse "0-24,0-48" into [("0-24", 0.0, 24.0), ...] (hours of lead time)."""
+    windows = []
+    for label in spec.split(","):
+        label = label.strip()
+        start, _, end = label.partition("-")
+        if not end or float(start) >= float(end):
+            raise ValueError(f"Invalid time window '{label}', expected '<start>-<end>' hours.")
+        windows.append((label, float(start), float(end)))
+    return windows
 
-def lambda_handler(event, context):
-    # Enable logging for ArcGIS API
-    logging.basicConfig(level=logging.INFO)
 
-    print(f"Connecting to ArcGIS Online {AGOURL}")
-    # Initialize the GIS connection
-    gis = GIS(AGOURL, AGOUSERNAME, AGOPASSWORD)
-    s3_client = boto3.client("s3")
+def threshold_variable(return_period):
+    """Name of the threshold variable of a return period (nrthresholds value)."""
+    name = f"relative_thresholds_{int(return_period)}yr"
+    if name not in THRESHOLD_VARIABLES:
+        raise KeyError(f"No threshold variable for nrthresholds value {return_period}.")
+    return name
 
-    print(f"Connected to ArcGIS Online {AGOURL}")
-    print(f"Feature Layer URL: {HOSTED_FEATURE_LAYER_URL}")
 
-    # Step 0: Read the NetCDF file from S3
-    print("Reading NetCDF file from S3...")
+def read_nrthresholds(dataset):
+    """The nrthresholds coordinate (return periods) of an open dataset."""
+    if "nrthresholds" not in dataset.variables:
+        raise KeyError("Coordinate variable 'nrthresholds' not found in the NetCDF file.")
+    return np.ma.getdata(dataset.variables["nrthresholds"][:])
 
-    # Get the bucket name and object key from the event
-    s3_bucket = event["Records"][0]["s3"]["bucket"]["name"]
-    s3_key = event["Records"][0]["s3"]["object"]["key"]
 
-    print(f"S3 bucket: {s3_bucket}")
-    print(f"S3 key: {s3_key}")
+def compute_threshold_exceedance(decoded, windows, variable="relativeValues"):
+    """Count, per reach, threshold and time window, the time steps above the threshold.
 
-    s3_path = f"s3://{s3_bucket}/{s3_key}"
+    decoded needs "time_values", "nrch", "nrthresholds" (the file's
+    nrthresholds coordinate, in return periods) and in "variables" the
+    arrays of variable and of relative_thresholds_<n>yr for each n. A window (label, start, end) covers
+    the time steps with start <= hours since the first time step < end.
+    Every time step is compared against all thresholds in one broadcast and
+    visited once; overlapping windows are summed from the per-segment counts.
+    Invalid values and thresholds never count as an exceedance.
 
-    # Step 1: Delete the previous temporary GPKG item from ArcGIS Online
-    delete_previous_item_from_agol(gis, s3_bucket, s3_key)
+    Returns one row per window, threshold and reach, in the shape of
+    extract_threshold_summary_from_netcdf plus a "timewindow" column.
+    """
+    data = decoded["variables"]
+    lead_hours = (decoded["time_values"] - decoded["time_values"][0]) / np.timedelta64(1, "h")
 
-    # Step 2: Process the NetCDF file
-    print("Processing NetCDF file...")
-    s3_path = f"s3://{s3_bucket}/{s3_key}"
-    df = process_netCDF_file(s3_path)
+    values = np.ma.getdata(data[variable])
+    values = np.where(
+        invalid_value_mask(data[variable], sentinel_values_for(variable)), -np.inf, values
+    )
+    # Thresholds in the order of the nrthresholds coordinate, as (thresholds, nrch)
+    nrthresholds = np.asarray(decoded["nrthresholds"]).astype("int64")
+    threshold_vars = [threshold_variable(n) for n in nrthresholds]
+    thresholds = np.stack(
+        [
+            np.where(
+                invalid_value_mask(data[var], sentinel_values_for(var)),
+                np.inf,
+                np.ma.getdata(data[var]),
+            )
+            for var in threshold_vars
+        ]
+    )
+
+    # Count exceedances between consecutive window boundaries, then add up
+    # the segments of each window
+    bounds = sorted({bound for _, start, end in windows for bound in (start, end)})
+    edges = np.searchsorted(lead_hours, bounds, side="left")
+    cumulative = np.zeros((len(bounds),) + thresholds.shape, dtype="int32")
+    for i in range(1, len(bounds)):
+        segment = values[edges[i - 1] : edges[i]]
+        exceeded = segment[None, :, :] > thresholds[:, None, :]
+        cumulative[i] = cumulative[i - 1] + exceeded.sum(axis=1)
+
+    counts = np.stack(
+        [
+            cumulative[bounds.index(end)] - cumulative[bounds.index(start)]
+            for _, start, end in windows
+        ]
+    )
+    reach_count = thresholds.shape[1]
+    rows_per_window = len(threshold_vars) * reach_count
+    return pd.DataFrame(
+        {
+            "nrch": np.tile(
+                np.asarray(decoded["nrch"]).astype("int64"),
+                len(windows) * len(threshold_vars),
+            ),
+            "nrthresholds": np.tile(np.repeat(nrthresholds, reach_count), len(windows)),
+            "timewindow": np.repeat([label for label, _, _ in windows], rows_per_window),
+            "sum_bool_value_thsh": counts.reshape(-1).astype("float64"),
+        }
+    )
+
+
+def threshold_exceedance_from_netcdf(s3_path, windows, variable="relativeValues"):
+    """Read only what compute_threshold_exceedance needs from the NetCDF file and run it.
+
+    Time steps after the end of the last window are not read.
+    """
+    dataset = open_netcdf_dataset(s3_path)
+    try:
+        time_values = read_time_values(dataset)
+        lead_hours = (time_values - time_values[0]) / np.timedelta64(1, "h")
+        time_stop = int(
+            np.searchsorted(lead_hours, max(end for _, _, end in windows), side="left")
+        )
+        nrthresholds = read_nrthresholds(dataset)
+        decoded = {
+            "time_values": time_values[:time_stop],
+            "nrch": read_nrch(dataset),
+            "nrthresholds": nrthresholds,
+            "variables": {
+                variable: dataset.variables[variable][:time_stop],
+                **{
+                    var: dataset.variables[var][:]
+                    for var in map(threshold_variable, nrthresholds)
+                },
+            },
+        }
+    finally:
+        dataset.close()
+    return compute_threshold_exceedance(decoded, windows, variable)
 
-    # Step 6: Aggregate the table created in the Lambda function
+
+def build_frames_from_decoded(decoded):
+    """Return the long-format frame and the per-reach aggregates of a decoded file.
+
+    The aggregates for the second layer are reduced straight from the
+    (time, nrch) arrays, without going through the long table.
+    """
+    df = flatten_decoded_netcdf(decoded)
+
+    # Aggregate per reach (by default the maximum)
     print("Aggregating data...")
-    aggregated_data = aggregate_table(
-        df, ["rchid", "streamorder"], "relativevalues95thpercentile"
+    exceedance_threshold = os.environ.get(
+        "EXCEEDANCE_THRESHOLD", "relative_thresholds_2yr"
     )
+    if _is_number(exceedance_threshold):
+        exceedance_threshold = float(exceedance_threshold)
+    aggregated_data = reduce_reach_statistics(
+        decoded,
+        OUTPUT_SCHEMA["second"]["variables"],
+        OUTPUT_SCHEMA["second"].get("statistics", ["max"]),
+        exceedance_threshold,
+    )
+    return df, aggregated_data
+
+
+def build_output_frames(s3_path):
+    """Run the NetCDF transform and return the cleaned raw and aggregated frames."""
+    shard_count = int(os.environ.get("SHARD_COUNT", "1"))
+    if shard_count > 1:
+        # Sharded: workers transform nrch ranges, the reducer merges them
+        from sharding import run_sharded
+
+        print(f"Processing NetCDF file in {shard_count} reach shards...")
+        df, aggregated_data = run_sharded(s3_path, shard_count)
+    else:
+        df, aggregated_data = build_frames_from_decoded(decode_netcdf_file(s3_path))
     print("Data aggregated successfully.")
 
-    # Step 7: Clean and filter the aggregated data
-    print("Cleaning and filtering data...")
-    cleaned_data = clean_and_filter_data(
-        aggregated_data, [-888, 888, 999], "time_stamp_date"
-    )
-    print("Data cleaned and filtered successfully.")
+    # Invalid and sentinel values were already dropped while decoding (see
+    # decode_netcdf_file), so neither frame needs cleaning
+    return df, aggregated_data
 
-    # Step 8: Retrieve the reference GeoPackage from S3 and save it under a distinct name
+
+def download_reference_geopackage(s3_client):
+    """Retrieve the reference GeoPackage from S3 unless it is already in /tmp.
+
+    With REFERENCE_STORE_S3_KEY set, the reference store is retrieved instead.
+    """
+    if REFERENCE_STORE_S3_KEY:
+        return download_reference_store(s3_client)
     print("Retrieving reference GeoPackage from S3...")
-    reference_s3_key = "REC1_Geopackage/a_gpkg.gpkg"
-    s3_bucket_download = "s3-lambda-stack-prd-input-bucket-prod"  # Static bucket name from test event
     reference_local_path = os.path.join(
         tempfile.gettempdir(), "reference_geopackage.gpkg"
     )
@@ -587,7 +1178,7 @@ def lambda_handler(event, context):
         # Ensure the file is not locked during download
         try:
             s3_client.download_file(
-                s3_bucket_download, reference_s3_key, reference_local_path
+                REFERENCE_S3_BUCKET, REFERENCE_S3_KEY, reference_local_path
             )
             print(
                 f"Reference GeoPackage retrieved and saved to: {reference_local_path}"
@@ -599,12 +1190,46 @@ def lambda_handler(event, context):
             print(f"Error downloading the reference GeoPackage: {e}")
             logging.error(f"Error downloading the reference GeoPackage: {e}")
             raise
+    return reference_local_path
 
+
+def download_reference_store(s3_client):
+    """Retrieve the reference store from S3 unless it is already in /tmp."""
+    reference_local_path = os.path.join(tempfile.gettempdir(), "reference.refstore")
+    if os.path.exists(reference_local_path):
+        print(f"Reference store already exists locally at: {reference_local_path}")
+        return reference_local_path
+    started = time.perf_counter()
+    s3_client.download_file(REFERENCE_S3_BUCKET, REFERENCE_STORE_S3_KEY, reference_local_path)
+    print(
+        f"Reference store retrieved and saved to: {reference_local_path} "
+        f"({os.path.getsize(reference_local_path) / 1e6:.1f} MB in "
+        f"{time.perf_counter() - started:.1f} s)"
+    )
+    return reference_local_path
+
+
+def transform_netcdf_to_geopackages(s3_path, reference_local_path, output_dir=None):
+    """Run the transform stages of lambda_handler for one NetCDF file.
+
+    Writes the first join, second join and threshold extract GeoPackages to
+    output_dir (default: the temp directory) and returns their paths keyed by
+    "first", "second" and "extract". Nothing is published.
+    """
+    # Step 2-7: Process, aggregate and clean the NetCDF file
+    print("Processing NetCDF file...")
+    cleaned_raw_data, cleaned_data = build_output_frames(s3_path)
+    return write_output_geopackages(
+        s3_path, cleaned_raw_data, cleaned_data, reference_local_path, output_dir
+    )
+
+
+def join_raw_riverlines(cleaned_raw_data, reference_local_path):
+    """Join the long-format frame onto the riverlines for the first GeoPackage."""
     # Step 9: Perform the join logic for the first GeoPackage using raw data
     print(
         "Performing join between riverlines and raw data in-memory for the first GeoPackage..."
     )
-    cleaned_raw_data = clean_and_filter_data(df, [-888, 888, 999], "time_stamp_date")
     joined_raw_data = join_geopackage_tables_in_memory(
         reference_local_path,
         "R1_Riverlines_SimplifyLine",
@@ -615,43 +1240,77 @@ def lambda_handler(event, context):
     )
     print("Join operation completed successfully for the first GeoPackage.")
 
-    # Reduce precision for numeric columns before writing first GeoPackage
-    cols_to_round_1 = [
-        col
-        for col in joined_raw_data.columns
-        if col.startswith("absolutevalues") or col.startswith("relativevalues")
-    ]
-    joined_raw_data[cols_to_round_1] = joined_raw_data[cols_to_round_1].round(2)
+    # Reduce precision and name the columns as declared in OUTPUT_SCHEMA
+    # before writing the first GeoPackage
+    joined_raw_data = widen_compact_columns(joined_raw_data)
+    return finish_layer_columns(joined_raw_data, "first")
 
-    # Step 10: Write the joined raw data to a new GeoPackage for the first join
-    print("Creating a new GeoPackage for the first join...")
-    first_geopackage_path = os.path.join(
-        tempfile.gettempdir(), "first_join_geopackage.gpkg"
-    )
-    print("Writing joined raw data to the first GeoPackage...")
-    output_table_name_first = "joined_raw_riverlines"
-    write_dataframe_to_geopackage(
-        joined_raw_data, first_geopackage_path, output_table_name_first, False, True
-    )
-    print(
-        f"Joined raw data written to the first GeoPackage as layer '{output_table_name_first}'."
-    )
 
-    # Extract threshold summary from NetCDF and write to the first GeoPackage
-    print(
-        "Extracting threshold summary for timewindows == 3 and writing to GeoPackage..."
-    )
-    threshold_summary_df = extract_threshold_summary_from_netcdf(s3_path)
-    output_s3_key = os.environ.get("OUTPUT_S3_KEY")
-    extract_geopackage_path = os.path.join(tempfile.gettempdir(), output_s3_key)
+def write_output_geopackages(
+    s3_path,
+    cleaned_raw_data,
+    cleaned_data,
+    reference_local_path,
+    output_dir=None,
+    include_first=True,
+    memory_budget=0,
+):
+    """Join the cleaned frames onto the riverlines and write the output GeoPackages.
+
+    include_first=False skips the first GeoPackage, e.g. when the raw layer
+    was already published progressively. With a memory_budget (bytes) the
+    outputs are GeoPackageOutputs built in memory where they fit, otherwise
+    paths in output_dir.
+    """
+    output_dir = output_dir or tempfile.gettempdir()
+    outputs = {}
+    # No indexes if the (opt-in) compact upload optimization drops them anyway
+    published = published_index_options()
+
+    if include_first:
+        joined_raw_data = join_raw_riverlines(cleaned_raw_data, reference_local_path)
+
+        # Step 10: Write the joined raw data to a new GeoPackage for the first join
+        print("Creating a new GeoPackage for the first join...")
+        print("Writing joined raw data to the first GeoPackage...")
+        outputs["first"] = build_geopackage(
+            joined_raw_data,
+            output_dir,
+            "first_join_geopackage.gpkg",
+            RAW_LAYER_NAME,
+            False,
+            memory_budget,
+            **published,
+        )
+        print(f"Joined raw data written to the first GeoPackage as layer '{RAW_LAYER_NAME}'.")
+
+    # Extract threshold summary from NetCDF and write to the extract GeoPackage
+    exceedance_windows = os.environ.get("EXCEEDANCE_WINDOWS")
+    if exceedance_windows:
+        print(
+            f"Computing threshold exceedance for windows {exceedance_windows} and writing to GeoPackage..."
+        )
+        threshold_summary_df = threshold_exceedance_from_netcdf(
+            s3_path, parse_time_windows(exceedance_windows)
+        )
+    else:
+        print(
+            "Extracting threshold summary for timewindows == 3 and writing to GeoPackage..."
+        )
+        threshold_summary_df = extract_threshold_summary_from_netcdf(s3_path)
+    output_s3_key = os.environ.get("OUTPUT_S3_KEY") or "extract_geopackage.gpkg"
+    extract_geopackage_path = os.path.join(output_dir, os.path.basename(output_s3_key))
     if not threshold_summary_df.empty:
         try:
-            write_dataframe_to_geopackage(
+            extract_geopackage_path = build_geopackage(
                 threshold_summary_df,
-                extract_geopackage_path,
+                output_dir,
+                os.path.basename(output_s3_key),
                 "data",  # Correct table name
                 add_dummy_geometry=True,
-                overwrite=False,
+                memory_budget=memory_budget,
+                # Intermediate for the second function, which only reads the table
+                spatial_index=False,
             )
             print(
                 "Threshold summary table written to the first GeoPackage as 'threshold_summary'."
@@ -662,52 +1321,6 @@ def lambda_handler(event, context):
     else:
         print("No threshold summary table written (no timewindows == 3 found).")
 
-    # Step 11: Upload the GeoPackage to an output S3 bucket
-    output_s3_bucket = os.environ.get(
-        "OUTPUT_S3_BUCKET"
-    )  # Set this env var in Lambda config
-    output_s3_key = os.environ.get("OUTPUT_S3_KEY")  # Set this env var in Lambda config
-    # output_s3_key = f"geopackages/{os.path.basename(unique_filename)}"
-    try:
-        s3_client = boto3.client("s3")
-        print(
-            f"Uploading GeoPackage to S3 bucket: {output_s3_bucket}, key: {output_s3_key}"
-        )
-        # s3_client.upload_file(first_geopackage_path, output_s3_bucket, output_s3_key)
-        s3_client.upload_file(extract_geopackage_path, output_s3_bucket, output_s3_key)
-
-        print("GeoPackage uploaded to output S3 bucket successfully.")
-    except Exception as e:
-        print(f"Error uploading GeoPackage to output S3 bucket: {e}")
-
-    # Ensure the correct GeoPackage is used for the first upload
-    # Step 11: Upload the first GeoPackage and update ArcGIS Online
-    print("Uploading the first GeoPackage and updating ArcGIS Online...")
-
-    # Truncate the feature layer before updating
-    print("Truncating the feature layer...")
-    feature_layer = Service(HOSTED_FEATURE_LAYER_URL)
-    truncate_result = feature_layer.manager.truncate()
-    if truncate_result["success"]:
-        print("Feature layer truncated successfully.")
-    else:
-        print("Failed to truncate the feature layer.")
-
-    root_folder = gis.content.folders.get()
-    # Call the function to upload the first GeoPackage and update ArcGIS Online
-    geopackage_item = upload_geopackage_to_arcgis(
-        gis,
-        first_geopackage_path,  # Use the correct GeoPackage path
-        s3_bucket,
-        s3_key,
-        feature_layer,
-        overwrite=False,
-    )
-
-    print(
-        "First GeoPackage uploaded and ArcGIS Online updated successfully. Item ID: {geopackage_item.id}"
-    )
-
     # Ensure the join operation for the second GeoPackage is performed and assigned to `joined_data`
     print(
         "Performing join between riverlines and cleaned aggregated data in-memory for the second GeoPackage..."
@@ -722,73 +1335,483 @@ def lambda_handler(event, context):
     )
     print("Join operation completed successfully for the second GeoPackage.")
 
-    # Reduce precision for numeric columns before writing second GeoPackage
-    cols_to_round_2 = [
-        col
-        for col in joined_data.columns
-        if col.startswith("absolutevalues") or col.startswith("relativevalues")
-    ]
-    joined_data[cols_to_round_2] = joined_data[cols_to_round_2].round(2)
+    # Reduce precision and name the columns as declared in OUTPUT_SCHEMA
+    # before writing the second GeoPackage
+    joined_data = widen_compact_columns(joined_data)
+    joined_data = finish_layer_columns(joined_data, "second")
 
     # Step 12: Create a new GeoPackage for the second output
     print("Creating a new GeoPackage for the second output...")
-    with tempfile.NamedTemporaryFile(suffix=".gpkg", delete=False) as temp_file:
-        second_geopackage_path = (
-            temp_file.name
-        )  # Use tempfile for platform-independent path
-
     second_output_table_name = "joined_max_riverlines_second"
-    write_dataframe_to_geopackage(
-        joined_data, second_geopackage_path, second_output_table_name, False
+    second_geopackage_path = build_geopackage(
+        joined_data,
+        output_dir,
+        "second_join_geopackage.gpkg",
+        second_output_table_name,
+        False,
+        memory_budget,
+        **published,
     )
     print(f"Second GeoPackage created with table/layer '{second_output_table_name}'.")
 
-    # Step 13: Upload the second GeoPackage and update the second feature layer
-    print("Uploading the second GeoPackage and updating the second feature layer...")
-    second_feature_layer = Service(SECOND_FEATURE_LAYER_URL)
-    truncate_result = second_feature_layer.manager.truncate()
+    outputs["second"] = second_geopackage_path
+    outputs["extract"] = extract_geopackage_path
+
+    # Lighter versions of the second output on the generalized riverlines,
+    # one per configured scale band
+    if GENERALIZED_LAYER_URLS:
+        from generalize import generalized_layer_name, get_generalized_reference
+
+        generalized_path = get_generalized_reference(reference_local_path, s3_path)
+        for band in GENERALIZED_LAYER_URLS:
+            # Same attributes as the second output, generalized geometry
+            generalized = gpd.read_file(generalized_path, layer=generalized_layer_name(band))
+            joined_band = pd.DataFrame(
+                joined_data.drop(columns=joined_data.geometry.name)
+            ).merge(generalized[["Top_reach", "geometry"]], on="Top_reach")
+            band_path = build_geopackage(
+                gpd.GeoDataFrame(joined_band, geometry="geometry", crs=joined_data.crs),
+                output_dir,
+                f"second_join_geopackage_{band}.gpkg",
+                second_output_table_name,
+                False,
+                memory_budget,
+                **published,
+            )
+            print(
+                f"Generalized {band} GeoPackage created with {len(joined_band)} of "
+                f"{len(joined_data)} features "
+                f"({as_geopackage_output(band_path).size / 1e6:.1f} MB vs "
+                f"{as_geopackage_output(second_geopackage_path).size / 1e6:.1f} MB)."
+            )
+            outputs[f"second_{band}"] = band_path
+    return outputs
+
+
+def publish_geopackage(
+    gis, layer_url, geopackage_path, s3_bucket, s3_key, report=None, key=None
+):
+    """Truncate one hosted feature layer and append a GeoPackage to it.
+
+    With an UploadReport, the upload and append times are recorded under key.
+    Returns the uploaded temporary item.
+    """
+    from arcgis.layers import Service
+
+    if report is not None:
+        report.start(key)
+    # Truncate the feature layer before updating
+    print(f"Truncating the feature layer {layer_url}...")
+    feature_layer = Service(layer_url)
+    truncate_result = feature_layer.manager.truncate()
     if truncate_result["success"]:
-        print("Second Feature layer truncated successfully.")
+        print("Feature layer truncated successfully.")
     else:
-        print("Failed to truncate the second feature layer.")
-
-    # Step 14: Upload the second GeoPackage and update ArcGIS Online
-    print("Uploading the second GeoPackage and updating ArcGIS Online...")
-    # Call the function to upload the second GeoPackage and update the second feature layer
-    # root_folder = gis.content.folders.get()
-    # geopackage_item = upload_geopackage_to_arcgis(
-    second_geopackage_item = upload_geopackage_to_arcgis(
+        print("Failed to truncate the feature layer.")
+
+    # Call the function to upload the GeoPackage and update ArcGIS Online
+    geopackage_item = upload_geopackage_to_arcgis(
         gis,
-        second_geopackage_path,
+        geopackage_path,
         s3_bucket,
         s3_key,
-        second_feature_layer,
+        feature_layer,
         overwrite=False,
+        on_append=None if report is None else lambda result: report.track_append(key, result),
     )
+    print(
+        f"GeoPackage uploaded and ArcGIS Online updating. Item ID: {geopackage_item.id}"
+    )
+    return geopackage_item
+
+
+def time_slices(time_values, steps_per_slice):
+    """Split the sorted unique time steps into consecutive slices, nearest first."""
+    times = np.sort(pd.unique(time_values.dropna()))
+    return [
+        times[i : i + steps_per_slice] for i in range(0, len(times), steps_per_slice)
+    ]
+
+
+def publish_raw_layer_progressively(
+    gis,
+    layer_url,
+    cleaned_raw_data,
+    reference_local_path,
+    steps_per_slice,
+    max_appends=2,
+    output_dir=None,
+):
+    """Publish the first (raw) layer in time slices, starting with the nearest horizon.
 
+    The layer is truncated once; then every slice of steps_per_slice time
+    steps is written to its own GeoPackage, shrunk like the other published
+    GeoPackages (see upload_payload.py), uploaded and appended, so the first
+    hours are on the map long before the last slice is written. The next
+    slice is written while the current one uploads, and at most max_appends
+    append jobs run at the same time.
+
+    Returns the IDs of the uploaded temporary items.
+    """
+    output_dir = output_dir or tempfile.gettempdir()
+    started = time.perf_counter()
+    joined_raw_data = join_raw_riverlines(cleaned_raw_data, reference_local_path)
+    slices = time_slices(joined_raw_data["time_stamp_date"], steps_per_slice)
+    published = published_index_options()
     print(
-        "Second GeoPackage uploaded and ArcGIS Online updating. Item ID: {second_geopackage_item.id}"
+        f"Publishing {len(joined_raw_data)} rows in {len(slices)} time slices of "
+        f"{steps_per_slice} time steps (at most {max_appends} appends at a time)..."
     )
 
-    # Consolidate metadata for both GeoPackages into a single file
+    def write_slice(index):
+        rows = joined_raw_data["time_stamp_date"].isin(slices[index])
+        if index == len(slices) - 1:
+            # Rows without a time step go with the last slice
+            rows |= joined_raw_data["time_stamp_date"].isna()
+        path = os.path.join(output_dir, f"first_join_geopackage_slice_{index:03d}.gpkg")
+        write_dataframe_to_geopackage(
+            joined_raw_data[rows], path, RAW_LAYER_NAME, False, True, **published
+        )
+        payload, _ = optimize_upload_payload(path, output_dir=output_dir)
+        return path, payload
+
+    from arcgis.layers import Service
+
+    print(f"Truncating the feature layer {layer_url}...")
+    feature_layer = Service(layer_url)
+    if feature_layer.manager.truncate()["success"]:
+        print("Feature layer truncated successfully.")
+    else:
+        print("Failed to truncate the feature layer.")
+
+    item_ids = []
+    appends = []
+    appended_at = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as writer:
+        next_slice = writer.submit(write_slice, 0) if slices else None
+        for index in range(len(slices)):
+            path, payload = next_slice.result()
+            if index + 1 < len(slices):
+                next_slice = writer.submit(write_slice, index + 1)
+
+            item = add_geopackage_item(gis, payload)
+            item_ids.append(item.id)
+            # Bound the number of append jobs running on the hosted layer
+            running = [append for append in appends if not append.done()]
+            if len(running) >= max_appends:
+                concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+            result = feature_layer.append(
+                item_id=item.id, upload_format="geoPackage", upsert=False, future=True
+            )
+            if not isinstance(result, concurrent.futures.Future):
+                done = concurrent.futures.Future()
+                done.set_result(result)
+                result = done
+            result.add_done_callback(
+                lambda _, index=index: appended_at.setdefault(
+                    index, time.perf_counter() - started
+                )
+            )
+            appends.append(result)
+            print(
+                f"Slice {index + 1}/{len(slices)} ({slices[index][0]} - {slices[index][-1]}) "
+                f"uploaded as item {item.id}, append started."
+            )
+            payload.remove()
+            if os.path.exists(path):
+                os.remove(path)
+
+    for append in appends:
+        append.result()
+    if appended_at:
+        print(
+            f"First time slice appended after {appended_at.get(0, 0.0):.1f} s, all "
+            f"{len(slices)} slices after {max(appended_at.values()):.1f} s."
+        )
+    return item_ids
+
+
+# Output GeoPackage and target layer URL for each published layer, keyed like
+# the item metadata file
+PUBLISHED_LAYERS = {
+    "first_geopackage": ("first", HOSTED_FEATURE_LAYER_URL),
+    "second_geopackage": ("second", SECOND_FEATURE_LAYER_URL),
+    **{
+        f"second_geopackage_{band}": (f"second_{band}", layer_url)
+        for band, layer_url in GENERALIZED_LAYER_URLS.items()
+    },
+}
+
+
+def publish_geopackages(gis, outputs, s3_bucket, s3_key):
+    """Truncate both hosted feature layers and append the first and second GeoPackages.
+
+    Each GeoPackage is shrunk before the upload (see upload_payload.py).
+    Layers whose output is missing from outputs are skipped. Returns the
+    uploaded temporary item IDs keyed like the item metadata file.
+    """
+    item_ids = {}
+    report = UploadReport()
+    for key, (output_name, layer_url) in PUBLISHED_LAYERS.items():
+        if output_name not in outputs:
+            print(f"No {output_name} GeoPackage, skipping {key}.")
+            continue
+        # Step 11-14: Upload the GeoPackage and update ArcGIS Online
+        print(f"Uploading the {output_name} GeoPackage and updating ArcGIS Online...")
+        payload = report.optimize(key, outputs[output_name])
+        item = publish_geopackage(gis, layer_url, payload, s3_bucket, s3_key, report, key)
+        remove_payload(payload, outputs[output_name])
+        item_ids[key] = item.id
+    report.wait(append_wait_seconds())
+    report.report()
+    return item_ids
+
+
+def save_item_metadata(state_store, scope, run_id, item_ids, cleanup_result=None):
+    """Record the uploaded item IDs in the run state for the next run's cleanup.
+
+    cleanup_result is what finish_cleanup returned: the records consumed
+    by this run's cleanup are dropped in the same conditional write, and
+    the items it could not delete are kept as pending so a later cleanup
+    retries them.
+    """
+    cleanup_result = cleanup_result or {}
+    # Consolidate metadata for both GeoPackages into a single record
     metadata = {
-        "first_geopackage": {"item_id": geopackage_item.id},
-        "second_geopackage": {"item_id": second_geopackage_item.id},
+        key: {"item_ids": item_id} if isinstance(item_id, list) else {"item_id": item_id}
+        for key, item_id in item_ids.items()
     }
+    if cleanup_result.get("pending"):
+        metadata["pending"] = {"item_ids": list(cleanup_result["pending"])}
+
+    print(f"Saving the item IDs of run {run_id} to the run state of {scope}")
+    state_store.record_run(scope, run_id, metadata, cleanup_result.get("consumed"))
+    print("Item IDs saved to the run state successfully.")
+
+
+def connect_to_arcgis(password):
+    """Log in to ArcGIS Online."""
+    from arcgis.gis import GIS
+
+    print(f"Connecting to ArcGIS Online {AGOURL}")
+    gis = GIS(AGOURL, AGOUSERNAME, password)
+    print(f"Connected to ArcGIS Online {AGOURL}")
+    print(f"Feature Layer URL: {HOSTED_FEATURE_LAYER_URL}")
+    return gis
+
+
+def delete_previous_items(gis, state_store, scope, run_id, legacy_bucket=None):
+    """start_previous_items_cleanup, waiting for the deletions to finish."""
+    consumed, cleanup = start_previous_items_cleanup(
+        gis, state_store, scope, run_id, legacy_bucket
+    )
+    cleanup.result()
+    return consumed, cleanup
+
+
+def upload_extract_geopackage(s3_client, extract):
+    """Upload the extract GeoPackage to OUTPUT_S3_BUCKET for the second function."""
+    output_s3_bucket = os.environ.get(
+        "OUTPUT_S3_BUCKET"
+    )  # Set this env var in Lambda config
+    output_s3_key = os.environ.get("OUTPUT_S3_KEY")  # Set this env var in Lambda config
+    try:
+        print(
+            f"Uploading GeoPackage to S3 bucket: {output_s3_bucket}, key: {output_s3_key}"
+        )
+        as_geopackage_output(extract).upload_to_s3(
+            s3_client, output_s3_bucket, output_s3_key
+        )
+
+        print("GeoPackage uploaded to output S3 bucket successfully.")
+    except Exception as e:
+        print(f"Error uploading GeoPackage to output S3 bucket: {e}")
+
 
-    # Save the consolidated metadata to a single file
-    metadata_file = os.path.join(
-        tempfile.gettempdir(), f"consolidated_metadata_{uuid.uuid4().hex}.json"
+def run_stages(event, context, stages, checkpoint, deadline, s3_bucket, s3_key):
+    """The steps of lambda_handler for one NetCDF file, as stages of a StagePipeline.
+
+    The ArcGIS login, the cleanup of previous items and the reference
+    download start right away on worker threads and overlap with the
+    NetCDF decode; the extract upload overlaps with publishing.
+    """
+    from checkpoint import continue_in_new_invocation
+
+    s3_client = boto3.client("s3")
+    s3_path = f"s3://{s3_bucket}/{s3_key}"
+
+    stages.submit("ssm_password", get_agol_password)
+    stages.submit("gis_login", connect_to_arcgis, after=["ssm_password"])
+
+    # Step 1: Delete the previous temporary GPKG items from ArcGIS Online, off
+    # the critical path; finish_cleanup waits for it before the handler returns.
+    # The item IDs are kept per run in the run state store, scoped by input key
+    state_store = open_state_store()
+    if not checkpoint.is_done("cleanup"):
+        stages.submit(
+            "cleanup",
+            lambda gis: delete_previous_items(
+                gis, state_store, s3_key, checkpoint.run_id, legacy_bucket=s3_bucket
+            ),
+            after=["gis_login"],
+        )
+        if os.environ.get("CLEANUP_MODE", "background") == "inline":
+            stages.result("cleanup")
+
+    def cleanup_result():
+        cleanup = stages.result("cleanup") if "cleanup" in stages else None
+        return finish_cleanup(cleanup, checkpoint)
+
+    # Step 8: Retrieve the reference GeoPackage from S3 and save it under a distinct name
+    stages.submit("reference_download", lambda: download_reference_geopackage(s3_client))
+
+    if checkpoint.is_done("geopackages"):
+        outputs = stages.run(
+            "geopackages",
+            lambda: checkpoint.load_files("geopackages", checkpoint.result("geopackages")),
+        )
+    else:
+        # Step 2-7: Process, aggregate and clean the NetCDF file
+        if checkpoint.is_done("frames"):
+            frames = stages.run(
+                "frames", lambda: checkpoint.load_frames("frames", ["raw", "aggregated"])
+            )
+            cleaned_raw_data, cleaned_data = frames["raw"], frames["aggregated"]
+        else:
+            print("Processing NetCDF file...")
+            cleaned_raw_data, cleaned_data = stages.run(
+                "frames", lambda: build_output_frames(s3_path)
+            )
+            checkpoint.save_frames(
+                "frames", {"raw": cleaned_raw_data, "aggregated": cleaned_data}
+            )
+            checkpoint.mark_done("frames")
+            if checkpoint.enabled and deadline.should_continue_elsewhere():
+                cleanup_result()
+                return continue_in_new_invocation(event, context, checkpoint)
+
+        # With PROGRESSIVE_SLICE_STEPS set, the raw layer is published first,
+        # in time slices, instead of as one first GeoPackage at the end
+        progressive_steps = int(os.environ.get("PROGRESSIVE_SLICE_STEPS", "0"))
+        if progressive_steps > 0 and not checkpoint.is_done("first_geopackage"):
+            checkpoint.mark_done(
+                "first_geopackage",
+                stages.run(
+                    "first_geopackage",
+                    lambda gis, reference_local_path: publish_raw_layer_progressively(
+                        gis,
+                        HOSTED_FEATURE_LAYER_URL,
+                        cleaned_raw_data,
+                        reference_local_path,
+                        progressive_steps,
+                        int(os.environ.get("PROGRESSIVE_MAX_APPENDS", "2")),
+                    ),
+                    after=["gis_login", "reference_download"],
+                ),
+            )
+
+        # Step 9-12: Join onto the riverlines and write the output GeoPackages
+        # With GEOPACKAGE_MEMORY_BUDGET_MB set they are built in memory and
+        # uploaded from there, without a round trip through /tmp
+        outputs = stages.run(
+            "geopackages",
+            lambda reference_local_path: write_output_geopackages(
+                s3_path,
+                cleaned_raw_data,
+                cleaned_data,
+                reference_local_path,
+                include_first=progressive_steps <= 0,
+                memory_budget=memory_budget_bytes(),
+            ),
+            after=["reference_download"],
+        )
+        checkpoint.save_files("geopackages", outputs)
+        checkpoint.mark_done(
+            "geopackages",
+            {name: as_geopackage_output(output).name for name, output in outputs.items()},
+        )
+
+    # Step 11: Upload the extract GeoPackage to an output S3 bucket, while
+    # the feature layers are published
+    if not checkpoint.is_done("extract_upload"):
+        stages.submit(
+            "extract_upload",
+            lambda _: upload_extract_geopackage(s3_client, outputs["extract"]),
+            after=["geopackages"],
+        )
+
+    def finish_extract_upload():
+        if "extract_upload" in stages and not checkpoint.is_done("extract_upload"):
+            stages.result("extract_upload")
+            checkpoint.mark_done("extract_upload")
+
+    # Layers whose output is missing (e.g. a band added since the checkpoint)
+    # are skipped, as in publish_geopackages
+    pending_layers = {}
+    for key, (output_name, layer_url) in PUBLISHED_LAYERS.items():
+        if checkpoint.is_done(key):
+            continue
+        if output_name not in outputs:
+            print(f"No {output_name} GeoPackage, skipping {key}.")
+            continue
+        pending_layers[key] = (output_name, layer_url)
+
+    # Shrink the published GeoPackages one after the other on a worker
+    # thread, so the next layer is optimized while the previous one uploads
+    upload_report = UploadReport()
+    previous = "geopackages"
+    for key, (output_name, _) in pending_layers.items():
+        stages.submit(
+            f"optimize_{key}",
+            lambda _, key=key, output_name=output_name: upload_report.optimize(
+                key, outputs[output_name]
+            ),
+            after=[previous],
+        )
+        previous = f"optimize_{key}"
+
+    # Step 11-14: Upload both GeoPackages and update the hosted feature layers
+    item_ids = {}
+    for key, (output_name, layer_url) in PUBLISHED_LAYERS.items():
+        if checkpoint.is_done(key):
+            item_ids[key] = checkpoint.result(key)
+            continue
+        if key not in pending_layers:
+            continue
+        if checkpoint.enabled and deadline.should_continue_elsewhere():
+            finish_extract_upload()
+            cleanup_result()
+            return continue_in_new_invocation(event, context, checkpoint)
+        print(f"Uploading the {output_name} GeoPackage and updating ArcGIS Online...")
+        item = stages.run(
+            f"publish_{key}",
+            lambda gis, payload, key=key, layer_url=layer_url: publish_geopackage(
+                gis, layer_url, payload, s3_bucket, s3_key, upload_report, key
+            ),
+            after=["gis_login", f"optimize_{key}"],
+        )
+        remove_payload(stages.result(f"optimize_{key}"), outputs[output_name])
+        item_ids[key] = item.id
+        checkpoint.mark_done(key, item.id)
+
+    finish_extract_upload()
+    stages.run(
+        "save_item_metadata",
+        lambda: save_item_metadata(
+            state_store, s3_key, checkpoint.run_id, item_ids, cleanup_result()
+        ),
     )
-    with open(metadata_file, "w") as f:
-        json.dump(metadata, f)
 
-    # Update the S3 metadata key to use the NetCDF file's S3 key combined with a simple file name
-    metadata_file_name = "item_metadata.json"
-    s3_metadata_key = f"{s3_key}/{metadata_file_name}"
-    print(f"Uploading consolidated metadata file to S3: {s3_metadata_key}")
-    s3_client.upload_file(metadata_file, s3_bucket, s3_metadata_key)
-    print("Consolidated metadata file uploaded to S3 successfully.")
+    # Time the append jobs for the upload report, within the time left
+    wait_seconds = append_wait_seconds()
+    remaining_ms = deadline.remaining_ms()
+    if remaining_ms is not None:
+        wait_seconds = min(wait_seconds, max(0, remaining_ms - deadline.min_remaining_ms) / 1000)
+    stages.run("appends", lambda: upload_report.wait(wait_seconds))
+    upload_report.report()
+    checkpoint.clear()
 
     return {
         "statusCode": 200,
@@ -796,6 +1819,53 @@ def lambda_handler(event, context):
     }
 
 
+# lambda_handler function
+
+def lambda_handler(event, context):
+    # Enable logging for ArcGIS API
+    logging.basicConfig(level=logging.INFO)
+
+    # Shard worker invocations only run the transform for their reach range
+    if "shard" in event:
+        from sharding import shard_worker_handler
+
+        return shard_worker_handler(event, context)
+
+    # Scheduled sweeps only delete the recorded temporary items
+    if "cleanup_sweep" in event:
+        from cleanup import sweeper_handler
+
+        return sweeper_handler(event, context)
+
+    # Step 0: Read the NetCDF file from S3
+    print("Reading NetCDF file from S3...")
+
+    # Get the bucket name and object key from the event
+    s3_bucket = event["Records"][0]["s3"]["bucket"]["name"]
+    s3_key = event["Records"][0]["s3"]["object"]["key"]
+
+    print(f"S3 bucket: {s3_bucket}")
+    print(f"S3 key: {s3_key}")
+
+    # Stage checkpoints let a run that is about to hit the Lambda timeout
+    # continue in a new invocation instead of starting from scratch
+    from checkpoint import DeadlineGuard, RunCheckpoint
+
+    checkpoint = RunCheckpoint.from_event(event)
+    deadline = DeadlineGuard(context)
+
+    # Network steps run on worker threads as soon as their inputs are ready,
+    # next to the CPU-bound steps on this thread (see stages.py)
+    stages = StagePipeline(int(os.environ.get("STAGE_WORKERS", "4")))
+    try:
+        return run_stages(event, context, stages, checkpoint, deadline, s3_bucket, s3_key)
+    finally:
+        # Nothing may still run once the handler returns: the execution
+        # environment is frozen until the next invocation
+        stages.close()
+        stages.report()
+
+
 # # Uncomment the following lines to test the function locally
 
 # if __name__ == "__main__":
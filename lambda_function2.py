@@ -5,6 +5,56 @@ import boto3
 import geopandas as gpd
 import pandas as pd
 
+from gpkg_memory import GeoPackageOutput, memory_budget_bytes
+from reference_store import open_reference_store
+
+
+def download_geopackage(s3, bucket, key):
+    """Fetch a GeoPackage from S3, in memory within GEOPACKAGE_MEMORY_BUDGET_MB."""
+    import botocore
+
+    try:
+        return GeoPackageOutput.from_s3(s3, bucket, key, memory_budget_bytes())
+    except botocore.exceptions.ClientError as e:
+        error_code = e.response.get("Error", {}).get("Code", "")
+        if error_code == "404" or error_code == "NoSuchKey":
+            raise FileNotFoundError(
+                f"GeoPackage not found in S3 bucket '{bucket}' "
+                f"with key '{key}'. Check that the file exists "
+                "and the key is correct."
+            )
+        else:
+            raise
+
+
+def download_reference_store(s3, bucket, key):
+    """Fetch a reference store into /tmp unless an earlier run already did."""
+    path = os.path.join(tempfile.gettempdir(), os.path.basename(key))
+    if not os.path.exists(path):
+        s3.download_file(bucket, key, path)
+    return path
+
+
+def model_query(conn, table, window):
+    """SQL and parameters reading the model rows above a threshold.
+
+    Extracts computed with EXCEEDANCE_WINDOWS hold one row per reach,
+    threshold and time window; of those only the rows of window are read.
+    """
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info("{table}")')}
+    if "timewindow" not in columns:
+        return f"SELECT * FROM {table} WHERE sum_bool_value_thsh > 0", ()
+    windows = [row[0] for row in conn.execute(f'SELECT DISTINCT timewindow FROM "{table}"')]
+    if window not in windows:
+        raise ValueError(
+            f"Time window '{window}' not in the extract (windows: {', '.join(windows)}); "
+            "set EXCEEDANCE_WINDOW to one of them."
+        )
+    return (
+        f"SELECT * FROM {table} WHERE sum_bool_value_thsh > 0 AND timewindow = ?",
+        (window,),
+    )
+
 
 def lambda_handler(event, context, retain_temp_gpkg=False):
     """
@@ -30,72 +80,41 @@ def lambda_handler(event, context, retain_temp_gpkg=False):
     MODEL_TABLE = os.environ.get("MODEL_TABLE", "data")
     # Name of lookup table in GPKG
     LOOKUP_TABLE = os.environ.get("LOOKUP_TABLE", "lookup")
+    # Time window of extracts with several (EXCEEDANCE_WINDOWS in stage 1)
+    EXCEEDANCE_WINDOW = os.environ.get("EXCEEDANCE_WINDOW", "0-48")
     INPUT_S3_KEY = os.environ.get("INPUT_S3_KEY")
+    # Riverlines layer converted with reference_store.py (optional)
+    RIVERLINES_STORE_S3_KEY = os.environ.get("RIVERLINES_STORE_S3_KEY")
     FINAL_OUTPUT_KEY = os.environ.get(
         "FINAL_OUTPUT_KEY", "geopackages/final_output.gpkg"
     )
 
     s3 = boto3.client("s3")
 
-    # Download GeoPackage from S3 to /tmp
-    import botocore
-    import sqlite3
-    
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".gpkg", delete=False) as tmp_file:
-            s3.download_fileobj(
-                OUTPUT_S3_BUCKET, OUTPUT_S3_KEY, tmp_file
-            )
-            gpkg_path = tmp_file.name
-    except botocore.exceptions.ClientError as e:
-        error_code = e.response.get("Error", {}).get("Code", "")
-        if error_code == "404" or error_code == "NoSuchKey":
-            raise FileNotFoundError(
-                f"GeoPackage not found in S3 bucket '{OUTPUT_S3_BUCKET}' "
-                f"with key '{OUTPUT_S3_KEY}'. Check that the file exists "
-                "and the key is correct."
-            )
-        else:
-            raise
-
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".gpkg", delete=False) as tmp_file_extract:
-            s3.download_fileobj(
-                OUTPUT_S3_BUCKET, INPUT_S3_KEY, tmp_file_extract
-            )
-            gpkg_path_extract = tmp_file_extract.name
-    except botocore.exceptions.ClientError as e:
-        error_code = e.response.get("Error", {}).get("Code", "")
-        if error_code == "404" or error_code == "NoSuchKey":
-            raise FileNotFoundError(
-                f"GeoPackage not found in S3 bucket '{OUTPUT_S3_BUCKET}' "
-                f"with key '{INPUT_S3_KEY}'. Check that the file exists "
-                "and the key is correct."
-            )
-        else:
-            raise
+    # Download the GeoPackages from S3, into memory when they fit the
+    # budget, else to /tmp
+    gpkg = download_geopackage(s3, OUTPUT_S3_BUCKET, OUTPUT_S3_KEY)
+    gpkg_extract = download_geopackage(s3, OUTPUT_S3_BUCKET, INPUT_S3_KEY)
 
     # Load tables/layers
     # Load tables/layers using sqlite3 for non-spatial tables
-    conn = sqlite3.connect(gpkg_path)
-    conn2 = sqlite3.connect(gpkg_path_extract)
-    
+    conn = gpkg.connect()
+    conn2 = gpkg_extract.connect()
+    # Only reaches above a threshold are kept below, so filter in SQLite
+    query, params = model_query(conn2, MODEL_TABLE, EXCEEDANCE_WINDOW)
+
     try:
-        df_model = pd.read_sql_query(f"SELECT * FROM {MODEL_TABLE}", conn2)
+        df_model = pd.read_sql_query(query, conn2, params=params)
         df_lookup = pd.read_sql_query(f"SELECT * FROM {LOOKUP_TABLE}", conn)
     except Exception:
         # If lookup is a layer, try geopandas
-        df_model = gpd.read_file(gpkg_path_extract, layer=MODEL_TABLE)
-        df_lookup = gpd.read_file(gpkg_path, layer=LOOKUP_TABLE)
+        df_model = gpd.read_file(gpkg_extract.source(), layer=MODEL_TABLE)
+        if "timewindow" in df_model.columns:
+            df_model = df_model[df_model["timewindow"] == EXCEEDANCE_WINDOW]
+        df_lookup = gpd.read_file(gpkg.source(), layer=LOOKUP_TABLE)
     
     conn.close()
     conn2.close()
-    # read riverlines
-    gdf_riverlines = gpd.read_file(gpkg_path, layer=RIVERLINES_LAYER)
-
-    # Ensure geometry column is named 'Shape' for SQL logic compatibility
-    if "geometry" in gdf_riverlines.columns:
-        gdf_riverlines = gdf_riverlines.rename(columns={"geometry": "Shape"})
 
     # 1. Merge and filter
     df_bools = pd.merge(
@@ -114,6 +133,19 @@ def lambda_handler(event, context, retain_temp_gpkg=False):
         ["OBJECTID", "rchid", "nrthresholds", "sum_bool_value_thsh"]
     ]
 
+    # read riverlines; from the reference store only the reaches joined below
+    if RIVERLINES_STORE_S3_KEY:
+        store = open_reference_store(
+            download_reference_store(s3, OUTPUT_S3_BUCKET, RIVERLINES_STORE_S3_KEY)
+        )
+        gdf_riverlines = store.layer(RIVERLINES_LAYER).frame(df_bools["rchid"])
+    else:
+        gdf_riverlines = gpd.read_file(gpkg.source(), layer=RIVERLINES_LAYER)
+
+    # Ensure geometry column is named 'Shape' for SQL logic compatibility
+    if "geometry" in gdf_riverlines.columns:
+        gdf_riverlines = gdf_riverlines.rename(columns={"geometry": "Shape"})
+
     # 2. Merge with spatial layer
     gdf_max_sum = pd.merge(
         df_bools, gdf_riverlines, left_on="rchid", right_on="Top_reach", how="inner"
@@ -164,13 +196,14 @@ def lambda_handler(event, context, retain_temp_gpkg=False):
         crs_to_use = None
     gdf_final = gpd.GeoDataFrame(gdf_final, geometry="Shape", crs=crs_to_use)
 
-    # Write final output to GeoPackage in /tmp
-    final_gpkg_path = os.path.join(tempfile.gettempdir(), "final_output.gpkg")
-    gdf_final.to_file(final_gpkg_path, layer="final_layer", driver="GPKG")
+    # Write final output to GeoPackage, in memory or in /tmp, with the
+    # spatial index and an index on rchid (GEOPACKAGE_INDEX_COLUMNS)
+    final_gpkg = GeoPackageOutput.from_frame(
+        gdf_final, "final_output.gpkg", "final_layer", memory_budget_bytes()
+    )
 
     # Upload final GeoPackage to S3
-    with open(final_gpkg_path, "rb") as f:
-        s3.upload_fileobj(f, OUTPUT_S3_BUCKET, FINAL_OUTPUT_KEY)
+    final_gpkg.upload_to_s3(s3, OUTPUT_S3_BUCKET, FINAL_OUTPUT_KEY)
 
     # === ArcGIS Online Upload and Feature Layer Update ===
     import time
@@ -183,10 +216,6 @@ def lambda_handler(event, context, retain_temp_gpkg=False):
     AGOUSERNAME = os.environ["AGOUSERNAME"]
     AGOPASSWORD_PARAM = os.environ["AGOPASSWORD"]
     HOSTED_FEATURE_LAYER_URL = os.environ["HOSTED_FEATURE_LAYER_URL"]
-    TEMP_ITEM_ID_S3_KEY = os.environ.get(
-        "TEMP_ITEM_ID_S3_KEY", "geopackages/last_temp_item_id.txt"
-    )
-
     # Retrieve AGOPASSWORD from SSM
     ssm_client = boto3.client("ssm")
     response = ssm_client.get_parameter(Name=AGOPASSWORD_PARAM, WithDecryption=True)
@@ -196,49 +225,70 @@ def lambda_handler(event, context, retain_temp_gpkg=False):
     gis = GIS(AGOURL, AGOUSERNAME, AGOPASSWORD)
     feature_layer = FeatureLayer(HOSTED_FEATURE_LAYER_URL, gis=gis)
 
-    # Delete previous temporary item if exists
+    # Delete the temporary items left by earlier runs in batches on a
+    # background thread while the new GeoPackage uploads; their IDs are kept
+    # per run in the run state store (see run_state.py)
+    from cleanup import ItemCleaner, item_ids_from_metadata, start_cleanup
+    from run_state import import_legacy_s3_record, open_state_store
+
+    state_store = open_state_store()
+    run_id = uuid.uuid4().hex
     try:
-        temp_item_id = None
-        try:
-            temp_item_id_obj = s3.get_object(
-                Bucket=OUTPUT_S3_BUCKET, Key=TEMP_ITEM_ID_S3_KEY
-            )
-            temp_item_id = temp_item_id_obj["Body"].read().decode("utf-8").strip()
-        except Exception:
-            temp_item_id = None
-        if temp_item_id:
-            print("Deleting previous temporary ArcGIS Online item: " f"{temp_item_id}")
-            try:
-                item = gis.content.get(temp_item_id)
-                if item:
-                    item.delete()
-                    print("Previous temporary item deleted.")
-            except Exception as e:
-                print(f"Error deleting previous item: {e}")
+        # The item ID an earlier version kept on S3 is imported once
+        previous_runs = import_legacy_s3_record(
+            state_store,
+            FINAL_OUTPUT_KEY,
+            OUTPUT_S3_BUCKET,
+            os.environ.get("TEMP_ITEM_ID_S3_KEY", "geopackages/last_temp_item_id.txt"),
+            lambda text: {"final_geopackage": {"item_id": text.strip()}} if text.strip() else {},
+            s3,
+        )
     except Exception as e:
-        print(f"Error checking for previous temp item: {e}")
+        print(f"Error checking for previous temp items: {e}")
+        previous_runs = {}
+    previous_item_ids = [
+        item_id
+        for record in previous_runs.values()
+        for item_id in item_ids_from_metadata(record["items"])
+    ]
+    print(f"Deleting {len(previous_item_ids)} previous temporary ArcGIS Online items...")
+    cleanup = start_cleanup(ItemCleaner.from_gis(gis), previous_item_ids)
 
     # Upload new GeoPackage as an item
     print("Uploading new GeoPackage to ArcGIS Online...")
     unique_title = f"temp_data_upload_{uuid.uuid4().hex}"
-    geopackage_item = gis.content.add(
-        {
-            "title": unique_title,
-            "type": "GeoPackage",
-            "tags": "data upload, automation",
-            "description": (
-                "Temporary GeoPackage file for updating a " "hosted feature layer."
-            ),
-        },
-        data=final_gpkg_path,
-    )
+    item_properties = {
+        "title": unique_title,
+        "type": "GeoPackage",
+        "tags": "data upload, automation",
+        "description": (
+            "Temporary GeoPackage file for updating a " "hosted feature layer."
+        ),
+    }
+    if final_gpkg.in_memory:
+        # gis.content.add needs a file; send the bytes as a multipart upload
+        from chunked_upload import ChunkedUploader
+
+        geopackage_item = gis.content.get(
+            ChunkedUploader.from_gis(gis).upload(
+                final_gpkg.name, item_properties, data=final_gpkg.data
+            )
+        )
+    else:
+        geopackage_item = gis.content.add(item_properties, data=final_gpkg.path)
     print(f"GeoPackage uploaded. Item ID: {geopackage_item.id}")
 
-    # Save new item ID to S3 for next run's cleanup
-    s3.put_object(
-        Bucket=OUTPUT_S3_BUCKET,
-        Key=TEMP_ITEM_ID_S3_KEY,
-        Body=geopackage_item.id.encode("utf-8"),
+    # Items the cleanup could not delete stay in the run state
+    pending_item_ids = cleanup.result()
+    pending = {"pending": {"item_ids": pending_item_ids}} if pending_item_ids else {}
+
+    # Save new item ID to the run state for next run's cleanup, dropping the
+    # records cleaned up above in the same conditional write
+    run_version = state_store.record_run(
+        FINAL_OUTPUT_KEY,
+        run_id,
+        {"final_geopackage": {"item_id": geopackage_item.id}, **pending},
+        {other: record["version"] for other, record in previous_runs.items()},
     )
 
     # Truncate the feature layer
@@ -270,14 +320,16 @@ def lambda_handler(event, context, retain_temp_gpkg=False):
     # Delete the temporary ArcGIS Online item
     geopackage_item.delete()
     print("Temporary GeoPackage item deleted from ArcGIS Online.")
+    # Only items that could not be deleted need to stay in the run state
+    state_store.record_run(FINAL_OUTPUT_KEY, run_id, pending, own_version=run_version)
 
     # After uploading final GeoPackage to S3, clean up temp files unless retaining
     if not retain_temp_gpkg:
-        for f in [gpkg_path, gpkg_path_extract, final_gpkg_path]:
+        for output in [gpkg, gpkg_extract, final_gpkg]:
             try:
-                os.remove(f)
+                output.remove()
             except Exception as e:
-                print(f"Could not remove {f}: {e}")
+                print(f"Could not remove {output.name}: {e}")
 
     return {
         "statusCode": 200,
@@ -305,8 +357,8 @@ def lambda_handler(event, context, retain_temp_gpkg=False):
 #     os.environ["HOSTED_FEATURE_LAYER_URL"] = (
 #         "https://services3.arcgis.com/XXXXX/arcgis/rest/services/final_output/FeatureServer/0"
 #     )
-#     # Optionally set TEMP_ITEM_ID_S3_KEY if you want to test item cleanup
-#     # os.environ["TEMP_ITEM_ID_S3_KEY"] = "geopackages/last_temp_item_id.txt"
+#     # Optionally set RUN_STATE_DB if you want to test item cleanup
+#     # os.environ["RUN_STATE_DB"] = "/tmp/run_state.sqlite"
 
 #     # Simulate a Lambda event (edit as needed)
 #     event = {}
@@ -0,0 +1,204 @@
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import s3fs
+from netCDF4 import Dataset
+
+# CF calendars that are the proleptic Gregorian calendar numpy uses (for
+# "standard", only from the Gregorian reform on)
+STANDARD_CALENDARS = {"standard", "gregorian", "proleptic_gregorian"}
+GREGORIAN_REFORM = np.datetime64("1582-10-15", "us")
+# The same and the datetime64[ns] bounds as microseconds since 1970
+_GREGORIAN_REFORM_MICROS = GREGORIAN_REFORM.astype("int64")
+_MIN_MICROS = pd.Timestamp.min.value // 1000 + 1
+_MAX_MICROS = pd.Timestamp.max.value // 1000
+# Microseconds per CF time unit
+_UNIT_MICROSECONDS = {
+    **dict.fromkeys(["microseconds", "microsecond", "us"], 1),
+    **dict.fromkeys(["milliseconds", "millisecond", "msec", "msecs", "ms"], 1000),
+    **dict.fromkeys(["seconds", "second", "sec", "secs", "s"], 1000000),
+    **dict.fromkeys(["minutes", "minute", "min", "mins"], 60000000),
+    **dict.fromkeys(["hours", "hour", "hr", "hrs", "h"], 3600000000),
+    **dict.fromkeys(["days", "day", "d"], 86400000000),
+}
+
+
+def localize_netcdf(path):
+    """Return a local path for the NetCDF file, downloading s3:// URLs to the temp dir once."""
+    if not path.startswith("s3://"):
+        return path
+    local_path = os.path.join(
+        tempfile.gettempdir(), f"decode_{uuid.uuid4().hex}_{os.path.basename(path)}"
+    )
+    fs = s3fs.S3FileSystem()
+    fs.get(path, local_path)
+    return local_path
+
+
+def decode_cf_times(values, units, calendar="standard"):
+    """Decode CF time values ("<unit> since <date>") into a datetime64[ns] array.
+
+    Vectorized equivalent of num2date for the standard calendars: times are
+    rounded to the microsecond like cftime and then truncated to whole
+    seconds like convert_to_datetime. Masked values become NaT. Returns None
+    for units, calendars or dates only cftime handles. Raises
+    pandas.errors.OutOfBoundsDatetime for times outside the datetime64[ns]
+    range (years 1677 to 2262) instead of letting them wrap around.
+    """
+    if str(calendar).lower() not in STANDARD_CALENDARS:
+        return None
+    unit, _, reference = str(units).partition(" since ")
+    unit_microseconds = _UNIT_MICROSECONDS.get(unit.strip().lower())
+    if unit_microseconds is None or not reference.strip():
+        return None
+    try:
+        reference = pd.Timestamp(reference.strip())
+    except ValueError:
+        return None
+    if reference.tzinfo is not None:
+        reference = reference.tz_convert("UTC").tz_localize(None)
+
+    invalid = np.ma.getmaskarray(values)
+    offsets = np.ma.getdata(values).astype("float64") * unit_microseconds
+    invalid = invalid | ~np.isfinite(offsets)
+    reference_micros = reference.to_datetime64().astype("datetime64[us]").astype("int64")
+    # Compared in float first, so offsets too large for int64 cannot wrap
+    valid_micros = offsets[~invalid] + reference_micros
+    if valid_micros.min(initial=_GREGORIAN_REFORM_MICROS) < _GREGORIAN_REFORM_MICROS:
+        return None
+    if valid_micros.size and (
+        valid_micros.min() < _MIN_MICROS or valid_micros.max() > _MAX_MICROS
+    ):
+        raise pd.errors.OutOfBoundsDatetime(
+            f"Times in {units} fall outside the datetime64[ns] range "
+            f"({pd.Timestamp.min} to {pd.Timestamp.max})."
+        )
+    micros = np.round(np.where(invalid, 0, offsets)).astype("int64") + reference_micros
+    micros -= micros % 1000000
+    times = micros.astype("datetime64[us]").astype("datetime64[ns]")
+    times[invalid] = np.datetime64("NaT")
+    return times
+
+
+def buffer_dir():
+    """Directory for the decode buffers: tmpfs /dev/shm if available (not on Lambda), else the temp dir."""
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def decoded_dtype(variable):
+    """dtype of a variable after netCDF4 applies scale/offset and fill-value masking."""
+    if hasattr(variable, "scale_factor") or hasattr(variable, "add_offset"):
+        return np.dtype("float64")
+    if np.issubdtype(variable.dtype, np.floating):
+        return np.dtype(variable.dtype)
+    # Integer data can only hold masked cells as NaN once widened to float
+    return np.dtype("float64")
+
+
+def _reach_index(variable, reach_range):
+    """Index tuple selecting reach_range along the nrch axis of a variable."""
+    index = [slice(None)] * variable.ndim
+    if reach_range and "nrch" in variable.dimensions:
+        index[variable.dimensions.index("nrch")] = slice(*reach_range)
+    return tuple(index)
+
+
+def _decode_worker(path, tasks, reach_range, conn):
+    """Decode a group of variables into their memory-mapped output buffers."""
+    try:
+        dataset = Dataset(path, mode="r")
+        timings = {}
+        for name, buffer_path, dtype, shape in tasks:
+            start = time.perf_counter()
+            variable = dataset.variables[name]
+            values = variable[_reach_index(variable, reach_range)]
+            out = np.memmap(buffer_path, dtype=dtype, mode="r+", shape=shape)
+            out[...] = np.ma.filled(np.ma.asarray(values, dtype=dtype), np.nan)
+            out.flush()
+            del out
+            timings[name] = time.perf_counter() - start
+        dataset.close()
+        conn.send(("ok", timings))
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def decode_variables_parallel(path, names, reach_range=None, max_workers=None):
+    """Decode NetCDF variables across processes into zero-copy memory-mapped arrays.
+
+    Each worker process opens the file itself, so zlib/HDF5 decompression runs
+    on separate cores, and writes straight into a memory-mapped buffer that the
+    caller then maps without copying. Masked cells come back as NaN, like
+    float() on a masked element. Uses plain Process/Pipe and file-backed
+    buffers because Lambda has no /dev/shm for multiprocessing pools or
+    shared_memory.
+
+    Returns ({name: ndarray}, {name: seconds spent decoding}).
+    """
+    max_workers = max(1, min(max_workers or os.cpu_count(), len(names)))
+
+    dataset = Dataset(path, mode="r")
+    tasks = []
+    for name in names:
+        if name not in dataset.variables:
+            dataset.close()
+            raise KeyError(f"Variable '{name}' not found in the NetCDF file.")
+        variable = dataset.variables[name]
+        shape = tuple(
+            len(range(*slice(*reach_range).indices(size)))
+            if reach_range and dim == "nrch"
+            else size
+            for dim, size in zip(variable.dimensions, variable.shape)
+        )
+        buffer_path = os.path.join(buffer_dir(), f"decode_{uuid.uuid4().hex}_{name}.bin")
+        dtype = decoded_dtype(variable)
+        # Allocate the (sparse) output file before the workers map it
+        np.memmap(buffer_path, dtype=dtype, mode="w+", shape=shape).flush()
+        tasks.append((name, buffer_path, dtype, shape))
+    dataset.close()
+
+    # Largest variables first, dealt round-robin so the groups stay balanced
+    ordered = sorted(tasks, key=lambda task: -int(np.prod(task[3])))
+    groups = [ordered[i::max_workers] for i in range(max_workers)]
+
+    processes = []
+    for group in groups:
+        parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_decode_worker, args=(path, group, reach_range, child_conn)
+        )
+        process.start()
+        child_conn.close()
+        processes.append((process, parent_conn))
+
+    timings = {}
+    errors = []
+    for process, parent_conn in processes:
+        try:
+            status, payload = parent_conn.recv()
+        except EOFError:
+            status, payload = "error", "decode worker exited without a result"
+        process.join()
+        if status == "ok":
+            timings.update(payload)
+        else:
+            errors.append(payload)
+
+    arrays = {}
+    for name, buffer_path, dtype, shape in tasks:
+        if not errors:
+            arrays[name] = np.memmap(buffer_path, dtype=dtype, mode="r+", shape=shape)
+        # The mapping stays valid after unlinking; the file is freed with the array
+        os.remove(buffer_path)
+    if errors:
+        raise RuntimeError(f"Parallel NetCDF decode failed: {'; '.join(errors)}")
+    return arrays, timings
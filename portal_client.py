@@ -0,0 +1,80 @@
+import random
+import time
+
+import requests
+
+
+class PortalError(Exception):
+    """Raised when the portal rejects a request or it keeps failing."""
+
+
+class PortalClient:
+    """Minimal ArcGIS Online / Portal REST client with retries.
+
+    Transient failures (connection errors, HTTP 5xx and 429, server errors in
+    the JSON response) are retried with exponential backoff and jitter;
+    requests the portal rejects as invalid (other HTTP 4xx, error codes 400,
+    403, 404) fail at once. Failures are raised as error_class.
+    """
+
+    error_class = PortalError
+
+    def __init__(
+        self,
+        portal_url,
+        username,
+        token,
+        max_retries=5,
+        backoff_seconds=1.0,
+        session=None,
+    ):
+        self.rest_url = portal_url.rstrip("/")
+        if not self.rest_url.endswith("/sharing/rest"):
+            self.rest_url += "/sharing/rest"
+        self.username = username
+        self.token = token
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.session = session or requests.Session()
+
+    @classmethod
+    def from_gis(cls, gis, **kwargs):
+        """Build a client from a logged-in arcgis.gis.GIS connection."""
+        return cls(gis.url, gis.users.me.username, gis._con.token, **kwargs)
+
+    def _user_url(self, path):
+        return f"{self.rest_url}/content/users/{self.username}/{path}"
+
+    def _request(self, method, url, data=None, files=None):
+        """One REST call with retries; returns the decoded JSON response."""
+        params = {"f": "json", "token": self.token}
+        for attempt in range(self.max_retries + 1):
+            try:
+                if method == "GET":
+                    response = self.session.get(url, params=params, timeout=60)
+                else:
+                    response = self.session.post(
+                        url, data={**params, **(data or {})}, files=files, timeout=300
+                    )
+                if 400 <= response.status_code < 500 and response.status_code != 429:
+                    raise self.error_class(
+                        f"{url}: HTTP {response.status_code} {response.text[:200]}"
+                    )
+                response.raise_for_status()
+                result = response.json()
+                if "error" in result:
+                    error = result["error"]
+                    if isinstance(error, dict) and error.get("code") in (400, 403, 404):
+                        raise self.error_class(f"{url}: {error}")
+                    raise ValueError(f"{url}: {error}")
+                return result
+            except PortalError:
+                raise
+            except (requests.RequestException, ValueError) as e:
+                if attempt == self.max_retries:
+                    raise self.error_class(
+                        f"{url} failed after {self.max_retries + 1} attempts: {e}"
+                    ) from e
+                delay = self.backoff_seconds * 2**attempt * (0.5 + random.random())
+                print(f"Request to {url} failed ({e}), retrying in {delay:.1f} s...")
+                time.sleep(delay)
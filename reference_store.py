@@ -0,0 +1,251 @@
+"""
+Memory-mappable store of the reference riverlines, built once from the
+reference GeoPackage.
+
+Example:
+    python reference_store.py ./a_gpkg.gpkg ./a_gpkg.refstore
+
+Each layer is kept as plain arrays in a single file: the Top_reach keys
+sorted (with the row each key belongs to), the WKB geometries in one
+contiguous buffer with their offsets, and one array per attribute column.
+Opening the store maps the file without parsing anything; a join looks its
+keys up in the sorted key array and only the matched rows are copied and
+their geometries decoded. The rows keep the GeoPackage's order, so frames
+read from the store equal gpd.read_file on the reference layer.
+
+File layout: an 8-byte magic, the length of a JSON header (uint64), the
+header, then the arrays, each aligned to 64 bytes.
+"""
+import argparse
+import json
+import os
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+MAGIC = b"RSTORE01"
+ALIGNMENT = 64
+# Layers the Lambda functions join on, and their key column
+DEFAULT_LAYERS = ["R1_Riverlines_SimplifyLine", "rec1_Riverlines_SimplifyLine"]
+DEFAULT_KEY = "Top_reach"
+
+
+def is_reference_store(path):
+    return str(path).endswith(".refstore")
+
+
+def _aligned(offset):
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def _column_arrays(name, values):
+    """Plain numpy arrays for a column: {"values": ..., "nulls": ... (strings only)}."""
+    if values.dtype != object and not pd.api.types.is_string_dtype(values.dtype):
+        array = np.asarray(values)
+        if array.dtype.hasobject:
+            raise ValueError(f"Column {name} of type {values.dtype} cannot be stored.")
+        return {"values": array}
+    nulls = values.isna().to_numpy()
+    if not all(isinstance(value, str) for value in values[~nulls]):
+        raise ValueError(f"Column {name} holds values other than strings.")
+    return {"values": values.fillna("").to_numpy().astype(str), "nulls": nulls}
+
+
+def write_reference_store(gpkg_path, store_path, layers=None, key=DEFAULT_KEY):
+    """Convert layers of a GeoPackage into a reference store file; returns the header."""
+    arrays = {}
+    header = {"source": os.path.basename(gpkg_path), "layers": {}, "arrays": {}}
+    for layer in layers or DEFAULT_LAYERS:
+        gdf = gpd.read_file(gpkg_path, layer=layer)
+        wkb = shapely.to_wkb(gdf.geometry.values)
+        lengths = np.array([0 if value is None else len(value) for value in wkb], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        keys = gdf[key].to_numpy()
+        order = np.argsort(keys, kind="stable")
+        arrays[f"{layer}/sorted_keys"] = keys[order]
+        arrays[f"{layer}/sorted_rows"] = order.astype(np.int64)
+        arrays[f"{layer}/wkb_offsets"] = offsets
+        arrays[f"{layer}/wkb"] = np.frombuffer(
+            b"".join(value for value in wkb if value is not None), dtype=np.uint8
+        )
+        columns = []
+        for name in gdf.columns:
+            if name == gdf.geometry.name:
+                columns.append({"name": name, "geometry": True})
+                continue
+            stored = _column_arrays(name, gdf[name])
+            for part, array in stored.items():
+                arrays[f"{layer}/{part}/{name}"] = array
+            columns.append(
+                {"name": name, "nulls": "nulls" in stored, "dtype": str(gdf[name].dtype)}
+            )
+        header["layers"][layer] = {
+            "key": key,
+            "rows": len(gdf),
+            "crs": gdf.crs.to_wkt() if gdf.crs is not None else None,
+            "columns": columns,
+        }
+        print(
+            f"Layer {layer}: {len(gdf)} rows, {offsets[-1] / 1e6:.1f} MB of WKB, "
+            f"{len(columns) - 1} attribute columns"
+        )
+
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        arrays[name] = array
+        header["arrays"][name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset = _aligned(offset + array.nbytes)
+    encoded = json.dumps(header).encode("utf-8")
+    data_start = _aligned(len(MAGIC) + 8 + len(encoded))
+    with open(store_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(np.uint64(len(encoded)).tobytes())
+        f.write(encoded)
+        for name, array in arrays.items():
+            f.seek(data_start + header["arrays"][name]["offset"])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    print(
+        f"Reference store written to {store_path} "
+        f"({os.path.getsize(store_path) / 1e6:.1f} MB)"
+    )
+    return header
+
+
+class ReferenceLayer:
+    """One layer of a ReferenceStore; arrays are views into the mapped file."""
+
+    def __init__(self, store, name):
+        self.name = name
+        self.info = store.header["layers"][name]
+        self.key = self.info["key"]
+        self.sorted_keys = store.array(f"{name}/sorted_keys")
+        self.sorted_rows = store.array(f"{name}/sorted_rows")
+        self.wkb_offsets = store.array(f"{name}/wkb_offsets")
+        self.wkb = store.array(f"{name}/wkb")
+        self.columns = {
+            column["name"]: (
+                store.array(f"{name}/values/{column['name']}"),
+                store.array(f"{name}/nulls/{column['name']}") if column["nulls"] else None,
+            )
+            for column in self.info["columns"]
+            if not column.get("geometry")
+        }
+
+    def __len__(self):
+        return self.info["rows"]
+
+    def rows_for_keys(self, keys):
+        """Rows (in file order) whose key is one of keys."""
+        keys = np.unique(np.asarray(keys).ravel())
+        keys = keys[~pd.isna(keys)]
+        starts = np.searchsorted(self.sorted_keys, keys, side="left")
+        stops = np.searchsorted(self.sorted_keys, keys, side="right")
+        counts = stops - starts
+        # Positions starts[i] .. stops[i] - 1 of every key, without a Python loop
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        return np.sort(self.sorted_rows[positions])
+
+    def geometries(self, rows):
+        """Shapely geometries of the rows, decoded from their WKB."""
+        starts = self.wkb_offsets[rows]
+        stops = self.wkb_offsets[np.asarray(rows) + 1]
+        # Slices of a memoryview are much cheaper than slices of the memmap
+        buffer = memoryview(self.wkb)
+        wkb = [
+            buffer[start:stop].tobytes() if stop > start else None
+            for start, stop in zip(starts.tolist(), stops.tolist())
+        ]
+        return shapely.from_wkb(np.array(wkb, dtype=object))
+
+    def frame(self, keys=None):
+        """GeoDataFrame of the layer, or of the rows whose key is in keys."""
+        rows = np.arange(len(self)) if keys is None else self.rows_for_keys(keys)
+        data = {}
+        for column in self.info["columns"]:
+            name = column["name"]
+            if column.get("geometry"):
+                data[name] = self.geometries(rows)
+                continue
+            values, nulls = self.columns[name]
+            if nulls is None:
+                data[name] = values[rows]
+            else:
+                strings = values[rows].astype(object)
+                strings[nulls[rows]] = None
+                # object or pandas' str dtype, as read from the GeoPackage
+                data[name] = pd.Series(strings, dtype=column["dtype"])
+        geometry = next(c["name"] for c in self.info["columns"] if c.get("geometry"))
+        return gpd.GeoDataFrame(data, geometry=geometry, crs=self.info["crs"])
+
+
+class ReferenceStore:
+    """A reference store file mapped into memory."""
+
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        if self.buffer[: len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError(f"{path} is not a reference store.")
+        length = int(self.buffer[len(MAGIC) : len(MAGIC) + 8].view(np.uint64)[0])
+        start = len(MAGIC) + 8
+        self.header = json.loads(self.buffer[start : start + length].tobytes())
+        self.data_start = _aligned(start + length)
+
+    def array(self, name):
+        info = self.header["arrays"][name]
+        dtype = np.dtype(info["dtype"])
+        start = self.data_start + info["offset"]
+        count = int(np.prod(info["shape"], dtype=np.int64))
+        return self.buffer[start : start + count * dtype.itemsize].view(dtype).reshape(
+            info["shape"]
+        )
+
+    def layer(self, name):
+        if name not in self.header["layers"]:
+            raise KeyError(f"Layer {name} is not in the reference store {self.path}.")
+        return ReferenceLayer(self, name)
+
+
+_open_stores = {}
+
+
+def open_reference_store(path):
+    """The ReferenceStore of path, mapped once per process."""
+    if path not in _open_stores:
+        _open_stores[path] = ReferenceStore(path)
+    return _open_stores[path]
+
+
+def read_reference_layer(path, layer, keys=None):
+    """A reference layer from a store or a GeoPackage; keys limits a store read to those rows."""
+    if is_reference_store(path):
+        return open_reference_store(path).layer(layer).frame(keys)
+    return gpd.read_file(path, layer=layer)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert reference riverline layers into a memory-mappable store."
+    )
+    parser.add_argument("reference", help="Reference riverlines GeoPackage")
+    parser.add_argument("output", help="Output store (.refstore)")
+    parser.add_argument(
+        "--layers", nargs="+", default=DEFAULT_LAYERS, help="Layers to convert"
+    )
+    parser.add_argument("--key", default=DEFAULT_KEY, help="Key column of the layers")
+    args = parser.parse_args(argv)
+    write_reference_store(args.reference, args.output, args.layers, args.key)
+
+
+if __name__ == "__main__":
+    main()
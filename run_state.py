@@ -0,0 +1,360 @@
+"""
+Run state of the Lambda functions: the temporary ArcGIS Online items each
+run leaves behind for the next one to delete.
+
+Every run writes its own record, keyed by (scope, run_id), where scope is
+the input the run belongs to (the NetCDF file's S3 key, or the final output
+key of the second function). Records carry a version, and every write is
+conditional on the version the writer read, so overlapping invocations
+never overwrite each other's item IDs: a run that lost a race reloads and
+retries. A run reads all records of its scope in one call at the start and
+writes its own record, dropping the records it cleaned up, in one
+conditional batch at the end. A DynamoDB batch holds at most 100 records;
+consumed records beyond that are dropped in further batches of their own.
+
+Set RUN_STATE_TABLE to a DynamoDB table (partition key "scope", sort key
+"run_id", both strings) in production; on Lambda it is required. Without
+it the state lives in the SQLite file RUN_STATE_DB (default
+/tmp/run_state.sqlite), which is meant for local runs and tests.
+
+Earlier versions kept the item IDs in files on S3 (item_metadata.json per
+input, last_temp_item_id.txt); import_legacy_s3_record moves such a file
+into the store the first time a scope without records is read.
+"""
+import abc
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import time
+
+import boto3
+import botocore
+
+# DynamoDB accepts at most 100 actions per TransactWriteItems call
+DYNAMODB_TRANSACTION_LIMIT = 100
+# Run ID of the record imported from an earlier version's file on S3
+LEGACY_RUN_ID = "legacy-s3"
+
+
+class StateConflict(Exception):
+    """A conditional write failed because someone changed the records meanwhile."""
+
+
+class RunStateStore(abc.ABC):
+    """Versioned per-run records; subclasses implement load, scan and commit.
+
+    A record is {"items": dict, "version": int}. items uses the item
+    metadata layout: {key: {"item_id": id} or {"item_ids": [ids]}}, with
+    earlier items that are not deleted yet under "pending".
+    """
+
+    # Most puts and deletes one commit accepts (None: no limit)
+    max_actions = None
+
+    @abc.abstractmethod
+    def load(self, scope):
+        """All records of a scope, as {run_id: record}."""
+
+    @abc.abstractmethod
+    def scan(self, scope_prefix=""):
+        """Records of all scopes starting with scope_prefix, as {scope: {run_id: record}}."""
+
+    @abc.abstractmethod
+    def commit(self, scope, puts=None, deletes=None):
+        """Write and delete records of a scope atomically, or raise StateConflict.
+
+        puts is {run_id: (items, expected_version)} and deletes is
+        {run_id: expected_version}; an expected_version of None means the
+        record must not exist yet. More than max_actions puts and deletes
+        raise ValueError before anything is written.
+        """
+
+    def _check_batch_size(self, puts, deletes):
+        count = len(puts or {}) + len(deletes or {})
+        if self.max_actions is not None and count > self.max_actions:
+            raise ValueError(
+                f"{count} run state writes do not fit into one commit "
+                f"(at most {self.max_actions})."
+            )
+
+    def record_run(self, scope, run_id, items, consumed=None, own_version=None, retries=3):
+        """Write a run's record and drop the consumed records in one conditional batch.
+
+        consumed is {run_id: version} of the records whose items this run
+        deleted, own_version the version of the run's record if it already
+        wrote one. With empty items the run's record is deleted instead.
+        After a conflict the records are reloaded: consumed records that
+        changed meanwhile are kept for a later cleanup. Consumed records
+        that do not fit into the batch (max_actions) are dropped afterwards
+        in batches of their own. Returns the version of the run's record
+        (None if there is none).
+        """
+        consumed = [(other, v) for other, v in (consumed or {}).items() if other != run_id]
+        split = len(consumed) if self.max_actions is None else self.max_actions - 1
+        consumed, later = dict(consumed[:split]), dict(consumed[split:])
+        for attempt in range(retries + 1):
+            puts, deletes = None, dict(consumed)
+            if items:
+                puts = {run_id: (items, own_version)}
+            elif own_version is not None:
+                deletes[run_id] = own_version
+            try:
+                self.commit(scope, puts=puts, deletes=deletes)
+                self._drop_records(scope, later)
+                return (own_version or 0) + 1 if items else None
+            except StateConflict:
+                if attempt == retries:
+                    raise
+                print(
+                    f"Run state of {scope} changed meanwhile, "
+                    f"retrying ({attempt + 1}/{retries})."
+                )
+                current = self.load(scope)
+                consumed = {
+                    other: version
+                    for other, version in consumed.items()
+                    if other in current and current[other]["version"] == version
+                }
+                own_version = current.get(run_id, {}).get("version")
+
+    def _drop_records(self, scope, versions):
+        """Delete records {run_id: version} in batches of max_actions.
+
+        A batch that conflicts is left as it is, for a later cleanup.
+        """
+        run_ids = list(versions)
+        batch_size = self.max_actions or len(run_ids) or 1
+        for i in range(0, len(run_ids), batch_size):
+            batch = {run_id: versions[run_id] for run_id in run_ids[i : i + batch_size]}
+            try:
+                self.commit(scope, deletes=batch)
+            except StateConflict:
+                print(
+                    f"Run state of {scope} changed meanwhile, keeping {len(batch)} "
+                    f"consumed records for a later cleanup."
+                )
+
+
+class DynamoDBStateStore(RunStateStore):
+    """Run state in a DynamoDB table, written with conditional transactions."""
+
+    max_actions = DYNAMODB_TRANSACTION_LIMIT
+
+    def __init__(self, table_name, client=None):
+        self.table_name = table_name
+        self.client = client or boto3.client("dynamodb")
+
+    @staticmethod
+    def _record(item):
+        return {
+            "items": json.loads(item["items"]["S"]),
+            "version": int(item["version"]["N"]),
+        }
+
+    def _paginate(self, operation, **kwargs):
+        kwargs = dict(kwargs, TableName=self.table_name)
+        while True:
+            response = operation(**kwargs)
+            yield from response.get("Items", [])
+            if "LastEvaluatedKey" not in response:
+                return
+            kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+
+    def load(self, scope):
+        return {
+            item["run_id"]["S"]: self._record(item)
+            for item in self._paginate(
+                self.client.query,
+                KeyConditionExpression="#scope = :scope",
+                ExpressionAttributeNames={"#scope": "scope"},
+                ExpressionAttributeValues={":scope": {"S": scope}},
+                ConsistentRead=True,
+            )
+        }
+
+    def scan(self, scope_prefix=""):
+        kwargs = {"ConsistentRead": True}
+        if scope_prefix:
+            kwargs.update(
+                FilterExpression="begins_with(#scope, :prefix)",
+                ExpressionAttributeNames={"#scope": "scope"},
+                ExpressionAttributeValues={":prefix": {"S": scope_prefix}},
+            )
+        records = {}
+        for item in self._paginate(self.client.scan, **kwargs):
+            scope_records = records.setdefault(item["scope"]["S"], {})
+            scope_records[item["run_id"]["S"]] = self._record(item)
+        return records
+
+    @staticmethod
+    def _condition(expected_version):
+        if expected_version is None:
+            return {"ConditionExpression": "attribute_not_exists(run_id)"}
+        return {
+            "ConditionExpression": "version = :version",
+            "ExpressionAttributeValues": {":version": {"N": str(expected_version)}},
+        }
+
+    def commit(self, scope, puts=None, deletes=None):
+        self._check_batch_size(puts, deletes)
+        actions = []
+        for run_id, (items, expected_version) in (puts or {}).items():
+            actions.append(
+                {
+                    "Put": {
+                        "TableName": self.table_name,
+                        "Item": {
+                            "scope": {"S": scope},
+                            "run_id": {"S": run_id},
+                            "items": {"S": json.dumps(items)},
+                            "version": {"N": str((expected_version or 0) + 1)},
+                            "updated_at": {"N": str(time.time())},
+                        },
+                        **self._condition(expected_version),
+                    }
+                }
+            )
+        for run_id, expected_version in (deletes or {}).items():
+            actions.append(
+                {
+                    "Delete": {
+                        "TableName": self.table_name,
+                        "Key": {"scope": {"S": scope}, "run_id": {"S": run_id}},
+                        **self._condition(expected_version),
+                    }
+                }
+            )
+        if not actions:
+            return
+        try:
+            self.client.transact_write_items(TransactItems=actions)
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code", "")
+            if error_code == "TransactionCanceledException":
+                raise StateConflict(str(e)) from e
+            raise
+
+
+class SQLiteStateStore(RunStateStore):
+    """Run state in a local SQLite file, for local runs and tests."""
+
+    def __init__(self, path):
+        self.path = path
+        with contextlib.closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS run_state (scope TEXT NOT NULL, "
+                "run_id TEXT NOT NULL, items TEXT NOT NULL, version INTEGER NOT NULL, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (scope, run_id))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _select(self, where, params):
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT scope, run_id, items, version FROM run_state WHERE {where}", params
+            ).fetchall()
+        return [
+            (scope, run_id, {"items": json.loads(items), "version": version})
+            for scope, run_id, items, version in rows
+        ]
+
+    def load(self, scope):
+        return {run_id: record for _, run_id, record in self._select("scope = ?", (scope,))}
+
+    def scan(self, scope_prefix=""):
+        records = {}
+        for scope, run_id, record in self._select(
+            "substr(scope, 1, ?) = ?", (len(scope_prefix), scope_prefix)
+        ):
+            records.setdefault(scope, {})[run_id] = record
+        return records
+
+    @staticmethod
+    def _check(changed, scope, run_id):
+        if not changed:
+            raise StateConflict(f"Run state of {run_id} in {scope} changed meanwhile.")
+
+    def commit(self, scope, puts=None, deletes=None):
+        self._check_batch_size(puts, deletes)
+        with contextlib.closing(self._connect()) as conn:
+            # BEGIN IMMEDIATE takes the write lock, so the version checks and
+            # the writes happen as one step across processes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                for run_id, (items, expected_version) in (puts or {}).items():
+                    if expected_version is None:
+                        cursor = conn.execute(
+                            "INSERT OR IGNORE INTO run_state VALUES (?, ?, ?, 1, ?)",
+                            (scope, run_id, json.dumps(items), time.time()),
+                        )
+                    else:
+                        cursor = conn.execute(
+                            "UPDATE run_state SET items = ?, version = version + 1, "
+                            "updated_at = ? WHERE scope = ? AND run_id = ? AND version = ?",
+                            (json.dumps(items), time.time(), scope, run_id, expected_version),
+                        )
+                    self._check(cursor.rowcount, scope, run_id)
+                for run_id, expected_version in (deletes or {}).items():
+                    cursor = conn.execute(
+                        "DELETE FROM run_state WHERE scope = ? AND run_id = ? AND version = ?",
+                        (scope, run_id, expected_version),
+                    )
+                    self._check(cursor.rowcount, scope, run_id)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+
+def open_state_store():
+    """The DynamoDB store if RUN_STATE_TABLE is set, else the local SQLite store.
+
+    On Lambda RUN_STATE_TABLE is required: a SQLite file in /tmp is lost
+    when the execution environment is recycled, and with it the IDs of the
+    items still to delete.
+    """
+    if os.environ.get("RUN_STATE_TABLE"):
+        return DynamoDBStateStore(os.environ["RUN_STATE_TABLE"])
+    if os.environ.get("AWS_LAMBDA_FUNCTION_NAME"):
+        raise RuntimeError(
+            "RUN_STATE_TABLE must be set on Lambda; the local SQLite run state "
+            "would be lost when the execution environment is recycled."
+        )
+    path = os.environ.get("RUN_STATE_DB") or os.path.join(
+        tempfile.gettempdir(), "run_state.sqlite"
+    )
+    return SQLiteStateStore(path)
+
+
+def import_legacy_s3_record(state_store, scope, bucket, key, parse, s3_client=None):
+    """Records of a scope, after importing the item IDs an earlier version left on S3.
+
+    Only while the scope has no records: the file s3://bucket/key, if there
+    is one, is parsed with parse(text) into the item metadata layout and
+    written as the LEGACY_RUN_ID record, so the usual cleanup deletes its
+    items, and the file is deleted.
+    """
+    records = state_store.load(scope)
+    if records:
+        return records
+    s3_client = s3_client or boto3.client("s3")
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except botocore.exceptions.ClientError as e:
+        if e.response.get("Error", {}).get("Code", "") in ("404", "NoSuchKey"):
+            return records
+        raise
+    items = parse(body.decode("utf-8"))
+    if items:
+        try:
+            state_store.commit(scope, puts={LEGACY_RUN_ID: (items, None)})
+            print(f"Imported the item IDs of s3://{bucket}/{key} into the run state.")
+        except StateConflict:
+            # Another run imported the file meanwhile
+            pass
+    s3_client.delete_object(Bucket=bucket, Key=key)
+    return state_store.load(scope)
@@ -0,0 +1,235 @@
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import tempfile
+import uuid
+
+import boto3
+import pandas as pd
+from netCDF4 import Dataset
+from pandas.api.types import union_categoricals
+
+from lambda_function import (
+    build_frames_from_decoded,
+    decode_netcdf_file,
+    open_netcdf_dataset,
+    read_frames_from_sqlite,
+    write_frames_to_sqlite,
+)
+
+
+def open_netcdf_metadata(s3_path):
+    """Open a NetCDF file for its dimensions without reading the whole file.
+
+    s3:// files are opened through a presigned URL in netCDF's byte-range
+    mode, which only fetches the blocks that are read; local files and Zarr
+    stores open lazily anyway. Falls back to reading the file into memory if
+    the netCDF library has no byte-range support.
+    """
+    if not s3_path.startswith("s3://") or ".zarr" in s3_path:
+        return open_netcdf_dataset(s3_path)
+    bucket, _, key = s3_path[len("s3://"):].partition("/")
+    url = boto3.client("s3").generate_presigned_url(
+        "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=600
+    )
+    try:
+        return Dataset(f"{url}#mode=bytes", mode="r")
+    except OSError as e:
+        print(f"Byte-range read of {s3_path} failed ({e}), reading the whole file.")
+        return open_netcdf_dataset(s3_path)
+
+
+def get_reach_count(s3_path):
+    """Return the length of the nrch dimension of a NetCDF file."""
+    dataset = open_netcdf_metadata(s3_path)
+    try:
+        if "nrch" not in dataset.dimensions:
+            raise KeyError("Dimension 'nrch' not found in the NetCDF file.")
+        return len(dataset.dimensions["nrch"])
+    finally:
+        dataset.close()
+
+
+def plan_shards(reach_count, shard_count):
+    """Split range(reach_count) into at most shard_count contiguous (start, stop) ranges."""
+    shard_count = max(1, min(shard_count, reach_count))
+    step, remainder = divmod(reach_count, shard_count)
+    shards = []
+    start = 0
+    for i in range(shard_count):
+        stop = start + step + (1 if i < remainder else 0)
+        shards.append((start, stop))
+        start = stop
+    return shards
+
+
+def run_shard(s3_path, start, stop):
+    """Worker: run the existing transform on one reach range.
+
+    Returns the raw long-format frame and its per-reach maxima for the shard.
+    """
+    print(f"Processing shard nrch[{start}:{stop}] of {s3_path}")
+    return build_frames_from_decoded(
+        decode_netcdf_file(s3_path, reach_range=(start, stop))
+    )
+
+
+def unify_categories(frames):
+    """Give the categorical columns of all frames the union of their categories.
+
+    pd.concat only keeps a categorical dtype if the categories are identical,
+    and the shards can see different time steps (e.g. all-invalid ones).
+    """
+    if not frames:
+        return frames
+    for column in frames[0].columns:
+        if not isinstance(frames[0][column].dtype, pd.CategoricalDtype):
+            continue
+        categories = union_categoricals(
+            [frame[column] for frame in frames], sort_categories=True
+        ).categories
+        for frame in frames:
+            frame[column] = frame[column].cat.set_categories(categories)
+    return frames
+
+
+def reduce_shards(shard_results):
+    """Reducer: merge shard outputs into the frames the single-worker path produces.
+
+    Every reach lives in exactly one shard, so the per-reach aggregates of the
+    shards (maxima, means, counts) only need to be concatenated.
+    """
+    raw_frames = unify_categories([raw for raw, _ in shard_results])
+    aggregated_frames = [aggregated for _, aggregated in shard_results]
+    df = pd.concat(raw_frames, ignore_index=True)
+    aggregated_data = pd.concat(aggregated_frames, ignore_index=True).sort_values(
+        ["rchid", "streamorder"], ignore_index=True
+    )
+    print(f"Merged {len(shard_results)} shards into DataFrame with shape: {df.shape}")
+    return df, aggregated_data
+
+
+def _shard_worker(s3_path, start, stop, conn):
+    """Run one shard in a worker process and send its frames back."""
+    try:
+        conn.send(("ok", run_shard(s3_path, start, stop)))
+    except Exception as e:
+        conn.send(("error", f"Shard nrch[{start}:{stop}] failed: {type(e).__name__}: {e}"))
+    finally:
+        conn.close()
+
+
+def run_sharded_local(s3_path, shard_count, max_workers=None):
+    """Fan the shards out over local worker processes standing in for Lambda workers.
+
+    Uses plain Process/Pipe like decode_variables_parallel, because Lambda
+    has no /dev/shm for multiprocessing pools; at most max_workers shards
+    run at a time.
+    """
+    shards = plan_shards(get_reach_count(s3_path), shard_count)
+    max_workers = max(1, min(max_workers or os.cpu_count() or 1, len(shards)))
+    print(f"Running {len(shards)} shards in up to {max_workers} local processes...")
+    # Keep shard order so the merged frame is deterministic
+    shard_results = []
+    errors = []
+    for first in range(0, len(shards), max_workers):
+        processes = []
+        for start, stop in shards[first : first + max_workers]:
+            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+            process = multiprocessing.Process(
+                target=_shard_worker, args=(s3_path, start, stop, child_conn)
+            )
+            process.start()
+            child_conn.close()
+            processes.append((process, parent_conn))
+        for process, parent_conn in processes:
+            # Receive before joining: a worker blocks until its frames are read
+            try:
+                status, payload = parent_conn.recv()
+            except EOFError:
+                status, payload = "error", "shard worker exited without a result"
+            process.join()
+            if status == "ok":
+                shard_results.append(payload)
+            else:
+                errors.append(payload)
+    if errors:
+        raise RuntimeError(f"Local sharded run failed: {'; '.join(errors)}")
+    return reduce_shards(shard_results)
+
+
+def shard_worker_handler(event, context):
+    """Lambda entry point for a shard worker.
+
+    Expects event["shard"] with s3_path, start, stop, output_bucket and
+    output_key; the shard frames are written to S3 because Lambda responses
+    are capped at 6 MB.
+    """
+    shard = event["shard"]
+    df, aggregated_data = run_shard(shard["s3_path"], shard["start"], shard["stop"])
+    local_path = os.path.join(
+        tempfile.gettempdir(), f"shard_{shard['start']}_{shard['stop']}.sqlite"
+    )
+    write_frames_to_sqlite({"raw": df, "aggregated": aggregated_data}, local_path)
+    boto3.client("s3").upload_file(
+        local_path, shard["output_bucket"], shard["output_key"]
+    )
+    os.remove(local_path)
+    print(
+        f"Shard written to s3://{shard['output_bucket']}/{shard['output_key']}"
+    )
+    return {"statusCode": 200, "output_key": shard["output_key"]}
+
+
+def run_sharded_lambda(s3_path, shard_count, function_name, output_bucket, run_id=None):
+    """Fan the shards out as synchronous invocations of a worker Lambda."""
+    run_id = run_id or uuid.uuid4().hex
+    shards = plan_shards(get_reach_count(s3_path), shard_count)
+    lambda_client = boto3.client("lambda")
+    s3_client = boto3.client("s3")
+
+    def invoke(start, stop):
+        payload = {
+            "shard": {
+                "s3_path": s3_path,
+                "start": start,
+                "stop": stop,
+                "output_bucket": output_bucket,
+                "output_key": f"shards/{run_id}/shard_{start}_{stop}.sqlite",
+            }
+        }
+        response = lambda_client.invoke(
+            FunctionName=function_name,
+            InvocationType="RequestResponse",
+            Payload=json.dumps(payload).encode("utf-8"),
+        )
+        result = json.loads(response["Payload"].read())
+        if response.get("FunctionError") or result.get("statusCode") != 200:
+            raise RuntimeError(f"Shard nrch[{start}:{stop}] failed: {result}")
+        return result["output_key"]
+
+    print(f"Invoking {len(shards)} shard workers on Lambda '{function_name}'...")
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(shards)) as executor:
+        output_keys = list(executor.map(lambda shard: invoke(*shard), shards))
+
+    shard_results = []
+    for output_key in output_keys:
+        local_path = os.path.join(tempfile.gettempdir(), os.path.basename(output_key))
+        s3_client.download_file(output_bucket, output_key, local_path)
+        frames = read_frames_from_sqlite(local_path, ["raw", "aggregated"])
+        shard_results.append((frames["raw"], frames["aggregated"]))
+        os.remove(local_path)
+        s3_client.delete_object(Bucket=output_bucket, Key=output_key)
+    return reduce_shards(shard_results)
+
+
+def run_sharded(s3_path, shard_count):
+    """Run the sharded transform, on Lambda workers if SHARD_WORKER_FUNCTION is set
+    and on a local process pool otherwise."""
+    function_name = os.environ.get("SHARD_WORKER_FUNCTION")
+    if function_name:
+        return run_sharded_lambda(
+            s3_path, shard_count, function_name, os.environ["OUTPUT_S3_BUCKET"]
+        )
+    return run_sharded_local(s3_path, shard_count)
@@ -0,0 +1,152 @@
+import concurrent.futures
+import threading
+import time
+
+
+class StagePipeline:
+    """Run the steps of a Lambda invocation as named stages with declared dependencies.
+
+    submit() starts a stage on a worker thread as soon as the stages it
+    comes after have finished, so network I/O (logins, downloads, uploads)
+    overlaps with the CPU-bound stages that run() executes on the calling
+    thread. A stage function gets the results of its dependencies as
+    arguments, in the order of after. report() prints every stage's timing
+    and the critical path: the chain of stages that set the total run time.
+    """
+
+    def __init__(self, max_workers=4):
+        self.started = time.perf_counter()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = {}
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.last_main_stage = None
+
+    def __contains__(self, name):
+        return name in self.futures
+
+    def _register(self, name, after, thread):
+        if name in self.futures:
+            raise ValueError(f"Stage {name} is already defined.")
+        unknown = [dep for dep in after if dep not in self.futures]
+        if unknown:
+            raise ValueError(f"Stage {name} comes after unknown stages {unknown}.")
+        stage = {"after": list(after), "thread": thread, "start": None, "end": None}
+        if thread == "main":
+            # Stages on the calling thread also wait for the one before them
+            stage["previous"] = self.last_main_stage
+            self.last_main_stage = name
+        self.stages[name] = stage
+        self.futures[name] = concurrent.futures.Future()
+        return self.futures[name]
+
+    def _execute(self, name, func, after):
+        results = [self.futures[dep].result() for dep in after]
+        stage = self.stages[name]
+        stage["start"] = time.perf_counter() - self.started
+        try:
+            return func(*results)
+        except BaseException:
+            stage["failed"] = True
+            raise
+        finally:
+            stage["end"] = time.perf_counter() - self.started
+
+    def submit(self, name, func, after=()):
+        """Run func on a worker thread once the stages in after are done."""
+        future = self._register(name, after, "worker")
+        waiting = [len(after)]
+
+        def resolve(inner):
+            if inner.exception() is not None:
+                future.set_exception(inner.exception())
+            else:
+                future.set_result(inner.result())
+
+        def launch(_=None):
+            with self.lock:
+                waiting[0] -= 1
+                if waiting[0] > 0:
+                    return
+            self.executor.submit(self._execute, name, func, after).add_done_callback(resolve)
+
+        if not after:
+            waiting[0] = 1
+            launch()
+        for dep in after:
+            self.futures[dep].add_done_callback(launch)
+        return future
+
+    def run(self, name, func, after=()):
+        """Run func on the calling thread after the stages in after; returns its result."""
+        future = self._register(name, after, "main")
+        try:
+            result = self._execute(name, func, after)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+
+    def result(self, name):
+        """Wait for a stage and return its result (or raise its exception)."""
+        return self.futures[name].result()
+
+    def close(self):
+        """Wait for all submitted stages, e.g. before the Lambda invocation returns."""
+        concurrent.futures.wait(list(self.futures.values()))
+        self.executor.shutdown(wait=True)
+
+    def critical_path(self):
+        """Names of the stages on the critical path, first to last."""
+        finished = {name: s for name, s in self.stages.items() if s["end"] is not None}
+        if not finished:
+            return []
+        name = max(finished, key=lambda n: finished[n]["end"])
+        path = [name]
+        while True:
+            stage = finished[name]
+            gates = [
+                dep
+                for dep in stage["after"] + [stage.get("previous")]
+                if dep in finished
+            ]
+            if not gates:
+                break
+            # The dependency that finished last held this stage back
+            name = max(gates, key=lambda n: finished[n]["end"])
+            path.append(name)
+        return path[::-1]
+
+    def report(self):
+        """Print the stage timeline and the critical path; returns the path."""
+        total = time.perf_counter() - self.started
+        print(f"Stage timeline ({total:.1f} s in total):")
+        busy = 0.0
+        for name, stage in sorted(
+            self.stages.items(), key=lambda item: item[1]["start"] or float("inf")
+        ):
+            if stage["start"] is None:
+                print(f"  {name:<32} not started")
+                continue
+            duration = stage["end"] - stage["start"]
+            busy += duration
+            status = " (failed)" if stage.get("failed") else ""
+            after = f" after {', '.join(stage['after'])}" if stage["after"] else ""
+            print(
+                f"  {name:<32} {stage['thread']:<6} {stage['start']:7.2f} - "
+                f"{stage['end']:7.2f} s {duration:7.2f} s{status}{after}"
+            )
+        path = self.critical_path()
+        print(
+            "Critical path: "
+            + " -> ".join(
+                f"{name} ({self.stages[name]['end'] - self.stages[name]['start']:.1f} s)"
+                for name in path
+            )
+        )
+        print(
+            f"Stage time {busy:.1f} s in {total:.1f} s of wall time "
+            f"({max(busy - total, 0.0):.1f} s overlapped)."
+        )
+        return path
@@ -0,0 +1,149 @@
+import json
+import os
+
+import pytest
+
+import portal_client
+from chunked_upload import ChunkedUploader, UploadError
+from fake_portal import start_fake_portal
+
+PART_SIZE = 1024
+
+
+@pytest.fixture
+def portal():
+    server = start_fake_portal()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture
+def upload_file(tmp_path):
+    path = tmp_path / "layer.gpkg"
+    path.write_bytes(os.urandom(5 * PART_SIZE + 100))
+    return str(path)
+
+
+def make_uploader(portal, **kwargs):
+    kwargs.setdefault("part_size", PART_SIZE)
+    kwargs.setdefault("backoff_seconds", 0)
+    return ChunkedUploader(portal.url, "me", "token", **kwargs)
+
+
+def test_upload_commits_the_parts_in_order(portal, upload_file, tmp_path):
+    state_path = str(tmp_path / "state.json")
+    item_id = make_uploader(portal).upload(
+        upload_file, {"type": "GeoPackage", "title": "layer"}, state_path=state_path
+    )
+
+    item = portal.items[item_id]
+    assert item["status"] == "completed"
+    assert item["properties"]["title"] == "layer"
+    assert portal.item_bytes(item_id) == open(upload_file, "rb").read()
+    assert portal.part_requests == 6
+    assert not os.path.exists(state_path)
+
+
+def test_upload_from_memory(portal):
+    data = os.urandom(2 * PART_SIZE + 1)
+    item_id = make_uploader(portal).upload("memory.gpkg", {"type": "GeoPackage"}, data=data)
+
+    assert portal.item_bytes(item_id) == data
+    assert not os.path.exists("memory.gpkg.upload.json")
+
+
+def test_resume_sends_only_the_missing_parts(portal, upload_file, tmp_path, monkeypatch):
+    state_path = str(tmp_path / "state.json")
+    uploader = make_uploader(portal, max_workers=1)
+    upload_part = ChunkedUploader._upload_part
+
+    def fail_part_three(self, item_id, path, part_num, data=None):
+        if part_num == 3:
+            raise UploadError("connection lost")
+        return upload_part(self, item_id, path, part_num, data)
+
+    monkeypatch.setattr(ChunkedUploader, "_upload_part", fail_part_three)
+    with pytest.raises(UploadError):
+        uploader.upload(upload_file, {"type": "GeoPackage"}, state_path=state_path)
+    with open(state_path) as f:
+        first_item_id = json.load(f)["item_id"]
+    assert portal.items[first_item_id]["status"] == "partial"
+    sent = portal.part_requests
+
+    monkeypatch.setattr(ChunkedUploader, "_upload_part", upload_part)
+    item_id = uploader.upload(upload_file, {"type": "GeoPackage"}, state_path=state_path)
+
+    assert item_id == first_item_id
+    assert portal.part_requests - sent == 1
+    assert portal.item_bytes(item_id) == open(upload_file, "rb").read()
+    assert not os.path.exists(state_path)
+
+
+def test_resume_starts_over_when_the_file_changed(portal, upload_file, tmp_path):
+    state_path = tmp_path / "state.json"
+    state_path.write_text(
+        json.dumps({"item_id": "gone", "file_size": 1, "part_size": PART_SIZE})
+    )
+    item_id = make_uploader(portal).upload(
+        upload_file, {"type": "GeoPackage"}, state_path=str(state_path)
+    )
+
+    assert item_id != "gone"
+    assert portal.item_bytes(item_id) == open(upload_file, "rb").read()
+
+
+def test_state_file_defaults_to_the_temp_directory(portal, upload_file, tmp_path, monkeypatch):
+    state_dir = tmp_path / "state"
+    state_dir.mkdir()
+    monkeypatch.setattr("tempfile.tempdir", str(state_dir))
+    uploader = make_uploader(portal, max_retries=0)
+    portal.fail_rate = 1.0
+
+    with pytest.raises(UploadError):
+        uploader.upload(upload_file, {"type": "GeoPackage"})
+
+    assert os.listdir(state_dir) == ["layer.gpkg.upload.json"]
+
+
+def test_failed_parts_are_retried(portal, upload_file, tmp_path):
+    portal.fail_parts = {2: 1, 5: 2}
+    item_id = make_uploader(portal).upload(
+        upload_file, {"type": "GeoPackage"}, state_path=str(tmp_path / "state.json")
+    )
+
+    assert portal.item_bytes(item_id) == open(upload_file, "rb").read()
+    assert portal.part_requests == 6 + 3
+
+
+def test_rejected_requests_are_not_retried(portal, tmp_path, monkeypatch):
+    delays = []
+    monkeypatch.setattr(portal_client.time, "sleep", delays.append)
+    portal.fail_status = 403
+    portal.fail_parts = {1: 1}
+    path = tmp_path / "small.gpkg"
+    path.write_bytes(b"x" * 10)
+
+    with pytest.raises(UploadError, match="HTTP 403"):
+        make_uploader(portal).upload(
+            str(path), {"type": "GeoPackage"}, state_path=str(tmp_path / "s")
+        )
+
+    assert portal.part_requests == 1
+    assert delays == []
+
+
+def test_backoff_doubles_until_the_retries_are_used_up(portal, tmp_path, monkeypatch):
+    delays = []
+    monkeypatch.setattr(portal_client.time, "sleep", delays.append)
+    portal.fail_rate = 1.0
+    path = tmp_path / "small.gpkg"
+    path.write_bytes(b"x" * 10)
+    uploader = make_uploader(portal, max_retries=3, backoff_seconds=1.0)
+
+    with pytest.raises(UploadError, match="after 4 attempts"):
+        uploader.upload(str(path), {"type": "GeoPackage"}, state_path=str(tmp_path / "s"))
+
+    assert portal.part_requests == 4
+    assert len(delays) == 3
+    for attempt, delay in enumerate(delays):
+        assert 0.5 * 2**attempt <= delay < 1.5 * 2**attempt
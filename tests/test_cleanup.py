@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from chunked_upload import ChunkedUploader
+from cleanup import ItemCleaner, item_ids_from_metadata, start_cleanup, sweep
+from fake_portal import start_fake_portal
+from run_state import SQLiteStateStore
+
+
+@pytest.fixture
+def portal():
+    server = start_fake_portal()
+    yield server
+    server.shutdown()
+
+
+def add_items(portal, count):
+    uploader = ChunkedUploader(portal.url, "me", "token")
+    return [
+        uploader.upload(f"item{i}.gpkg", {"type": "GeoPackage"}, data=b"x")
+        for i in range(count)
+    ]
+
+
+def make_cleaner(portal, **kwargs):
+    return ItemCleaner(portal.url, "me", "token", backoff_seconds=0, **kwargs)
+
+
+def test_items_are_deleted_in_batches(portal):
+    item_ids = add_items(portal, 7)
+    cleaner = make_cleaner(portal, batch_size=3)
+
+    assert cleaner.delete_items(item_ids + item_ids[:2]) == []
+    assert portal.items == {}
+    # 3 deleteItems batches for the 7 distinct IDs, no individual purges
+    assert portal.delete_requests == 3
+
+
+def test_ids_a_batch_did_not_delete_are_purged_one_by_one(portal, capsys):
+    item_ids = add_items(portal, 2)
+
+    # items/missing/delete reports the item as gone, which counts as deleted
+    assert make_cleaner(portal).delete_items(item_ids + ["missing"]) == []
+    assert "Deleted 3 of 3 items" in capsys.readouterr().out
+    assert portal.items == {}
+
+
+def test_failed_batches_fall_back_to_single_deletes(portal):
+    item_ids = add_items(portal, 5)
+    random.seed(3)
+    portal.fail_rate = 0.5
+
+    failed = make_cleaner(portal, batch_size=2, max_retries=0).delete_items(item_ids)
+
+    # Exactly the items still on the portal are reported as failed
+    assert set(failed) == set(portal.items)
+
+
+def test_start_cleanup_returns_the_ids_left_over(portal):
+    item_ids = add_items(portal, 3)
+    portal.fail_rate = 1.0
+
+    future = start_cleanup(make_cleaner(portal, max_retries=0), item_ids)
+
+    assert sorted(future.result()) == sorted(item_ids)
+
+
+def test_item_ids_from_metadata():
+    metadata = {
+        "first_geopackage": {"item_ids": ["a", "b"]},
+        "second_geopackage": {"item_id": "c"},
+        "pending": {"item_ids": ["d"]},
+    }
+    assert item_ids_from_metadata(metadata) == ["a", "b", "c", "d"]
+
+
+def test_sweep_deletes_recorded_items_and_keeps_failures(portal, tmp_path):
+    store = SQLiteStateStore(str(tmp_path / "state.sqlite"))
+    item_ids = add_items(portal, 3)
+    store.record_run("forecasts/a.nc", "run1", {"first_geopackage": {"item_ids": item_ids[:2]}})
+    store.record_run("forecasts/b.nc", "run2", {"second_geopackage": {"item_id": item_ids[2]}})
+    store.record_run("other/c.nc", "run3", {"pending": {"item_ids": ["kept"]}})
+
+    assert sweep(make_cleaner(portal), store, "forecasts/") == 3
+
+    assert portal.items == {}
+    assert store.scan("forecasts/") == {}
+    assert "run3" in store.load("other/c.nc")
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+from netCDF4 import Dataset
+
+import lambda_function
+
+VARIABLE = "relativeValues95thPercentile"
+THRESHOLD = "relative_thresholds_2yr"
+
+
+@pytest.fixture
+def netcdf_path(tmp_path):
+    """Four time steps: the second one masked, the fourth repeating the third.
+
+    The threshold is stored as float64, the values as float32.
+    """
+    path = str(tmp_path / "forecast.nc")
+    n_reaches = 3
+    with Dataset(path, "w") as ds:
+        ds.createDimension("time", 4)
+        ds.createDimension("nrch", n_reaches)
+        time = ds.createVariable("time", "f8", ("time",), fill_value=-9999.0)
+        time.units = "hours since 2024-01-01 00:00:00"
+        time[:] = np.ma.masked_array([0.0, 0.0, 1.0, 1.0], mask=[False, True, False, False])
+        ds.createVariable("nrch", "i4", ("nrch",))[:] = np.arange(n_reaches)
+        ds.createVariable("rchid", "i4", ("nrch",))[:] = np.arange(n_reaches) + 1000
+        ds.createVariable("streamorder", "i4", ("nrch",))[:] = [1, 2, 3]
+        values = ds.createVariable(VARIABLE, "f4", ("time", "nrch"))
+        values[:] = np.arange(4 * n_reaches, dtype="f4").reshape(4, n_reaches)
+        ds.createVariable(THRESHOLD, "f8", ("nrch",))[:] = [0.5, 1.5, 2.5]
+    return path
+
+
+def test_masked_and_repeated_time_steps(netcdf_path):
+    decoded = lambda_function.decode_netcdf_file(netcdf_path, variables=[VARIABLE, THRESHOLD])
+
+    assert np.isnat(decoded["time_values"][1])
+    assert not decoded["valid"]["first"][1].any()
+    assert decoded["valid"]["first"][[0, 2, 3]].all()
+
+    df = lambda_function.flatten_decoded_netcdf(decoded)
+
+    assert len(df) == 3 * 3
+    assert list(df["time_stamp_date"].cat.categories) == list(
+        pd.to_datetime(["2024-01-01 00:00", "2024-01-01 01:00"])
+    )
+    assert df["time_stamp_date"].value_counts().to_dict() == {
+        pd.Timestamp("2024-01-01 01:00"): 6,
+        pd.Timestamp("2024-01-01 00:00"): 3,
+    }
+    # Rows of the masked time step are dropped, not shifted onto its neighbours
+    assert sorted(df[VARIABLE.lower()]) == [0, 1, 2, 6, 7, 8, 9, 10, 11]
+
+
+def test_value_columns_keep_wider_file_dtypes(netcdf_path, tmp_path):
+    decoded = lambda_function.decode_netcdf_file(netcdf_path, variables=[VARIABLE, THRESHOLD])
+    df = lambda_function.flatten_decoded_netcdf(decoded)
+    aggregated = lambda_function.reduce_reach_statistics(decoded, [VARIABLE, THRESHOLD])
+
+    assert df[VARIABLE.lower()].dtype == "float32"
+    assert df[THRESHOLD].dtype == "float64"
+    assert aggregated[VARIABLE.lower()].dtype == "float32"
+    assert aggregated[THRESHOLD].dtype == "float64"
+
+    path = str(tmp_path / "frames.sqlite")
+    lambda_function.write_frames_to_sqlite({"raw": df, "aggregated": aggregated}, path)
+    frames = lambda_function.read_frames_from_sqlite(path, ["raw", "aggregated"])
+
+    assert frames["raw"].dtypes.to_dict() == df.dtypes.to_dict()
+    assert frames["aggregated"][THRESHOLD].dtype == "float64"
@@ -0,0 +1,87 @@
+import numpy as np
+import pandas as pd
+import pytest
+from netCDF4 import num2date
+
+from netcdf_decode import decode_cf_times
+
+
+def num2date_seconds(values, units, calendar="standard"):
+    """num2date truncated to whole seconds, as read_time_values did it."""
+    dates = num2date(values, units=units, calendar=calendar)
+    return np.array(
+        [
+            np.datetime64("NaT")
+            if np.ma.is_masked(date)
+            else np.datetime64(date.strftime("%Y-%m-%dT%H:%M:%S"))
+            for date in np.ma.asarray(dates, dtype=object).ravel()
+        ],
+        dtype="datetime64[ns]",
+    )
+
+
+@pytest.mark.parametrize(
+    "units, values",
+    [
+        ("hours since 2024-01-01 00:00:00", np.arange(0, 240, 1.0)),
+        ("seconds since 1970-01-01", np.array([0, 1.4, 1.6, 86399.999, 1.7e9])),
+        ("minutes since 2023-06-30T12:30:00", np.arange(-90, 90, 7.5)),
+        ("days since 1900-01-01", np.array([0, 0.5, 45000.25, 45000.9999999])),
+        ("milliseconds since 2024-02-28 23:59:59", np.array([0, 999, 1000, 86400000])),
+    ],
+)
+@pytest.mark.parametrize("calendar", ["standard", "gregorian", "proleptic_gregorian"])
+def test_matches_num2date(units, values, calendar):
+    expected = num2date_seconds(values, units, calendar)
+
+    times = decode_cf_times(values, units, calendar)
+
+    assert times.dtype == np.dtype("datetime64[ns]")
+    np.testing.assert_array_equal(times, expected)
+
+
+def test_integer_values_match_num2date():
+    values = np.arange(0, 48, dtype="int32")
+    units = "hours since 2024-01-01"
+
+    np.testing.assert_array_equal(decode_cf_times(values, units), num2date_seconds(values, units))
+
+
+def test_masked_and_non_finite_values_become_nat():
+    values = np.ma.masked_array([0.0, 1.0, np.nan, 1e30], mask=[False, True, False, True])
+
+    times = decode_cf_times(values, "hours since 2024-01-01")
+
+    assert times[0] == np.datetime64("2024-01-01T00:00:00")
+    assert np.isnat(times[1:]).all()
+
+
+@pytest.mark.parametrize(
+    "units, calendar",
+    [
+        ("hours since 2024-01-01", "noleap"),
+        ("hours since 2024-01-01", "360_day"),
+        ("months since 2024-01-01", "standard"),
+        ("hours", "standard"),
+        ("hours since not a date", "standard"),
+    ],
+)
+def test_leaves_what_only_cftime_handles_to_num2date(units, calendar):
+    assert decode_cf_times(np.arange(3.0), units, calendar) is None
+
+
+def test_standard_calendar_before_the_gregorian_reform_falls_back():
+    assert decode_cf_times(np.array([0.0]), "days since 1500-01-01") is None
+
+
+@pytest.mark.parametrize(
+    "units, values",
+    [
+        ("days since 2200-01-01", [0.0, 36500.0]),
+        ("days since 1700-01-01", [-10000.0]),
+        ("seconds since 1970-01-01", [1e30]),
+    ],
+)
+def test_times_outside_the_nanosecond_range_raise(units, values):
+    with pytest.raises(pd.errors.OutOfBoundsDatetime):
+        decode_cf_times(np.array(values), units)
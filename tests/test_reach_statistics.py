@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import lambda_function
+
+VARIABLE = "relativeValues95thPercentile"
+THRESHOLD = "relative_thresholds_2yr"
+
+
+@pytest.fixture
+def decoded():
+    rng = np.random.default_rng(0)
+    n_times, n_reaches = 12, 6
+    values = rng.uniform(0, 5, (n_times, n_reaches)).astype("float32")
+    valid = rng.random((n_times, n_reaches)) > 0.2
+    # A reach without valid cells and one with a single valid cell
+    valid[:, 4] = False
+    valid[:, 5] = False
+    valid[7, 5] = True
+    return {
+        "time_values": (
+            np.datetime64("2024-01-01T00:00", "ns")
+            + np.arange(n_times) * np.timedelta64(1, "h")
+        ),
+        "nrch": np.arange(n_reaches),
+        "variables": {
+            "rchid": np.array([60, 10, 50, 20, 40, 30], dtype="int32"),
+            "streamorder": np.array([1, 2, 3, 1, 2, 3], dtype="int32"),
+            VARIABLE: values,
+            THRESHOLD: np.full(n_reaches, 2.5, dtype="float32"),
+        },
+        "valid": {"first": np.ones_like(valid), "second": valid},
+    }
+
+
+def long_table(decoded):
+    """The valid cells as a long table, as the groupby aggregation used."""
+    time_index, reach_index = np.nonzero(decoded["valid"]["second"])
+    data = decoded["variables"]
+    return pd.DataFrame(
+        {
+            "rchid": data["rchid"][reach_index].astype("int64"),
+            "streamorder": data["streamorder"][reach_index].astype("int64"),
+            "time_stamp_date": decoded["time_values"][time_index],
+            "value": data[VARIABLE][time_index, reach_index].astype("float64"),
+            "threshold": data[THRESHOLD][reach_index].astype("float64"),
+        }
+    )
+
+
+def test_reductions_match_a_groupby_over_the_long_table(decoded):
+    result = lambda_function.reduce_reach_statistics(
+        decoded, [VARIABLE], ("max", "mean", "argmax_time", "exceedance_count"), THRESHOLD
+    )
+
+    groups = long_table(decoded).groupby(["rchid", "streamorder"])
+    expected = pd.DataFrame(
+        {
+            "max": groups["value"].max(),
+            "mean": groups["value"].mean(),
+            "argmax_time": groups.apply(
+                lambda g: g["time_stamp_date"][g["value"].idxmax()], include_groups=False
+            ),
+            "exceedance_count": groups.apply(
+                lambda g: (g["value"] > g["threshold"]).sum(), include_groups=False
+            ),
+            "time_stamp_date": groups["time_stamp_date"].max(),
+        }
+    ).reset_index()
+
+    name = VARIABLE.lower()
+    assert result["rchid"].tolist() == expected["rchid"].tolist() == [10, 20, 30, 50, 60]
+    assert result["streamorder"].tolist() == expected["streamorder"].tolist()
+    np.testing.assert_allclose(result[name], expected["max"], rtol=1e-6)
+    np.testing.assert_allclose(result[f"{name}_mean"], expected["mean"], rtol=1e-6)
+    assert (
+        pd.to_datetime(result[f"{name}_argmax_time"]).tolist()
+        == pd.to_datetime(expected["argmax_time"]).tolist()
+    )
+    assert result[f"{name}_exceedance_count"].tolist() == expected["exceedance_count"].tolist()
+    assert (
+        pd.to_datetime(result["time_stamp_date"]).tolist()
+        == pd.to_datetime(expected["time_stamp_date"]).tolist()
+    )
+
+
+def test_numeric_exceedance_threshold(decoded):
+    result = lambda_function.reduce_reach_statistics(
+        decoded, [VARIABLE], ("exceedance_count",), 1.0
+    )
+
+    expected = long_table(decoded).assign(above=lambda df: df["value"] > 1.0)
+    counts = expected.groupby("rchid")["above"].sum()
+    assert result[f"{VARIABLE.lower()}_exceedance_count"].tolist() == counts.tolist()
+
+
+def test_exceedance_count_needs_a_threshold(decoded):
+    with pytest.raises(ValueError):
+        lambda_function.reduce_reach_statistics(decoded, [VARIABLE], ("exceedance_count",))
+
+
+def test_parse_reach_statistics():
+    assert lambda_function.parse_reach_statistics(" max , mean,") == ["max", "mean"]
+    assert lambda_function.parse_reach_statistics(["argmax_time"]) == ["argmax_time"]
+    with pytest.raises(ValueError, match="median"):
+        lambda_function.parse_reach_statistics("max,median")
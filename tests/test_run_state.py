@@ -0,0 +1,184 @@
+import json
+
+import boto3
+import pytest
+
+from run_state import (
+    LEGACY_RUN_ID,
+    DynamoDBStateStore,
+    SQLiteStateStore,
+    StateConflict,
+    import_legacy_s3_record,
+    open_state_store,
+)
+
+SCOPE = "forecasts/a.nc"
+
+
+def create_table(client, name):
+    client.create_table(
+        TableName=name,
+        KeySchema=[
+            {"AttributeName": "scope", "KeyType": "HASH"},
+            {"AttributeName": "run_id", "KeyType": "RANGE"},
+        ],
+        AttributeDefinitions=[
+            {"AttributeName": "scope", "AttributeType": "S"},
+            {"AttributeName": "run_id", "AttributeType": "S"},
+        ],
+        BillingMode="PAY_PER_REQUEST",
+    )
+
+
+@pytest.fixture(params=["sqlite", "dynamodb"])
+def store(request, tmp_path, monkeypatch):
+    if request.param == "sqlite":
+        yield SQLiteStateStore(str(tmp_path / "state.sqlite"))
+        return
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with moto.mock_aws():
+        client = boto3.client("dynamodb")
+        create_table(client, "run-state")
+        yield DynamoDBStateStore("run-state", client)
+
+
+def test_new_records_must_not_exist_yet(store):
+    store.commit(SCOPE, puts={"run1": ({"a": {"item_id": "x"}}, None)})
+
+    with pytest.raises(StateConflict):
+        store.commit(SCOPE, puts={"run1": ({"a": {"item_id": "y"}}, None)})
+    assert store.load(SCOPE) == {"run1": {"items": {"a": {"item_id": "x"}}, "version": 1}}
+
+
+def test_writes_are_conditional_on_the_version(store):
+    store.commit(SCOPE, puts={"run1": ({"a": {"item_id": "x"}}, None)})
+    store.commit(SCOPE, puts={"run1": ({"a": {"item_id": "y"}}, 1)})
+
+    with pytest.raises(StateConflict):
+        store.commit(SCOPE, puts={"run1": ({"a": {"item_id": "z"}}, 1)})
+    with pytest.raises(StateConflict):
+        store.commit(SCOPE, deletes={"run1": 1})
+    assert store.load(SCOPE)["run1"] == {"items": {"a": {"item_id": "y"}}, "version": 2}
+
+
+def test_a_conflict_writes_nothing(store):
+    store.commit(SCOPE, puts={"run1": ({"a": {"item_id": "x"}}, None)})
+
+    with pytest.raises(StateConflict):
+        store.commit(
+            SCOPE, puts={"run2": ({"b": {"item_id": "y"}}, None)}, deletes={"run1": 7}
+        )
+    assert list(store.load(SCOPE)) == ["run1"]
+
+
+def test_record_run_drops_the_consumed_records(store):
+    store.record_run(SCOPE, "run1", {"a": {"item_id": "x"}})
+    consumed = {run_id: record["version"] for run_id, record in store.load(SCOPE).items()}
+
+    version = store.record_run(SCOPE, "run2", {"b": {"item_id": "y"}}, consumed)
+    assert version == 1
+    assert list(store.load(SCOPE)) == ["run2"]
+
+    # Only pending items left: the record is rewritten; none left: it is deleted
+    version = store.record_run(
+        SCOPE, "run2", {"pending": {"item_ids": ["y"]}}, own_version=version
+    )
+    assert store.load(SCOPE)["run2"]["version"] == version == 2
+    assert store.record_run(SCOPE, "run2", {}, own_version=version) is None
+    assert store.load(SCOPE) == {}
+
+
+def test_overlapping_runs_keep_each_others_items(store):
+    store.record_run(SCOPE, "old", {"a": {"item_id": "x"}})
+    # Both runs read the old record before either of them writes
+    seen_by_first = {run_id: r["version"] for run_id, r in store.load(SCOPE).items()}
+    seen_by_second = dict(seen_by_first)
+
+    store.record_run(SCOPE, "first", {"b": {"item_id": "y"}}, seen_by_first)
+    store.record_run(SCOPE, "second", {"c": {"item_id": "z"}}, seen_by_second)
+
+    records = store.load(SCOPE)
+    assert sorted(records) == ["first", "second"]
+    assert records["first"]["items"] == {"b": {"item_id": "y"}}
+
+
+def test_consumed_records_changed_meanwhile_are_kept(store):
+    store.record_run(SCOPE, "old", {"a": {"item_id": "x"}})
+    seen = {run_id: r["version"] for run_id, r in store.load(SCOPE).items()}
+    # The old run records another item after it was read
+    store.record_run(
+        SCOPE, "old", {"a": {"item_id": "x"}, "b": {"item_id": "w"}}, own_version=1
+    )
+
+    store.record_run(SCOPE, "new", {"c": {"item_id": "z"}}, seen)
+
+    assert sorted(store.load(SCOPE)) == ["new", "old"]
+
+
+def test_scan_filters_by_scope_prefix(store):
+    store.record_run("forecasts/a.nc", "run1", {"a": {"item_id": "x"}})
+    store.record_run("forecasts/b.nc", "run2", {"b": {"item_id": "y"}})
+    store.record_run("other/c.nc", "run3", {"c": {"item_id": "z"}})
+
+    assert sorted(store.scan("forecasts/")) == ["forecasts/a.nc", "forecasts/b.nc"]
+    assert len(store.scan()) == 3
+
+
+def test_open_state_store(tmp_path, monkeypatch):
+    monkeypatch.delenv("RUN_STATE_TABLE", raising=False)
+    monkeypatch.delenv("AWS_LAMBDA_FUNCTION_NAME", raising=False)
+    monkeypatch.setenv("RUN_STATE_DB", str(tmp_path / "state.sqlite"))
+    store = open_state_store()
+    assert isinstance(store, SQLiteStateStore)
+    assert store.path == str(tmp_path / "state.sqlite")
+
+    monkeypatch.setenv("AWS_LAMBDA_FUNCTION_NAME", "topnet")
+    with pytest.raises(RuntimeError, match="RUN_STATE_TABLE"):
+        open_state_store()
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("RUN_STATE_TABLE", "run-state")
+    store = open_state_store()
+    assert isinstance(store, DynamoDBStateStore)
+    assert store.table_name == "run-state"
+
+
+def test_commits_larger_than_a_transaction_are_refused(store, monkeypatch):
+    monkeypatch.setattr(store, "max_actions", 3)
+    puts = {f"run{i}": ({"a": {"item_id": str(i)}}, None) for i in range(4)}
+
+    with pytest.raises(ValueError, match="at most 3"):
+        store.commit(SCOPE, puts=puts)
+    assert store.load(SCOPE) == {}
+
+
+def test_record_run_drops_more_consumed_records_than_fit_into_one_commit(store):
+    for start in (0, 75):
+        puts = {f"old{i:03d}": ({"a": {"item_id": str(i)}}, None) for i in range(start, start + 75)}
+        store.commit(SCOPE, puts=puts)
+    consumed = {run_id: record["version"] for run_id, record in store.load(SCOPE).items()}
+
+    store.record_run(SCOPE, "new", {"a": {"item_id": "n"}}, consumed)
+
+    assert list(store.load(SCOPE)) == ["new"]
+
+
+def test_legacy_s3_file_is_imported_once(tmp_path, monkeypatch):
+    moto = pytest.importorskip("moto")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    store = SQLiteStateStore(str(tmp_path / "state.sqlite"))
+    key = f"{SCOPE}/item_metadata.json"
+    with moto.mock_aws():
+        s3 = boto3.client("s3")
+        s3.create_bucket(Bucket="input")
+        s3.put_object(Bucket="input", Key=key, Body=b'{"first_geopackage": {"item_id": "x"}}')
+
+        records = import_legacy_s3_record(store, SCOPE, "input", key, json.loads, s3)
+
+        assert records == {
+            LEGACY_RUN_ID: {"items": {"first_geopackage": {"item_id": "x"}}, "version": 1}
+        }
+        assert "Contents" not in s3.list_objects_v2(Bucket="input")
+        assert import_legacy_s3_record(store, SCOPE, "input", key, json.loads, s3) == records
+        assert import_legacy_s3_record(store, "other.nc", "input", key, json.loads, s3) == {}
@@ -0,0 +1,103 @@
+import threading
+import time
+
+import pytest
+
+from stages import StagePipeline
+
+
+@pytest.fixture
+def pipeline():
+    pipeline = StagePipeline(max_workers=4)
+    yield pipeline
+    pipeline.close()
+
+
+def test_stages_get_their_dependencies_results_in_order(pipeline):
+    pipeline.submit("a", lambda: 1)
+    pipeline.submit("b", lambda: 2)
+    pipeline.submit("sum", lambda b, a: (b, a), after=["b", "a"])
+
+    assert pipeline.run("main", lambda pair: pair, after=["sum"]) == (2, 1)
+    assert pipeline.result("sum") == (2, 1)
+
+
+def test_a_stage_starts_only_after_its_dependencies(pipeline):
+    order = []
+    release = threading.Event()
+
+    def slow():
+        release.wait(5)
+        order.append("slow")
+
+    pipeline.submit("slow", slow)
+    pipeline.submit("next", lambda _: order.append("next"), after=["slow"])
+    time.sleep(0.05)
+    assert order == []
+
+    release.set()
+    pipeline.result("next")
+    assert order == ["slow", "next"]
+
+
+def test_worker_stages_overlap_the_main_thread(pipeline):
+    started = threading.Event()
+    pipeline.submit("download", lambda: started.set() or "data")
+
+    # Would time out if the worker stage waited for the main thread
+    assert pipeline.run("compute", lambda: started.wait(5))
+    assert pipeline.run("use", lambda data: data, after=["download"]) == "data"
+
+
+def test_a_failure_fails_the_stages_after_it(pipeline):
+    called = []
+
+    def fail():
+        raise RuntimeError("login failed")
+
+    pipeline.submit("login", fail)
+    pipeline.submit("upload", lambda _: called.append("upload"), after=["login"])
+
+    with pytest.raises(RuntimeError, match="login failed"):
+        pipeline.result("upload")
+    with pytest.raises(RuntimeError, match="login failed"):
+        pipeline.run("append", lambda _: called.append("append"), after=["upload"])
+    assert called == []
+    assert pipeline.stages["login"]["failed"]
+    assert pipeline.stages["upload"]["start"] is None
+
+
+def test_a_failing_main_stage_raises_and_fails_its_dependents(pipeline):
+    def fail():
+        raise ValueError("bad file")
+
+    with pytest.raises(ValueError):
+        pipeline.run("transform", fail)
+    pipeline.submit("publish", lambda _: None, after=["transform"])
+
+    with pytest.raises(ValueError, match="bad file"):
+        pipeline.result("publish")
+    assert pipeline.stages["transform"]["failed"]
+
+
+def test_stage_names_are_checked(pipeline):
+    pipeline.submit("a", lambda: None)
+
+    with pytest.raises(ValueError, match="already defined"):
+        pipeline.submit("a", lambda: None)
+    with pytest.raises(ValueError, match="unknown stages"):
+        pipeline.run("b", lambda _: None, after=["missing"])
+    assert "a" in pipeline
+    assert "b" not in pipeline
+
+
+def test_critical_path_follows_the_stage_that_finished_last(pipeline, capsys):
+    pipeline.submit("download", lambda: time.sleep(0.1))
+    pipeline.submit("login", lambda: None)
+    pipeline.run("decode", lambda: None)
+    pipeline.run("publish", lambda download, login: None, after=["download", "login"])
+
+    assert pipeline.report() == ["download", "publish"]
+    out = capsys.readouterr().out
+    assert "Critical path: download" in out
+    assert "publish" in out
@@ -0,0 +1,356 @@
+"""
+Shrink the GeoPackages published to ArcGIS Online before they are uploaded,
+and report their size and append latency per layer.
+
+UPLOAD_OPTIMIZATIONS lists the steps applied to every published GeoPackage
+(comma-separated; empty disables them):
+
+- drop_unmatched: drop features without geometry, i.e. reaches of the first
+  (right) join that are not in the reference riverlines
+- compact: drop the R-tree and attribute indexes, which append does not use;
+  the published layers are then written without them (opt-in, by default
+  they keep the indexes, see "GeoPackage indexes" in the README)
+- quantize: snap the coordinates to a grid of UPLOAD_GRID_SIZE CRS units
+  (default 0.01, 1 cm in NZTM; 1e-7 for geographic CRS), dropping the
+  vertices that fall onto the same grid point
+- narrow: declare float columns holding only whole numbers (e.g. keys that
+  became float through the join's missing values) as the smallest integer
+  type
+- compress: upload the GeoPackage zipped (.zip); only for portals that
+  accept zipped GeoPackage items
+
+The default, "drop_unmatched", edits the written GeoPackage in SQLite and
+vacuums it, which costs far less than it saves. quantize and
+narrow rewrite the layer through GDAL; SQLite already stores whole numbers
+and WKB compactly, so they only pay off together with compress. Rounded
+float columns stay float64: float32 would change the values ArcGIS receives.
+"""
+import concurrent.futures
+import contextlib
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pyogrio
+import shapely
+
+from gpkg_memory import GeoPackageOutput, as_geopackage_output
+
+UPLOAD_OPTIMIZATION_STEPS = ["drop_unmatched", "compact", "quantize", "narrow", "compress"]
+DEFAULT_UPLOAD_OPTIMIZATIONS = "drop_unmatched"
+# Steps that need the layer read into a GeoDataFrame and written again
+REWRITE_STEPS = {"quantize", "narrow"}
+# Flag of the GeoPackage geometry header marking an empty geometry
+GPKG_EMPTY_FLAG = 0x10
+# Smallest first; pandas' nullable types keep the missing values
+INTEGER_TYPES = ["Int8", "Int16", "Int32", "Int64"]
+
+
+def upload_optimizations():
+    """Steps from UPLOAD_OPTIMIZATIONS, in the order they are applied."""
+    value = os.environ.get("UPLOAD_OPTIMIZATIONS", DEFAULT_UPLOAD_OPTIMIZATIONS)
+    steps = [step.strip() for step in value.split(",") if step.strip()]
+    unknown = [step for step in steps if step not in UPLOAD_OPTIMIZATION_STEPS]
+    if unknown:
+        raise ValueError(
+            f"Unknown upload optimizations {unknown}, expected some of "
+            f"{', '.join(UPLOAD_OPTIMIZATION_STEPS)}."
+        )
+    return [step for step in UPLOAD_OPTIMIZATION_STEPS if step in steps]
+
+
+def published_index_options(optimizations=None):
+    """build_geopackage index arguments for a published layer.
+
+    With compact the payload's indexes are dropped before the upload anyway,
+    so the layer is written without the R-tree and attribute indexes.
+    """
+    optimizations = upload_optimizations() if optimizations is None else optimizations
+    if "compact" in optimizations:
+        return {"spatial_index": False, "index_columns": []}
+    return {}
+
+
+def upload_grid_size(crs=None):
+    """Grid the coordinates are snapped to, from UPLOAD_GRID_SIZE (CRS units)."""
+    if os.environ.get("UPLOAD_GRID_SIZE"):
+        return float(os.environ["UPLOAD_GRID_SIZE"])
+    return 1e-7 if crs is not None and crs.is_geographic else 0.01
+
+
+def append_wait_seconds():
+    """How long a run waits for its append jobs to time them (UPLOAD_APPEND_WAIT_SECONDS)."""
+    return float(os.environ.get("UPLOAD_APPEND_WAIT_SECONDS", "300"))
+
+
+def drop_unmatched_rows(gdf):
+    """Rows with a geometry; the others cannot be drawn on the hosted layer."""
+    matched = ~(gdf.geometry.isna() | gdf.geometry.is_empty)
+    return gdf[matched].reset_index(drop=True)
+
+
+def _is_empty_geometry(blob):
+    return blob is not None and len(blob) > 3 and bool(blob[3] & GPKG_EMPTY_FLAG)
+
+
+def drop_unmatched_features(conn, layer, column):
+    """Delete the features without geometry from a GeoPackage layer; returns how many."""
+    conn.create_function("is_empty_geometry", 1, _is_empty_geometry, deterministic=True)
+    return conn.execute(
+        f'DELETE FROM "{layer}" WHERE "{column}" IS NULL OR is_empty_geometry("{column}")'
+    ).rowcount
+
+
+def drop_layer_indexes(conn, layer, column):
+    """Drop the R-tree (with its triggers) and the attribute indexes of a GeoPackage layer."""
+    rtree = f"rtree_{layer}_{column}"
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)).fetchone():
+        triggers = conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = ? "
+            "AND substr(name, 1, ?) = ?",
+            (layer, len(rtree) + 1, f"{rtree}_"),
+        ).fetchall()
+        for (name,) in triggers:
+            conn.execute(f'DROP TRIGGER "{name}"')
+        conn.execute(f'DROP TABLE "{rtree}"')
+        conn.execute(
+            "DELETE FROM gpkg_extensions WHERE table_name = ? AND column_name = ? "
+            "AND extension_name = 'gpkg_rtree_index'",
+            (layer, column),
+        )
+    # Automatic indexes (primary keys, unique constraints) have no SQL
+    indexes = conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? "
+        "AND sql IS NOT NULL",
+        (layer,),
+    ).fetchall()
+    for (name,) in indexes:
+        conn.execute(f'DROP INDEX "{name}"')
+
+
+def quantize_geometries(gdf, grid_size):
+    """Snap the coordinates to grid_size, removing repeated vertices."""
+    gdf = gdf.copy()
+    gdf[gdf.geometry.name] = shapely.set_precision(
+        np.asarray(gdf.geometry.values), grid_size
+    )
+    return gdf
+
+
+def narrow_attribute_types(gdf):
+    """Store numeric columns holding only whole numbers as the smallest integer type."""
+    for column in gdf.columns:
+        values = gdf[column]
+        if column == gdf.geometry.name or pd.api.types.is_bool_dtype(values):
+            continue
+        if not pd.api.types.is_numeric_dtype(values):
+            continue
+        data = values.to_numpy(dtype="float64", na_value=np.nan)
+        valid = data[~np.isnan(data)]
+        if not len(valid) or not np.array_equal(valid, np.trunc(valid)):
+            continue
+        for dtype in INTEGER_TYPES:
+            limits = np.iinfo(dtype.lower())
+            if limits.min <= valid.min() and valid.max() <= limits.max:
+                if values.dtype != dtype:
+                    gdf[column] = values.astype(dtype)
+                break
+    return gdf
+
+
+def compress_geopackage(output, output_dir=None):
+    """The GeoPackage zipped, as a GeoPackageOutput named <name>.zip."""
+    name = f"{os.path.splitext(output.name)[0]}.zip"
+    if output.in_memory:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(output.name, output.data)
+        return GeoPackageOutput(name, data=buffer.getvalue())
+    path = os.path.join(output_dir or os.path.dirname(output.path), name)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(output.path, output.name)
+    return GeoPackageOutput(name, path=path)
+
+
+def _edit_geopackage(source, optimizations, output_dir=None):
+    """drop_unmatched and compact as SQL on a copy of the GeoPackage; returns (output, rows)."""
+    if source.in_memory:
+        output = GeoPackageOutput(source.name, data=source.data)
+    else:
+        path = os.path.join(output_dir or tempfile.gettempdir(), source.name)
+        if os.path.abspath(path) != os.path.abspath(source.path):
+            shutil.copyfile(source.path, path)
+        output = GeoPackageOutput(source.name, path=path)
+    with contextlib.closing(output.connect()) as conn:
+        layer, column = conn.execute(
+            "SELECT table_name, column_name FROM gpkg_geometry_columns"
+        ).fetchone()
+        rows = conn.execute(f'SELECT COUNT(*) FROM "{layer}"').fetchone()[0]
+        if "compact" in optimizations:
+            drop_layer_indexes(conn, layer, column)
+        if "drop_unmatched" in optimizations:
+            rows_after = rows - drop_unmatched_features(conn, layer, column)
+        else:
+            rows_after = rows
+        conn.commit()
+        if output.in_memory:
+            output.data = conn.serialize()
+    # Free the pages of the deleted features and indexes
+    output.vacuum()
+    return output, (rows, rows_after)
+
+
+def _rewrite_geopackage(source, optimizations, grid_size, memory_budget, output_dir):
+    """All steps but compress on the layer read into a GeoDataFrame; returns (output, rows)."""
+    layer = pyogrio.list_layers(source.source())[0][0]
+    gdf = pyogrio.read_dataframe(source.source(), layer=layer)
+    rows = len(gdf)
+    if "drop_unmatched" in optimizations:
+        gdf = drop_unmatched_rows(gdf)
+    if "quantize" in optimizations:
+        gdf = quantize_geometries(
+            gdf, upload_grid_size(gdf.crs) if grid_size is None else grid_size
+        )
+    if "narrow" in optimizations:
+        gdf = narrow_attribute_types(gdf)
+    compact = "compact" in optimizations
+    output = GeoPackageOutput.from_frame(
+        gdf,
+        source.name,
+        layer,
+        memory_budget,
+        output_dir,
+        spatial_index=not compact,
+        index_columns=[] if compact else None,
+    )
+    return output, (rows, len(gdf))
+
+
+def optimize_upload_payload(
+    output, optimizations=None, grid_size=None, memory_budget=None, output_dir=None
+):
+    """Apply the upload optimizations to a one-layer GeoPackage.
+
+    Returns the GeoPackageOutput to upload and its stats. The payload is
+    written to output_dir (default: the temp directory) under the source's
+    name, or kept in memory if the source is; quantize and narrow build it
+    in memory if it fits memory_budget (default GEOPACKAGE_MEMORY_BUDGET_MB).
+    A source elsewhere than output_dir is left alone.
+    """
+    source = as_geopackage_output(output)
+    optimizations = upload_optimizations() if optimizations is None else optimizations
+    started = time.perf_counter()
+    stats = {"bytes_before": source.size, "optimizations": list(optimizations)}
+    output = source
+    if REWRITE_STEPS & set(optimizations):
+        output, rows = _rewrite_geopackage(
+            source, optimizations, grid_size, memory_budget, output_dir
+        )
+        stats["rows_before"], stats["rows_after"] = rows
+    elif {"drop_unmatched", "compact"} & set(optimizations):
+        output, rows = _edit_geopackage(source, optimizations, output_dir)
+        stats["rows_before"], stats["rows_after"] = rows
+    if "compress" in optimizations:
+        compressed = compress_geopackage(output, output_dir)
+        if output is not source:
+            output.remove()
+        output = compressed
+    stats["bytes_after"] = output.size
+    stats["seconds"] = time.perf_counter() - started
+    if optimizations:
+        print(
+            f"Upload payload {output.name}: {stats['bytes_before'] / 1e6:.2f} MB -> "
+            f"{stats['bytes_after'] / 1e6:.2f} MB ({', '.join(optimizations)}) "
+            f"in {stats['seconds']:.2f} s."
+        )
+    return output, stats
+
+
+def remove_payload(payload, output):
+    """Delete an uploaded payload, unless it is the GeoPackage output it was made from."""
+    source = as_geopackage_output(output)
+    if payload is source:
+        return
+    if payload.path and source.path:
+        if os.path.abspath(payload.path) == os.path.abspath(source.path):
+            # Optimized in place
+            return
+    payload.remove()
+
+
+class UploadReport:
+    """Payload sizes and upload/append latencies of the layers a run publishes.
+
+    Times are measured from start(key), when the layer's publish begins;
+    the append latency is when its append job finished.
+    """
+
+    def __init__(self):
+        self.layers = {}
+        self.appends = []
+
+    def optimize(self, key, output, **kwargs):
+        """optimize_upload_payload for a layer, keeping its stats; returns the payload."""
+        payload, stats = optimize_upload_payload(output, **kwargs)
+        self.layers.setdefault(key, {}).update(stats)
+        return payload
+
+    def start(self, key):
+        self.layers.setdefault(key, {})["started"] = time.perf_counter()
+
+    def track_append(self, key, result):
+        """Record the upload time and time the append result (a Future with future=True)."""
+        layer = self.layers.setdefault(key, {})
+        layer["upload_seconds"] = time.perf_counter() - layer["started"]
+        if not isinstance(result, concurrent.futures.Future):
+            done = concurrent.futures.Future()
+            done.set_result(result)
+            result = done
+
+        def finished(future):
+            layer["append_seconds"] = time.perf_counter() - layer["started"]
+            layer["append_failed"] = future.exception() is not None
+
+        result.add_done_callback(finished)
+        self.appends.append(result)
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for the append jobs; True if all finished."""
+        if not self.appends:
+            return True
+        _, running = concurrent.futures.wait(self.appends, timeout=timeout)
+        return not running
+
+    def report(self):
+        """Print bytes before/after and the latencies of every layer."""
+        if not self.layers:
+            return
+        print("Upload payloads:")
+        for key, layer in self.layers.items():
+            line = f"  {key:<32}"
+            if "rows_before" in layer:
+                line += f" {layer['rows_before']} -> {layer['rows_after']} rows,"
+            if "bytes_before" in layer:
+                saved = 1 - layer["bytes_after"] / layer["bytes_before"]
+                line += (
+                    f" {layer['bytes_before'] / 1e6:.2f} -> {layer['bytes_after'] / 1e6:.2f} MB"
+                    f" ({saved:.0%} smaller), optimized in {layer['seconds']:.2f} s"
+                )
+            if "upload_seconds" in layer:
+                line += f"; uploaded after {layer['upload_seconds']:.1f} s"
+            if layer.get("append_failed"):
+                line += f", append failed after {layer['append_seconds']:.1f} s"
+            elif "append_seconds" in layer:
+                line += f", appended after {layer['append_seconds']:.1f} s"
+            elif "upload_seconds" in layer:
+                line += ", append still running"
+            print(line)
+        before = sum(layer.get("bytes_before", 0) for layer in self.layers.values())
+        after = sum(layer.get("bytes_after", 0) for layer in self.layers.values())
+        if before:
+            print(f"Uploaded {after / 1e6:.2f} MB instead of {before / 1e6:.2f} MB.")
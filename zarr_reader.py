@@ -0,0 +1,254 @@
+"""
+Read forecast Zarr stores (local directories or s3:// prefixes) through the
+netCDF4 Dataset interface the NetCDF readers already use.
+
+Example:
+    python zarr_reader.py ./forecast.nc ./forecast.zarr --time-chunk 24
+
+open_zarr_dataset returns a ZarrDataset with .variables, .dimensions and
+close() like netCDF4.Dataset. Variable reads come back as masked arrays with
+_FillValue / missing_value masked and scale_factor / add_offset applied, as
+netCDF4 does. Reads are split along the first axis at chunk boundaries and
+the blocks are fetched and decoded on a thread pool (ZARR_FETCH_WORKERS,
+default 16); read_variables does this for several variables at once.
+Dimension names come from the _ARRAY_DIMENSIONS attribute written by xarray.
+
+zarr is only imported once a store is opened, so NetCDF-only deployments do
+not need it. The stores are opened with the zarr 2 API (FSStore,
+DirectoryStore), so the Lambda layer needs zarr<3. The command line converts
+a NetCDF file into a Zarr directory store with the same variables and
+attributes, e.g. for tests and benchmarks.
+"""
+import argparse
+import concurrent.futures
+import os
+
+import numpy as np
+from netCDF4 import Dataset
+
+
+def is_zarr_path(path):
+    """Whether path names a Zarr store (or an object inside one)."""
+    return ".zarr/" in f"{path}/"
+
+
+def zarr_store_path(path):
+    """Store path of a path that may name an object inside it (.../x.zarr/.zmetadata)."""
+    head, _, _ = f"{path}/".partition(".zarr/")
+    return f"{head}.zarr"
+
+
+def import_zarr():
+    """Import zarr, which has to be a 2.x release (the storage API changed in 3)."""
+    import zarr
+
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        raise ImportError(
+            f"zarr_reader needs zarr<3, found zarr {zarr.__version__}; "
+            "install it with pip install 'zarr<3'."
+        )
+    return zarr
+
+
+def fetch_workers():
+    return int(os.environ.get("ZARR_FETCH_WORKERS", "16"))
+
+
+class ZarrDimension:
+    """Length of a dimension, like netCDF4.Dimension."""
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+
+class ZarrVariable:
+    """One array of the store, indexed like a netCDF4.Variable."""
+
+    def __init__(self, name, array, executor):
+        self.name = name
+        self.array = array
+        self.executor = executor
+        self.dimensions = tuple(array.attrs.get("_ARRAY_DIMENSIONS", ()))
+        self._cache = None
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def ndim(self):
+        return self.array.ndim
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def ncattrs(self):
+        return [key for key in self.array.attrs if key != "_ARRAY_DIMENSIONS"]
+
+    def __getattr__(self, name):
+        # NetCDF attributes such as units, like netCDF4.Variable
+        attrs = self.__dict__["array"].attrs
+        if name in attrs:
+            return attrs[name]
+        raise AttributeError(name)
+
+    def _blocks(self, key):
+        """Split a basic-slicing key at the chunk boundaries of the first axis."""
+        key = key if isinstance(key, tuple) else (key,)
+        key = key + (slice(None),) * (self.ndim - len(key))
+        start, stop, step = key[0].indices(self.shape[0])
+        if step != 1:
+            return [key]
+        chunk = self.array.chunks[0]
+        edges = [start] + list(range((start // chunk + 1) * chunk, stop, chunk)) + [stop]
+        return [(slice(a, b),) + key[1:] for a, b in zip(edges[:-1], edges[1:]) if b > a]
+
+    def submit(self, key=slice(None)):
+        """Start fetching key; returns the futures of its blocks."""
+        return [
+            self.executor.submit(self.array.__getitem__, block) for block in self._blocks(key)
+        ]
+
+    def assemble(self, futures):
+        """Join the blocks of submit() and mask/scale them like netCDF4."""
+        blocks = [future.result() for future in futures]
+        raw = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+        return self._mask_and_scale(raw)
+
+    def _mask_and_scale(self, raw):
+        attrs = self.array.attrs
+        invalid = np.zeros(raw.shape, dtype=bool)
+        for attr in ("_FillValue", "missing_value"):
+            for fill in np.atleast_1d(attrs.get(attr, [])):
+                invalid |= raw == fill
+        values = raw
+        if "scale_factor" in attrs or "add_offset" in attrs:
+            values = raw * attrs.get("scale_factor", 1.0) + attrs.get("add_offset", 0.0)
+        return np.ma.masked_array(values, mask=invalid)
+
+    def __getitem__(self, key):
+        if self._cache is not None:
+            return self._cache[key]
+        parts = key if isinstance(key, tuple) else (key,)
+        if all(isinstance(part, slice) for part in parts):
+            return self.assemble(self.submit(key))
+        # Element-wise access (e.g. in a Python loop): read the array once
+        self._cache = self.assemble(self.submit())
+        return self._cache[key]
+
+
+class ZarrDataset:
+    """A Zarr group with the netCDF4.Dataset attributes the readers use."""
+
+    def __init__(self, path, max_workers=None):
+        zarr = import_zarr()
+
+        path = zarr_store_path(path)
+        if path.startswith("s3://"):
+            store = zarr.storage.FSStore(path, mode="r")
+        else:
+            store = zarr.storage.DirectoryStore(path)
+        try:
+            self.group = zarr.open_consolidated(store, mode="r")
+        except KeyError:
+            self.group = zarr.open_group(store, mode="r")
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers or fetch_workers()
+        )
+        self.variables = {
+            name: ZarrVariable(name, array, self.executor)
+            for name, array in self.group.arrays()
+        }
+        self.dimensions = {}
+        for variable in self.variables.values():
+            for name, size in zip(variable.dimensions, variable.shape):
+                self.dimensions[name] = ZarrDimension(name, size)
+
+    def read_variables(self, names, reach_slice=slice(None)):
+        """Read several variables with all their chunk blocks fetched concurrently.
+
+        Time-dependent (time, nrch) variables are read as [:, reach_slice],
+        per-reach ones as [reach_slice].
+        """
+        futures = {}
+        for name in names:
+            variable = self.variables[name]
+            if variable.dimensions[0] == "time":
+                futures[name] = variable.submit((slice(None), reach_slice))
+            else:
+                futures[name] = variable.submit(reach_slice)
+        return {name: self.variables[name].assemble(f) for name, f in futures.items()}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def open_zarr_dataset(path, max_workers=None):
+    """Open a local or s3:// Zarr store as a ZarrDataset."""
+    return ZarrDataset(path, max_workers)
+
+
+def write_zarr_from_netcdf(netcdf_path, zarr_path, time_chunk=24, reach_chunk=50000):
+    """Copy every variable of a NetCDF file into a Zarr directory store (shuffle + zlib).
+
+    Raw (unscaled, unmasked) values and all attributes are kept, with the
+    dimension names in _ARRAY_DIMENSIONS, so the store reads back like the
+    NetCDF file.
+    """
+    from numcodecs import Shuffle, Zlib
+
+    zarr = import_zarr()
+
+    dataset = Dataset(netcdf_path, mode="r")
+    dataset.set_auto_maskandscale(False)
+    group = zarr.open_group(zarr.storage.DirectoryStore(zarr_path), mode="w")
+    for name, variable in dataset.variables.items():
+        chunks = tuple(
+            {"time": time_chunk, "nrch": reach_chunk}.get(dim, size)
+            for dim, size in zip(variable.dimensions, variable.shape)
+        )
+        array = group.create_dataset(
+            name,
+            data=variable[:],
+            chunks=chunks or None,
+            filters=[Shuffle(elementsize=variable.dtype.itemsize)],
+            compressor=Zlib(level=4),
+            overwrite=True,
+        )
+        array.attrs.update(
+            {attr: _json_value(variable.getncattr(attr)) for attr in variable.ncattrs()}
+        )
+        array.attrs["_ARRAY_DIMENSIONS"] = list(variable.dimensions)
+    dataset.close()
+    zarr.consolidate_metadata(group.store)
+    return zarr_path
+
+
+def _json_value(value):
+    """NetCDF attribute value as something JSON can hold."""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Convert a NetCDF file into a Zarr directory store."
+    )
+    parser.add_argument("netcdf", help="Input NetCDF file")
+    parser.add_argument("zarr", help="Output Zarr directory (.zarr)")
+    parser.add_argument("--time-chunk", type=int, default=24, help="Time steps per chunk")
+    parser.add_argument("--reach-chunk", type=int, default=50000, help="Reaches per chunk")
+    args = parser.parse_args(argv)
+    write_zarr_from_netcdf(args.netcdf, args.zarr, args.time_chunk, args.reach_chunk)
+
+
+if __name__ == "__main__":
+    main()